@@ -1,19 +1,21 @@
-from db import db, update_user, get_user, get_user_by_username, get_room, update_room, get_chat_history, insert_blocked_word, remove_blocked_word, get_blocked_words
+from usercache import cache as user_cache
+from db import db, update_user, get_user, get_user_by_username, get_room, update_room, get_chat_history, insert_blocked_word, get_blocked_words
+from db import remove_blocked_word as delete_blocked_word
+from premium_expiry import scheduler as expiry_scheduler
+from matchmaker import matchmaker
+import moderation
 from models import default_report
 from datetime import datetime, timedelta
 
 async def approve_premium(user_id, duration_days=90):
     expiry = (datetime.utcnow() + timedelta(days=duration_days)).isoformat()
     await update_user(user_id, {"is_premium": True, "premium_expiry": expiry})
+    expiry_scheduler.schedule(user_id, expiry)
     return expiry
 
 async def reset_premium(user_id):
     await update_user(user_id, {"is_premium": False, "premium_expiry": None})
-
-async def downgrade_expired_premium():
-    now = datetime.utcnow().isoformat()
-    async for user in db.users.find({"is_premium": True, "premium_expiry": {"$lt": now}}):
-        await update_user(user["user_id"], {"is_premium": False})
+    expiry_scheduler.cancel(user_id)
 
 async def block_user(user_id):
     await update_user(user_id, {"blocked": True})
@@ -37,14 +39,18 @@ async def send_admin_message(bot, user_id_or_username, text, file=None):
 
 async def add_blocked_word(word):
     await insert_blocked_word(word)
+    await moderation.reload()
 
 async def remove_blocked_word(word):
-    await remove_blocked_word(word)
+    await delete_blocked_word(word)
+    await moderation.reload()
 
 async def get_stats():
     users_count = await db.users.count_documents({})
     rooms_count = await db.rooms.count_documents({})
     reports_count = await db.reports.count_documents({})
     return {
-        "users": users_count, "rooms": rooms_count, "reports": reports_count
+        "users": users_count, "rooms": rooms_count, "reports": reports_count,
+        "user_cache": {**user_cache.stats, "size": len(user_cache)},
+        "matchmaking": matchmaker.stats()
     }
@@ -0,0 +1,349 @@
+"""admin_mirror.py - queued, digesting, rate-limited mirror to the admin group"""
+import asyncio
+import logging
+import os
+import time
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime
+from telegram import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from db import db, get_user
+from outbound import dispatcher, ADMIN
+
+logger = logging.getLogger(__name__)
+
+MIRROR_MODE = os.getenv("ADMIN_MIRROR_MODE", "all")  # all | flagged | off
+SAMPLE_RATE = float(os.getenv("ADMIN_MIRROR_SAMPLE_RATE", "1.0"))
+DIGEST_INTERVAL = float(os.getenv("ADMIN_MIRROR_DIGEST_INTERVAL", "5.0"))
+MAX_PENDING = int(os.getenv("ADMIN_MIRROR_MAX_PENDING", "5000"))
+TEXT_LIMIT = 4096
+CONTINUED = " (cont.)"
+CAPTION_LIMIT = 1024
+ALBUM_LIMIT = 10
+# Chat/user pairs whose posted profile photos are remembered.
+PHOTO_MEMORY = int(os.getenv("ADMIN_PHOTO_MEMORY", "50000"))
+ALBUM_KINDS = {
+    "photo": ("visual", InputMediaPhoto),
+    "video": ("visual", InputMediaVideo),
+    "document": ("document", InputMediaDocument),
+    "audio": ("audio", InputMediaAudio),
+}
+
+class _RoomBatch:
+    __slots__ = ("room_id", "created_at", "users", "lines", "media", "extras")
+
+    def __init__(self, room_id, created_at):
+        self.room_id = room_id
+        self.created_at = created_at
+        self.users = {}
+        self.lines = []
+        self.media = []
+        self.extras = []
+
+class AdminMirror:
+    def __init__(self, mode=MIRROR_MODE, sample_rate=SAMPLE_RATE, digest_interval=DIGEST_INTERVAL,
+                 max_pending=MAX_PENDING):
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.digest_interval = digest_interval
+        self.max_pending = max_pending
+        self.flagged_rooms = set()
+        self._pending = OrderedDict()
+        self._size = 0
+        self._bot = None
+        self._chat_id = None
+        self._task = None
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self.stats = {"submitted": 0, "skipped": 0, "dropped": 0, "sent_calls": 0, "errors": 0}
+
+    def __len__(self):
+        return self._size
+
+    def flag_room(self, room_id):
+        self.flagged_rooms.add(room_id)
+
+    def unflag_room(self, room_id):
+        self.flagged_rooms.discard(room_id)
+
+    def wants(self, room_id):
+        if self.mode == "off":
+            return False
+        if room_id in self.flagged_rooms:
+            return True
+        if self.mode == "flagged":
+            return False
+        if self.sample_rate >= 1.0:
+            return True
+        # Sample whole rooms rather than single messages so mirrored rooms
+        # stay readable.
+        return zlib.crc32(str(room_id).encode()) % 10000 < self.sample_rate * 10000
+
+    def submit(self, event):
+        # Never awaits: the relay handler only pays for a dict append.
+        room_id = event["room_id"]
+        if not self.wants(room_id):
+            self.stats["skipped"] += 1
+            return False
+        if self._size >= self.max_pending:
+            self._drop_oldest()
+        batch = self._pending.get(room_id)
+        if batch is None:
+            batch = self._pending[room_id] = _RoomBatch(room_id, event.get("room_created"))
+        batch.users[event["sender_id"]] = event.get("sender_username") or "none"
+        if event.get("receiver_id"):
+            batch.users.setdefault(event["receiver_id"], None)
+        stamp = datetime.utcfromtimestamp(event.get("timestamp", time.time())).strftime("%H:%M:%S")
+        prefix = f"[{stamp}] {event['sender_id']}"
+        kind = event["kind"]
+        if kind == "text":
+            batch.lines.append(f"{prefix}: {event['text']}")
+        elif kind in ALBUM_KINDS:
+            batch.media.append(event)
+            batch.lines.append(f"{prefix}: [{kind.capitalize()}]{' ' + event['text'] if event.get('text') else ''}")
+        else:
+            batch.extras.append(event)
+            batch.lines.append(f"{prefix}: [{event.get('label', kind)}]")
+        self._size += 1
+        self.stats["submitted"] += 1
+        return True
+
+    def _drop_oldest(self):
+        room_id, batch = next(iter(self._pending.items()))
+        dropped = len(batch.lines)
+        del self._pending[room_id]
+        self._size -= dropped
+        self.stats["dropped"] += dropped
+
+    async def start(self, bot, chat_id):
+        self._bot = bot
+        self._chat_id = chat_id
+        if self._task is None and chat_id and self.mode != "off":
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, drain=True):
+        # drain=False drops what is still queued, including a flush that is
+        # waiting on the group's flood budget; returns how many were dropped.
+        dropped = 0
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            if not drain:
+                dropped = self._size
+                self._pending, self._size = OrderedDict(), 0
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if not drain:
+            dropped += self._size
+            self._pending, self._size = OrderedDict(), 0
+        elif self._pending and self._bot and self._chat_id:
+            await self.flush()
+        return dropped
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.digest_interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                break
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Admin mirror flush failed")
+
+    async def flush(self):
+        pending, self._pending, self._size = self._pending, OrderedDict(), 0
+        for batch in pending.values():
+            await self._send_batch(batch)
+
+    async def _send_batch(self, batch):
+        header = await self._header(batch)
+        for text in self._digest_chunks(header, batch.lines):
+            await self._call(self._bot.send_message, chat_id=self._chat_id, text=text)
+        groups = {}
+        for event in batch.media:
+            groups.setdefault(ALBUM_KINDS[event["kind"]][0], []).append(event)
+        for events in groups.values():
+            for i in range(0, len(events), ALBUM_LIMIT):
+                await self._send_album(header, events[i:i + ALBUM_LIMIT])
+        for event in batch.extras:
+            await self._send_extra(header, event)
+
+    async def _header(self, batch):
+        parts = []
+        for uid, username in batch.users.items():
+            if username is None:
+                user = await get_user(uid)
+                username = user.get("username", "") if user else ""
+            parts.append(f"{uid} (@{username})")
+        created = batch.created_at if batch.created_at is not None else "N/A"
+        return f"📢 Room #{batch.room_id}\n👥 {' ↔ '.join(parts)}\nRoom Created: {created}"
+
+    @staticmethod
+    def _digest_chunks(header, lines):
+        # A line always fits after a continuation header: the header,
+        # CONTINUED and the two newlines around the line.
+        chunk = header + "\n"
+        for line in lines:
+            line = line[:TEXT_LIMIT - len(header) - len(CONTINUED) - 2]
+            if len(chunk) + len(line) + 1 > TEXT_LIMIT:
+                yield chunk
+                chunk = header + CONTINUED + "\n"
+            chunk += "\n" + line
+        yield chunk
+
+    async def _send_album(self, header, events):
+        caption = f"{header}\n[{len(events)} media]"[:CAPTION_LIMIT]
+        if len(events) == 1:
+            event = events[0]
+            send = getattr(self._bot, f"send_{event['kind']}")
+            await self._call(send, chat_id=self._chat_id, caption=caption, **{event["kind"]: event["file_id"]})
+            return
+        media = []
+        for i, event in enumerate(events):
+            cls = ALBUM_KINDS[event["kind"]][1]
+            media.append(cls(event["file_id"], caption=caption if i == 0 else None))
+        await self._call(self._bot.send_media_group, chat_id=self._chat_id, media=media)
+
+    async def _send_extra(self, header, event):
+        kind = event["kind"]
+        if kind == "forward":
+            await self._call(self._bot.forward_message, chat_id=self._chat_id,
+                             from_chat_id=event["from_chat_id"], message_id=event["message_id"])
+        elif kind == "voice":
+            await self._call(self._bot.send_voice, chat_id=self._chat_id, voice=event["file_id"],
+                             caption=f"{header}\n[Voice message]"[:CAPTION_LIMIT])
+        else:
+            # Stickers and video notes take no caption; the digest above
+            # already carries the context line.
+            send = getattr(self._bot, f"send_{kind}")
+            await self._call(send, chat_id=self._chat_id, **{kind: event["file_id"]})
+
+    async def _call(self, method, **kwargs):
+        # The dispatcher paces the group, retries RetryAfter and keeps admin
+        # traffic behind user-facing sends.
+        try:
+            self.stats["sent_calls"] += 1
+            return await dispatcher.send(ADMIN, method, **kwargs)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning("Admin mirror send failed: %s", e)
+            return None
+
+mirror = AdminMirror()
+
+def photo_entries(user):
+    # (file_id, file_unique_id) per profile photo. Profiles saved before
+    # unique ids were stored hold bare file_id strings; those key on the
+    # file_id, which is stable for this bot.
+    for entry in (user or {}).get("profile_photos", []):
+        if isinstance(entry, dict):
+            yield entry["file_id"], entry.get("file_unique_id") or entry["file_id"]
+        else:
+            yield entry, entry
+
+def message_link(chat_id, message_id):
+    # t.me/c links only resolve for supergroups and channels (-100...).
+    text = str(chat_id)
+    if message_id is None or not text.startswith("-100"):
+        return None
+    return f"https://t.me/c/{text[4:]}/{message_id}"
+
+class _Shown:
+    __slots__ = ("unique_ids", "message_id")
+
+    def __init__(self):
+        self.unique_ids = set()
+        self.message_id = None
+
+class ProfilePhotoMirror:
+    # Posts profile photos to admin chats as albums and remembers, per chat
+    # and user, which photos (by file_unique_id) were already posted there.
+    # Repeats become a one-line reference to the earlier album instead of a
+    # re-upload. Kept in memory; after a restart each user's photos are
+    # posted once more.
+    def __init__(self, max_users=PHOTO_MEMORY):
+        self.max_users = max_users
+        self._shown = OrderedDict()
+        self.stats = {"posted": 0, "referenced": 0, "albums": 0}
+
+    def _entry(self, chat_id, user_id):
+        key = (chat_id, user_id)
+        shown = self._shown.get(key)
+        if shown is None:
+            shown = self._shown[key] = _Shown()
+            if len(self._shown) > self.max_users:
+                self._shown.popitem(last=False)
+        else:
+            self._shown.move_to_end(key)
+        return shown
+
+    def prepare(self, chat_id, users):
+        # Returns (notes, album): a reference line per user with photos
+        # already in the chat, and the (user_id, file_id, unique_id) triples
+        # still to post. Marked as shown now, so concurrent matches of the
+        # same user don't both post them; post() undoes that on failure.
+        notes, album = [], []
+        for user in users:
+            if not user:
+                continue
+            shown = self._entry(chat_id, user["user_id"])
+            seen = 0
+            for file_id, unique_id in photo_entries(user):
+                if unique_id in shown.unique_ids:
+                    seen += 1
+                else:
+                    shown.unique_ids.add(unique_id)
+                    album.append((user["user_id"], file_id, unique_id))
+            if seen:
+                link = message_link(chat_id, shown.message_id)
+                notes.append(f"📷 {user['user_id']}: {seen} photo(s) posted earlier" + (f" {link}" if link else ""))
+                self.stats["referenced"] += seen
+        return notes, album
+
+    def post(self, bot, chat_id, album):
+        # Queues the album (one send_media_group per ALBUM_LIMIT photos,
+        # send_photo for a single one) behind user traffic.
+        for start in range(0, len(album), ALBUM_LIMIT):
+            chunk = album[start:start + ALBUM_LIMIT]
+            caption = "Profile photos: " + ", ".join(dict.fromkeys(str(uid) for uid, _, _ in chunk))
+            if len(chunk) == 1:
+                future = dispatcher.post(ADMIN, bot.send_photo, chat_id=chat_id, photo=chunk[0][1], caption=caption)
+            else:
+                media = [InputMediaPhoto(file_id, caption=caption if i == 0 else None)
+                         for i, (_, file_id, _) in enumerate(chunk)]
+                future = dispatcher.post(ADMIN, bot.send_media_group, chat_id=chat_id, media=media)
+            future.add_done_callback(lambda f, chunk=chunk: self._posted(chat_id, chunk, f))
+            self.stats["albums"] += 1
+            self.stats["posted"] += len(chunk)
+
+    def _posted(self, chat_id, chunk, future):
+        failed = future.cancelled() or future.exception() is not None
+        messages = None if failed else future.result()
+        if messages is not None and not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        linked = set()
+        for i, (user_id, _, unique_id) in enumerate(chunk):
+            shown = self._shown.get((chat_id, user_id))
+            if shown is None:
+                continue
+            if failed:
+                shown.unique_ids.discard(unique_id)
+            elif user_id not in linked and i < len(messages):
+                # References point at the user's latest album.
+                shown.message_id = messages[i].message_id
+                linked.add(user_id)
+
+profile_photos = ProfilePhotoMirror()
+
+async def load_flagged_rooms():
+    for room_id in await db.reports.distinct("room_id", {"reviewed": False}):
+        mirror.flag_room(room_id)
+    return len(mirror.flagged_rooms)
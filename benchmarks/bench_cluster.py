@@ -0,0 +1,73 @@
+"""bench_cluster.py - throughput scaling of the sharded worker mode
+
+Drives cluster.Front with a synthetic worker that does a fixed amount of
+CPU work per update (JSON round trip plus a blocked-word scan), and
+reports updates/s for 1..N shards.
+
+Run from the repo root: python -m benchmarks.bench_cluster [updates] [max_shards]
+"""
+import json
+import os
+import random
+import string
+import sys
+import time
+
+from cluster import Front
+
+def _text(rng, words=40):
+    return " ".join("".join(rng.choice(string.ascii_lowercase) for _ in range(6)) for _ in range(words))
+
+class SyntheticRunner:
+    def __init__(self, index, shards, publish):
+        from moderation import BlockedWordMatcher
+        rng = random.Random(index)
+        self.publish = publish
+        self.matcher = BlockedWordMatcher(_text(rng, 5000).split())
+        self.processed = 0
+
+    async def start(self):
+        self.publish(None, {"op": "ready"})
+
+    async def process(self, data):
+        update = json.loads(json.dumps(data))
+        for _ in range(3):
+            self.matcher.find(update["message"]["text"])
+        self.processed += 1
+
+    def control(self, event):
+        pass
+
+    async def stop(self):
+        self.publish(None, {"op": "done", "processed": self.processed})
+
+def run(updates, shards):
+    rng = random.Random(1)
+    payloads = [
+        {"update_id": i, "message": {"message_id": i, "from": {"id": rng.randint(1, 10**6)}, "text": _text(rng, 30)}}
+        for i in range(updates)
+    ]
+    front = Front(shards, "benchmarks.bench_cluster:SyntheticRunner")
+    front.start()
+    for _ in range(shards):
+        front.events.get()
+    t0 = time.perf_counter()
+    for payload in payloads:
+        front.dispatch(payload["message"]["from"]["id"], payload)
+    front.stop()
+    elapsed = time.perf_counter() - t0
+    processed = 0
+    while not front.events.empty():
+        processed += front.events.get().get("processed", 0)
+    return updates / elapsed, processed
+
+if __name__ == "__main__":
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    max_shards = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    base = None
+    shards = 1
+    while shards <= max_shards:
+        rate, processed = run(updates, shards)
+        base = base or rate
+        print(f"shards={shards:>2}  {rate:8.0f} updates/s  speedup={rate / base:4.2f}x  processed={processed}")
+        shards *= 2
@@ -0,0 +1,60 @@
+"""bench_lifecycle.py - cost of an idle-expiry tick, timer wheel vs full scan
+
+Run from the repo root: python -m benchmarks.bench_lifecycle [rooms...]
+
+Simulated time: every room is touched on average once a minute, ticks are
+5 s apart and rooms go idle after 30 minutes, with 1% of rooms going
+silent at the start. For each room count, times lifecycle.TimerWheel's
+touch and advance against scanning a last-seen dict every tick.
+"""
+import random
+import sys
+import time
+
+from lifecycle import TimerWheel
+
+TICK = 5
+TIMEOUT = 1800
+TOUCH_EVERY = 60
+TICKS = 720
+
+def run(rooms):
+    rng = random.Random(1)
+    now = 0.0
+    wheel = TimerWheel(TICK, TIMEOUT, now=now)
+    last_seen = {}
+    for room in range(rooms):
+        wheel.schedule(room, now + TIMEOUT)
+        last_seen[room] = now
+    silent = set(rng.sample(range(rooms), rooms // 100))
+    touches_per_tick = rooms * TICK // TOUCH_EVERY
+    wheel_touch = wheel_tick = scan_tick = 0.0
+    wheel_expired = scan_expired = 0
+    for _ in range(TICKS):
+        now += TICK
+        touched = [room for room in rng.choices(range(rooms), k=touches_per_tick) if room not in silent]
+        started = time.perf_counter()
+        for room in touched:
+            wheel.touch(room, now + TIMEOUT)
+        wheel_touch += time.perf_counter() - started
+        for room in touched:
+            if room in last_seen:
+                last_seen[room] = now
+
+        started = time.perf_counter()
+        wheel_expired += len(wheel.advance(now))
+        wheel_tick += time.perf_counter() - started
+
+        started = time.perf_counter()
+        expired = [room for room, seen in last_seen.items() if seen + TIMEOUT <= now]
+        for room in expired:
+            del last_seen[room]
+        scan_tick += time.perf_counter() - started
+        scan_expired += len(expired)
+    print(f"{rooms:>9} rooms  wheel tick {wheel_tick / TICKS * 1e3:8.3f} ms  "
+          f"(touch {wheel_touch / (TICKS * touches_per_tick) * 1e9:5.0f} ns)  "
+          f"scan tick {scan_tick / TICKS * 1e3:8.3f} ms  expired {wheel_expired}/{scan_expired}")
+
+if __name__ == "__main__":
+    for rooms in [int(n) for n in sys.argv[1:]] or [10_000, 100_000, 500_000]:
+        run(rooms)
@@ -0,0 +1,63 @@
+"""bench_matchmaker.py - batch matchmaker throughput and wait-time fairness
+
+Run from the repo root: python -m benchmarks.bench_matchmaker [arrivals_per_second...]
+
+Simulates users arriving at a fixed rate for 60 simulated seconds, with a
+tick every 0.5s. A share of users filter on gender/language; every pair is
+checked against both sides' filters.
+"""
+import random
+import sys
+import time
+
+from rooms import MatchPool, POOL_FIELDS
+from matchmaker import Matchmaker
+from benchmarks.bench_pool import random_user, GENDERS, LANGUAGES
+
+TICK = 0.5
+DURATION = 60
+
+def random_prefs(rng):
+    prefs = {}
+    if rng.random() < 0.3:
+        prefs["gender"] = rng.choice(GENDERS)
+    if rng.random() < 0.2:
+        prefs["language"] = rng.choice(LANGUAGES)
+    return prefs
+
+def _ok(prefs, user):
+    return all(user.get(field) == value for field, value in prefs.items())
+
+def run(rate, seed=1):
+    rng = random.Random(seed)
+    pool = MatchPool()
+    engine = Matchmaker(pool)
+    profiles = {}
+    next_uid = 0
+    matched = 0
+    tick_seconds = 0.0
+    clock = 0.0
+    while clock < DURATION:
+        for _ in range(int(rate * TICK)):
+            user, prefs = random_user(rng), random_prefs(rng)
+            profiles[next_uid] = (user, prefs)
+            pool.add(next_uid, user, prefs, since=clock + rng.random() * TICK)
+            next_uid += 1
+        clock += TICK
+        t0 = time.perf_counter()
+        pairs = engine.tick(now=clock)
+        tick_seconds += time.perf_counter() - t0
+        for a, b in pairs:
+            (ua, pa), (ub, pb) = profiles.pop(a), profiles.pop(b)
+            assert _ok(pa, ub) and _ok(pb, ua), "pair violates a filter"
+        matched += 2 * len(pairs)
+    stats = engine.stats(now=clock)
+    print(f"arrivals={rate:>6}/s  matches/s(cpu)={matched / 2 / tick_seconds:9.0f}  "
+          f"tick_avg={tick_seconds / engine.totals['ticks'] * 1e3:6.2f}ms  matched={matched / next_uid:.1%}  "
+          f"wait_p50={stats['wait_p50']:.2f}s  wait_p95={stats['wait_p95']:.2f}s  "
+          f"still_waiting={len(pool)}  classes={len(pool.classes)}")
+
+if __name__ == "__main__":
+    rates = [int(r) for r in sys.argv[1:]] or [1_000, 5_000]
+    for rate in rates:
+        run(rate)
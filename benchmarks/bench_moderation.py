@@ -0,0 +1,41 @@
+"""bench_moderation.py - blocked-word matcher build and per-message cost
+
+Run from the repo root: python -m benchmarks.bench_moderation [terms...]
+"""
+import random
+import string
+import sys
+import time
+
+from moderation import BlockedWordMatcher
+
+def random_word(rng, lo=4, hi=10):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(lo, hi)))
+
+def run(terms, messages=2000, seed=1):
+    rng = random.Random(seed)
+    words = [random_word(rng) for _ in range(terms)]
+    texts = [" ".join(random_word(rng, 2, 8) for _ in range(rng.randint(3, 30))) for _ in range(messages)]
+
+    t0 = time.perf_counter()
+    matcher = BlockedWordMatcher(words)
+    build_ms = (time.perf_counter() - t0) * 1000
+
+    t0 = time.perf_counter()
+    hits = sum(1 for text in texts if matcher.find(text))
+    per_msg_us = (time.perf_counter() - t0) / messages * 1e6
+
+    sample = texts[:200]
+    t0 = time.perf_counter()
+    for text in sample:
+        lowered = text.lower()
+        any(word.lower() in lowered for word in words)
+    naive_us = (time.perf_counter() - t0) / len(sample) * 1e6
+
+    print(f"terms={terms:>6}  build={build_ms:8.1f}ms  find={per_msg_us:7.1f}us/msg  "
+          f"naive_loop={naive_us:9.1f}us/msg  hit_rate={hits / messages:.1%}")
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or [1_000, 10_000, 50_000]
+    for size in sizes:
+        run(size)
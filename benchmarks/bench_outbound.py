@@ -0,0 +1,105 @@
+"""bench_outbound.py - relay latency under an admin burst, direct vs dispatcher
+
+Run from the repo root: python -m benchmarks.bench_outbound [seconds] [chats] [rate]
+
+A fake Bot enforces Telegram-like flood limits (about 30 sends a second
+overall, one a second per private chat, 20 a minute per group) and raises
+RetryAfter past them. User chats relay `rate` messages a second between
+them while an admin burst of 150 messages lands on one group. "direct"
+awaits the Bot as the handlers used to; "dispatcher" goes through
+outbound.Dispatcher.
+"""
+import asyncio
+import random
+import sys
+import time
+from collections import Counter
+
+from telegram.error import RetryAfter
+
+from outbound import ADMIN, RELAY, Dispatcher, TokenBucket
+
+ADMIN_CHAT = -100
+ADMIN_BURST = 150
+
+class FloodBot:
+    def __init__(self, latency=0.04):
+        self.latency = latency
+        self.global_bucket = TokenBucket(30, 30)
+        self.buckets = {}
+        self.retry_after = Counter()
+        self.delivered = {}
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.latency)
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(20 / 60, 20) if chat_id < 0 else TokenBucket(1, 3)
+        # Going over a limit closes it for the whole retry window, as
+        # Telegram does.
+        for limit in (self.global_bucket, bucket):
+            if not limit.try_acquire():
+                self.retry_after["user" if chat_id > 0 else "admin"] += 1
+                if limit.tokens >= 0:
+                    limit.pause(max(1, int(limit.wait_time()) + 1))
+                raise RetryAfter(int(limit.wait_time()) + 1)
+        self.delivered.setdefault(chat_id, []).append(text)
+
+def _pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+async def run(mode, seconds, chats, rate):
+    bot = FloodBot()
+    dispatcher = Dispatcher()
+    if mode == "dispatcher":
+        await dispatcher.start()
+    rng = random.Random(1)
+    latencies, failed = [], Counter()
+
+    async def send(priority, chat_id, text):
+        try:
+            # Not started, the dispatcher calls the Bot straight away.
+            await dispatcher.send(priority, bot.send_message, chat_id=chat_id, text=text)
+            return True
+        except RetryAfter:
+            failed["user" if chat_id > 0 else "admin"] += 1
+            return False
+
+    async def user(chat_id):
+        seq = 0
+        deadline = time.monotonic() + seconds
+        await asyncio.sleep(rng.uniform(0, min(seconds, chats / rate)))
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            if await send(RELAY, chat_id, str(seq)):
+                latencies.append(time.monotonic() - started)
+            seq += 1
+            await asyncio.sleep(min(rng.expovariate(rate / chats), max(0, deadline - time.monotonic())))
+
+    async def admin_burst():
+        await asyncio.sleep(1)
+        await asyncio.gather(*(send(ADMIN, ADMIN_CHAT, str(i)) for i in range(ADMIN_BURST)),
+                             return_exceptions=True)
+
+    burst = asyncio.create_task(admin_burst())
+    await asyncio.gather(*(user(chat_id) for chat_id in range(1, chats + 1)))
+    burst.cancel()
+    await dispatcher.stop(drain=False)
+    out_of_order = sum(1 for chat_id, texts in bot.delivered.items()
+                       if chat_id > 0 and texts != sorted(texts, key=int))
+    print(f"{mode:<11} relays {len(latencies):5d}  p50 {_pct(latencies, .5) * 1e3:6.0f}ms  "
+          f"p95 {_pct(latencies, .95) * 1e3:6.0f}ms  "
+          f"RetryAfter user/admin {bot.retry_after['user']}/{bot.retry_after['admin']}  "
+          f"failed user/admin {failed['user']}/{failed['admin']}  "
+          f"admin delivered {len(bot.delivered.get(ADMIN_CHAT, []))}  out-of-order chats {out_of_order}")
+
+async def main(seconds, chats, rate):
+    for mode in ("direct", "dispatcher"):
+        await run(mode, seconds, chats, rate)
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rate = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    asyncio.run(main(seconds, chats, rate))
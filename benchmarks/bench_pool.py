@@ -0,0 +1,54 @@
+"""bench_pool.py - waiting pool add/discard cost for large pools
+
+Run from the repo root: python -m benchmarks.bench_pool [sizes...]
+"""
+import random
+import sys
+import time
+
+from rooms import MatchPool
+
+GENDERS = ['male', 'female', 'other']
+REGIONS = ['Africa', 'Europe', 'Asia', 'North America', 'South America', 'Oceania', 'Antarctica']
+COUNTRIES = ['Indonesia', 'Malaysia', 'India', 'Russia', 'Arab', 'USA', 'Iran', 'Nigeria', 'Brazil', 'Turkey']
+LANGUAGES = ['en', 'ar', 'hi', 'id']
+
+def random_user(rng):
+    return {
+        "gender": rng.choice(GENDERS),
+        "region": rng.choice(REGIONS),
+        "country": rng.choice(COUNTRIES),
+        "language": rng.choice(LANGUAGES),
+    }
+
+def run(size, churn=20_000, seed=1):
+    rng = random.Random(seed)
+    pool = MatchPool()
+    users = [random_user(rng) for _ in range(size)]
+
+    t0 = time.perf_counter()
+    for uid, user in enumerate(users):
+        pool.add(uid, user)
+    add_us = (time.perf_counter() - t0) / size * 1e6
+
+    # Join/leave churn at a steady pool size: one user leaves, one arrives.
+    t0 = time.perf_counter()
+    next_uid = size
+    for _ in range(churn):
+        pool.discard(rng.randrange(next_uid - size, next_uid))
+        pool.add(next_uid, random_user(rng))
+        next_uid += 1
+    cycle_us = (time.perf_counter() - t0) / churn * 1e6
+
+    t0 = time.perf_counter()
+    for uid in list(pool):
+        pool.discard(uid)
+    discard_us = (time.perf_counter() - t0) / size * 1e6
+
+    print(f"pool={size:>7}  add={add_us:6.2f}us  churn_cycle={cycle_us:6.2f}us  "
+          f"discard={discard_us:6.2f}us  classes_left={len(pool.classes)}")
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or [10_000, 50_000, 100_000]
+    for size in sizes:
+        run(size)
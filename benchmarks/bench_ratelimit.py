@@ -0,0 +1,40 @@
+"""bench_ratelimit.py - rate limiter check cost and memory over many users
+
+Run from the repo root: python -m benchmarks.bench_ratelimit [distinct_users...]
+
+Users arrive at a steady rate with a simulated clock; once the first users
+go idle past the refill window their slots are reused, so resident memory
+stops growing no matter how many distinct users pass through.
+"""
+import sys
+import time
+import tracemalloc
+
+from ratelimit import RateLimiter
+
+def run(distinct, per_second=5000, messages_per_user=4):
+    limiter = RateLimiter(max_entries=1_000_000)
+    tracemalloc.start()
+    clock = 0.0
+    checks = 0
+    limited = 0
+    peak_entries = 0
+    t0 = time.perf_counter()
+    for uid in range(distinct):
+        clock += 1 / per_second
+        for _ in range(messages_per_user):
+            if not limiter.tables["text"].allow(uid, now=clock):
+                limited += 1
+            checks += 1
+        if uid % 10_000 == 0:
+            peak_entries = max(peak_entries, len(limiter.tables["text"]))
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"users={distinct:>9}  check={elapsed / checks * 1e6:5.2f}us  live_entries<={peak_entries:>7}  "
+          f"peak_mem={peak / 1e6:6.1f}MB  limited={limited}")
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or [100_000, 1_000_000, 3_000_000]
+    for size in sizes:
+        run(size)
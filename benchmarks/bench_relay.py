@@ -0,0 +1,84 @@
+"""bench_relay.py - partner lookup cost on the relay path
+
+Models one relayed message: resolve the partner (and, for the admin mirror,
+the room and receiver), then copy the message. Mongo and Bot API latencies
+are simulated with lognormal delays so the before/after shapes are
+comparable without a live cluster.
+
+Run from the repo root: python -m benchmarks.bench_relay [messages]
+"""
+import asyncio
+import random
+import statistics
+import sys
+import time
+
+from rooms import RoomDirectory
+
+MONGO_MEDIAN_MS = 2.0
+BOT_MEDIAN_MS = 40.0
+
+def _delay(rng, median_ms, sigma=0.6):
+    return rng.lognormvariate(0, sigma) * median_ms / 1000
+
+async def legacy_relay(rng, rooms, user_room_map, user_id):
+    room_id = user_room_map[user_id]
+    await asyncio.sleep(_delay(rng, MONGO_MEDIAN_MS))          # get_room in route_message
+    room = rooms[room_id]
+    other_id = [uid for uid in room["users"] if uid != user_id][0]
+    await asyncio.sleep(_delay(rng, BOT_MEDIAN_MS))            # message.copy
+    await asyncio.sleep(_delay(rng, MONGO_MEDIAN_MS))          # get_room in forward_to_admin
+    await asyncio.sleep(_delay(rng, MONGO_MEDIAN_MS))          # get_user(receiver)
+    return other_id
+
+async def directory_relay(rng, directory, user_id):
+    other_id = directory.partner_of(user_id)
+    await asyncio.sleep(_delay(rng, BOT_MEDIAN_MS))            # message.copy
+    directory.get(directory.room_of(user_id))
+    return other_id
+
+def _pct(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+async def run(messages, concurrency=200, pairs=25_000, seed=1):
+    rng = random.Random(seed)
+    directory = RoomDirectory()
+    rooms, user_room_map = {}, {}
+    for i in range(pairs):
+        room_id = f"r{i}"
+        users = (2 * i + 1, 2 * i + 2)
+        rooms[room_id] = {"room_id": room_id, "users": list(users), "created_at": 0}
+        user_room_map.update({u: room_id for u in users})
+        directory.bind(room_id, users, 0)
+    senders = [rng.randint(1, 2 * pairs) for _ in range(messages)]
+
+    async def measure(fn):
+        samples = []
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(uid):
+            async with sem:
+                t0 = time.perf_counter()
+                await fn(uid)
+                samples.append(time.perf_counter() - t0)
+        await asyncio.gather(*(one(uid) for uid in senders))
+        return samples
+
+    t0 = time.perf_counter()
+    partner_lookups = [directory.partner_of(uid) for uid in senders]
+    lookup_us = (time.perf_counter() - t0) / messages * 1e6
+    assert all(partner_lookups)
+
+    for name, fn in (
+        ("mongo lookups", lambda uid: legacy_relay(rng, rooms, user_room_map, uid)),
+        ("room directory", lambda uid: directory_relay(rng, directory, uid)),
+    ):
+        samples = await measure(fn)
+        print(f"{name:>15}: p50={_pct(samples, 0.5):7.2f}ms  p99={_pct(samples, 0.99):7.2f}ms  "
+              f"mean={statistics.mean(samples) * 1000:7.2f}ms")
+    print(f"in-memory partner lookup: {lookup_us:.3f}us")
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    asyncio.run(run(messages))
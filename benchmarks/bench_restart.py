@@ -0,0 +1,73 @@
+"""bench_restart.py - restart-to-ready time with many live rooms
+
+Seeds a scratch database with active rooms, per-user data, conversation
+states and waiting users, then times the startup restore path
+(room directory + persistence). Needs a reachable MongoDB and refuses to
+touch the production database name.
+
+Run from the repo root:
+    MONGODB_DB=anonindochat_bench python -m benchmarks.bench_restart [rooms]
+"""
+import asyncio
+import sys
+import time
+
+from bson import Binary
+from db import MONGODB_DB, db
+from persistence import MongoPersistence, _dump
+import rooms
+
+async def seed(room_count, waiting):
+    await db.rooms.delete_many({})
+    await db.persistence.delete_many({})
+    batch = []
+    for i in range(room_count):
+        users = [2 * i + 1, 2 * i + 2]
+        batch.append({"room_id": f"r{i:07d}", "users": users, "created_at": time.time(), "active": True})
+        if len(batch) == 5000:
+            await db.rooms.insert_many(batch)
+            batch = []
+    if batch:
+        await db.rooms.insert_many(batch)
+    docs = []
+    for uid in range(1, 2 * room_count + 1):
+        docs.append({"_id": f"user:{uid}", "kind": "user_data", "key": uid,
+                     "data": Binary(_dump({"search_filters": {"gender": "female"}}))})
+        if uid % 3 == 0:
+            docs.append({"_id": f"conv:search_conv:{uid}:{uid}", "kind": "conversation",
+                         "name": "search_conv", "key": [uid, uid], "state": Binary(_dump(0))})
+        if len(docs) >= 5000:
+            await db.persistence.insert_many(docs)
+            docs = []
+    for j in range(waiting):
+        uid = 10_000_000 + j
+        docs.append({"_id": f"waiting:{uid}", "kind": "waiting", "key": uid,
+                     "attrs": {"gender": "male", "region": "Asia", "country": "India", "language": "hi"}})
+    if docs:
+        await db.persistence.insert_many(docs)
+
+async def restore():
+    # The directory and pool are still empty in this process; other modules
+    # hold them by reference, so they are filled in place, never replaced.
+    persistence = MongoPersistence()
+    t0 = time.perf_counter()
+    loaded_rooms = await rooms.load_directory()
+    t_rooms = time.perf_counter()
+    user_data = await persistence.get_user_data()
+    await persistence.get_bot_data()
+    convs = await persistence.get_conversations("search_conv")
+    t_ptb = time.perf_counter()
+    waiting = await persistence.restore_pool()
+    t_end = time.perf_counter()
+    print(f"rooms={loaded_rooms} ({(t_rooms - t0) * 1000:.0f}ms)  "
+          f"user_data={len(user_data)} conversations={len(convs)} ({(t_ptb - t_rooms) * 1000:.0f}ms)  "
+          f"waiting={waiting} ({(t_end - t_ptb) * 1000:.0f}ms)  total={(t_end - t0) * 1000:.0f}ms")
+
+async def main(room_count):
+    if MONGODB_DB == "anonindochat":
+        sys.exit("Set MONGODB_DB to a scratch database; this benchmark wipes rooms and persistence.")
+    await seed(room_count, waiting=room_count // 10)
+    await restore()
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000))
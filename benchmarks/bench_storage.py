@@ -0,0 +1,71 @@
+"""bench_storage.py - cost of a write in the local backend vs a whole-file rewrite
+
+Run from the repo root: python -m benchmarks.bench_storage [users...]
+
+For each data set size, times single-user updates through
+storage.JournalDatabase (one appended line, fsynced each time here)
+against what the old JSON helpers did per save (the whole dict
+re-serialised with indent=2 and fsynced), then a compaction and a cold
+load of the result.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import storage
+
+UPDATES = 200
+
+def user_doc(uid):
+    return {"user_id": uid, "username": f"user{uid}", "language": "en", "gender": "male", "region": "Asia",
+            "country": "Indonesia", "is_premium": False, "premium_expiry": None, "blocked": False,
+            "matching_preferences": {}, "profile_photos": [], "created_at": "2026-01-01T00:00:00"}
+
+def rewrite_save(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+
+async def run(users, workdir):
+    db = storage.JournalDatabase(workdir / f"journal_{users}")
+    await db.users.create_index("user_id", unique=True)
+    await db.users.insert_many([user_doc(uid) for uid in range(users)])
+    db.flush()
+    started = time.perf_counter()
+    for i in range(UPDATES):
+        await db.users.update_one({"user_id": i % users}, {"$set": {"region": f"r{i}"}})
+        db.flush()
+    journal = (time.perf_counter() - started) / UPDATES
+
+    data = {str(uid): user_doc(uid) for uid in range(users)}
+    path = workdir / f"users_{users}.json"
+    rounds = max(3, min(UPDATES, 200_000 // users))
+    started = time.perf_counter()
+    for i in range(rounds):
+        data[str(i % users)]["region"] = f"r{i}"
+        rewrite_save(path, data)
+    rewrite = (time.perf_counter() - started) / rounds
+
+    started = time.perf_counter()
+    await db.compact()
+    compact = time.perf_counter() - started
+    db.close()
+    started = time.perf_counter()
+    loaded = storage.JournalDatabase(workdir / f"journal_{users}")
+    load = time.perf_counter() - started
+    loaded.close()
+    print(f"{users:>8} users  journal write {journal * 1e3:7.3f} ms  rewrite {rewrite * 1e3:9.2f} ms  "
+          f"compaction {compact:6.2f} s  load {load:6.2f} s ({loaded.stats['loaded']} docs)")
+
+async def main(sizes):
+    with tempfile.TemporaryDirectory() as tmp:
+        for users in sizes:
+            await run(users, Path(tmp))
+
+if __name__ == "__main__":
+    asyncio.run(main([int(n) for n in sys.argv[1:]] or [1_000, 10_000, 100_000]))
@@ -0,0 +1,99 @@
+"""fakes.py - in-memory stand-ins for Motor and the Telegram Bot
+
+MemoryDatabase is storage.MemoryDatabase (the engine behind the local
+backend) with injectable per-call latency; it counts every call. FakeBot
+records Bot API calls with configurable latency and error injection.
+
+Install before importing project modules, since they bind `db` at import:
+
+    from benchmarks import fakes
+    fakes.install_memory_db()
+"""
+import asyncio
+import itertools
+import random
+from collections import Counter
+from types import SimpleNamespace
+from telegram.error import NetworkError, RetryAfter
+import storage
+
+class MemoryDatabase(storage.MemoryDatabase):
+    # storage.MemoryDatabase with an optional per-call latency, so the
+    # harness can stand in for a remote Mongo.
+    def __init__(self, name="memory", latency=0.0, jitter=0.0, seed=None):
+        super().__init__(name)
+        self.latency = latency
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+
+    async def _op(self, collection, op):
+        self.calls[(collection, op)] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self.jitter * self._rng.random()))
+        else:
+            await asyncio.sleep(0)
+
+def install_memory_db(**kwargs):
+    # Swaps db.db for a MemoryDatabase; must run before other project
+    # modules are imported.
+    import db as db_module
+    memory = MemoryDatabase(**kwargs)
+    db_module.db = memory
+    return memory
+
+class FakeBot:
+    # Records every Bot API call as (method, kwargs). Latency is lognormal
+    # around `latency` seconds; `error_rate` of calls raise NetworkError and
+    # `flood_rate` raise RetryAfter. on_call(method, kwargs) lets a harness
+    # observe deliveries.
+    defaults = None
+    id = 1
+    username = "fake_bot"
+
+    def __init__(self, latency=0.0, error_rate=0.0, flood_rate=0.0, seed=None, on_call=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.on_call = on_call
+        self.calls = Counter()
+        self.errors = Counter()
+        self.log = None
+        self._rng = random.Random(seed)
+        self._message_ids = itertools.count(1)
+
+    def record(self):
+        # Keep a full call log (tests); off by default for long runs.
+        self.log = []
+        return self
+
+    async def _call(self, method, kwargs):
+        self.calls[method] += 1
+        if self.log is not None:
+            self.log.append((method, kwargs))
+        if self.latency:
+            await asyncio.sleep(self._rng.lognormvariate(0, 0.5) * self.latency)
+        roll = self._rng.random()
+        if roll < self.error_rate:
+            self.errors[method] += 1
+            raise NetworkError("fake network error")
+        if roll < self.error_rate + self.flood_rate:
+            self.errors[method] += 1
+            raise RetryAfter(1)
+        if self.on_call is not None:
+            self.on_call(method, kwargs)
+        if method == "send_media_group":
+            return [SimpleNamespace(message_id=next(self._message_ids)) for _ in kwargs.get("media", ())]
+        if method == "get_user_profile_photos":
+            return SimpleNamespace(photos=[], total_count=0)
+        return SimpleNamespace(message_id=next(self._message_ids))
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            if args:
+                kwargs = {"chat_id": args[0], **({"text": args[1]} if len(args) > 1 else {}), **kwargs}
+            return await self._call(method, kwargs)
+        call.__name__ = method
+        return call
@@ -0,0 +1,356 @@
+"""load_harness.py - offline load test of the real handlers
+
+Drives find_command, do_search, route_message (and through it
+forward_to_admin), and end_command for thousands of simulated users
+against benchmarks.fakes: an in-memory stand-in for the Mongo collections
+and a fake Bot with lognormal latency and injected errors. The chat log
+pipeline, admin mirror, matchmaker and lifecycle run as they do in the bot.
+
+Reports messages/s, match latency percentiles (find/search -> "Match
+found" delivered), handler latency, DB calls per update and Bot API calls.
+Results are written to benchmarks/results/load_<commit>.json and compared
+with the most recently saved result.
+
+Run from the repo root: python -m benchmarks.load_harness --users 2000 --duration 30
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks import fakes
+
+memory_db = fakes.install_memory_db()
+
+from telegram import Update
+import chatlog
+import moderation
+from admin_mirror import mirror, profile_photos
+from db import insert_blocked_word
+from handlers.match import find_command, end_command, do_search, start_match, GENDERS, LANGUAGES, REGIONS, COUNTRIES
+from handlers.message_router import route_message
+from indexes import ensure_indexes
+from lifecycle import lifecycle
+from matchmaker import matchmaker
+from outbound import dispatcher, TokenBucket
+from rooms import room_of
+
+RESULTS_DIR = Path(__file__).parent / "results"
+ADMIN_GROUP_ID = -1000000000001
+MATCH_TEXT = "🎉 Match found"
+BLOCKED_WORDS = ["badword", "spamlink", "scamcoin"]
+WORDS = "hi hello how are you where from nice cool lol ok yes no maybe music movie food travel".split()
+
+def _pct(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.bot = fakes.FakeBot(latency=args.bot_latency, error_rate=args.bot_error_rate,
+                                 seed=args.seed, on_call=self._observe)
+        self.bot_data = {"ADMIN_GROUP_ID": ADMIN_GROUP_ID, "ADMIN_ID": 1, "SHARD": 0}
+        self.user_data = {}
+        self.profiles = {}
+        self.match_waiters = {}
+        self.update_ids = itertools.count(1)
+        self.stopping = False
+        self.counts = Counter()
+        self.match_latency = []
+        self.handler_latency = []
+
+    # -- fixtures -------------------------------------------------------------
+    async def seed(self):
+        rng = self.rng
+        docs = []
+        for i in range(self.args.users):
+            uid = 10_000 + i
+            doc = {
+                "user_id": uid,
+                "username": f"user{uid}",
+                "language": rng.choice(LANGUAGES),
+                "gender": rng.choice(GENDERS),
+                "region": rng.choice(REGIONS),
+                "country": rng.choice(COUNTRIES),
+                "is_premium": rng.random() < self.args.premium_share,
+                "premium_expiry": None,
+                "blocked": False,
+                "matching_preferences": {},
+                "profile_photos": [{"file_id": f"pp{uid}_{n}", "file_unique_id": f"ppu{uid}_{n}"}
+                                   for n in range(rng.randint(0, 3))],
+            }
+            docs.append(doc)
+            self.profiles[uid] = doc
+        await memory_db.users.insert_many(docs)
+        for word in BLOCKED_WORDS:
+            await insert_blocked_word(word)
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"user{uid}"}
+
+    def _message(self, uid, **fields):
+        return {
+            "message_id": next(self.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": self._user(uid),
+            **fields,
+        }
+
+    def message_update(self, uid, **fields):
+        return Update.de_json({"update_id": next(self.update_ids), "message": self._message(uid, **fields)}, self.bot)
+
+    def command_update(self, uid, command):
+        return self.message_update(uid, text=command,
+                                   entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+
+    def callback_update(self, uid, data):
+        return Update.de_json({
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.update_ids)),
+                "from": self._user(uid),
+                "chat_instance": str(uid),
+                "data": data,
+                "message": self._message(uid, text="Choose your search filters:"),
+            },
+        }, self.bot)
+
+    def context(self, uid):
+        return SimpleNamespace(bot=self.bot, bot_data=self.bot_data, chat_data={}, args=[],
+                               user_data=self.user_data.setdefault(uid, {}))
+
+    # -- observation ----------------------------------------------------------
+    def _observe(self, method, kwargs):
+        if method == "send_message" and str(kwargs.get("text", "")).startswith(MATCH_TEXT):
+            waiter = self.match_waiters.pop(kwargs.get("chat_id"), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+
+    async def handle(self, handler, update, uid):
+        self.counts["updates"] += 1
+        # What the bot's group -1 TypeHandler does for every update.
+        lifecycle.seen(uid)
+        started = time.perf_counter()
+        try:
+            return await handler(update, self.context(uid))
+        except Exception as e:
+            self.counts["handler_errors"] += 1
+            self.counts[f"error:{type(e).__name__}"] += 1
+        finally:
+            self.handler_latency.append(time.perf_counter() - started)
+
+    # -- behaviour ------------------------------------------------------------
+    async def search(self, uid):
+        waiter = asyncio.get_running_loop().create_future()
+        self.match_waiters[uid] = waiter
+        started = time.perf_counter()
+        profile = self.profiles[uid]
+        if profile["is_premium"] and self.rng.random() < 0.5:
+            field = self.rng.choice(["gender", "language"])
+            values = GENDERS if field == "gender" else LANGUAGES
+            self.user_data.setdefault(uid, {})["search_filters"] = {field: self.rng.choice(values)}
+            await self.handle(do_search, self.callback_update(uid, "filter_none"), uid)
+            self.counts["filtered_searches"] += 1
+        else:
+            await self.handle(find_command, self.command_update(uid, "/find"), uid)
+            self.counts["searches"] += 1
+        while not self.stopping and room_of(uid) is None:
+            try:
+                matched_at = await asyncio.wait_for(asyncio.shield(waiter), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+            self.match_latency.append(matched_at - started)
+            self.counts["matched"] += 1
+            return True
+        self.match_waiters.pop(uid, None)
+        return room_of(uid) is not None
+
+    async def chat(self, uid):
+        rng = self.rng
+        for _ in range(rng.randint(3, self.args.max_messages)):
+            await asyncio.sleep(rng.expovariate(1 / self.args.think_time))
+            if self.stopping or room_of(uid) is None:
+                return
+            roll = rng.random()
+            if roll < 0.1:
+                n = next(self.update_ids)
+                update = self.message_update(uid, caption="look", photo=[
+                    {"file_id": f"photo{n}", "file_unique_id": f"u{n}", "width": 640, "height": 480}])
+                self.counts["photos"] += 1
+            else:
+                words = rng.choices(WORDS, k=rng.randint(1, 8))
+                if roll < 0.11:
+                    words.append(rng.choice(BLOCKED_WORDS))
+                update = self.message_update(uid, text=" ".join(words))
+            await self.handle(route_message, update, uid)
+            self.counts["messages"] += 1
+
+    async def user_loop(self, uid):
+        await asyncio.sleep(self.rng.random() * self.args.ramp_up)
+        while not self.stopping:
+            if await self.search(uid):
+                await self.chat(uid)
+                if not self.stopping and room_of(uid) is not None:
+                    await self.handle(end_command, self.command_update(uid, "/end"), uid)
+                    self.counts["ends"] += 1
+            await asyncio.sleep(self.rng.expovariate(1 / self.args.idle_time))
+
+    async def run(self):
+        # Injected Bot errors would otherwise log a traceback each.
+        logging.disable(logging.ERROR)
+        await ensure_indexes()
+        await self.seed()
+        await moderation.reload()
+        spool = tempfile.TemporaryDirectory()
+        chatlog.pipeline = chatlog.ChatLogPipeline(spool_path=Path(spool.name) / "chatlog.spool")
+        await dispatcher.start()
+        await chatlog.pipeline.start()
+        await mirror.start(self.bot, ADMIN_GROUP_ID)
+        await matchmaker.start(lambda user_id, partner: start_match(self.bot, self.bot_data, user_id, partner))
+        await lifecycle.start(self.bot)
+        # Fixture setup isn't part of the measurement.
+        memory_db.calls.clear()
+        self.bot.calls.clear()
+        self.bot.errors.clear()
+
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(self.user_loop(uid)) for uid in self.profiles]
+        await asyncio.sleep(self.args.duration)
+        self.stopping = True
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*tasks)
+        await matchmaker.stop()
+        self.lifecycle_tracked = {"rooms": len(lifecycle.rooms), "waiting": len(lifecycle.waiting)}
+        await lifecycle.stop()
+        # Whatever the mirror still holds would take minutes to drain at the
+        # admin group's flood limit; report it instead of sending it.
+        self.mirror_backlog = await mirror.stop(drain=False)
+        await chatlog.pipeline.stop()
+        await dispatcher.stop(drain=False)
+        spool.cleanup()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        updates = self.counts["updates"] or 1
+        db_calls = memory_db.total_calls()
+        return {
+            "revision": git_revision(),
+            "timestamp": time.time(),
+            "config": vars(self.args),
+            "elapsed": elapsed,
+            "updates": self.counts["updates"],
+            "updates_per_second": self.counts["updates"] / elapsed,
+            "messages": self.counts["messages"],
+            "messages_per_second": self.counts["messages"] / elapsed,
+            "matches": self.counts["matched"] // 2,
+            "match_latency": {p: _pct(self.match_latency, q) for p, q in (("p50", .5), ("p95", .95), ("p99", .99))},
+            "handler_latency": {p: _pct(self.handler_latency, q) for p, q in (("p50", .5), ("p95", .95), ("p99", .99))},
+            "db_calls": db_calls,
+            "db_calls_per_update": db_calls / updates,
+            "db_calls_by_op": {f"{c}.{op}": n for (c, op), n in memory_db.calls.most_common()},
+            "bot_calls": dict(self.bot.calls.most_common()),
+            "bot_errors": sum(self.bot.errors.values()),
+            "mirror": {**mirror.stats, "backlog": self.mirror_backlog},
+            "chatlog": dict(chatlog.pipeline.stats),
+            "outbound": dict(dispatcher.stats),
+            "profile_photos": dict(profile_photos.stats),
+            "lifecycle": {**lifecycle.stats, **self.lifecycle_tracked},
+            "handler_errors": self.counts["handler_errors"],
+            "counts": dict(self.counts),
+        }
+
+COMPARED = ("messages_per_second", "updates_per_second", "db_calls_per_update")
+
+def print_report(result, previous=None):
+    print(f"revision {result['revision']}: {result['config']['users']} users for {result['elapsed']:.1f}s")
+    print(f"  updates/s        {result['updates_per_second']:10.1f}")
+    print(f"  messages/s       {result['messages_per_second']:10.1f}")
+    print(f"  matches          {result['matches']:10d}")
+    ml, hl = result["match_latency"], result["handler_latency"]
+    print(f"  match latency    p50={ml['p50'] * 1e3:.0f}ms p95={ml['p95'] * 1e3:.0f}ms p99={ml['p99'] * 1e3:.0f}ms")
+    print(f"  handler latency  p50={hl['p50'] * 1e3:.1f}ms p95={hl['p95'] * 1e3:.1f}ms p99={hl['p99'] * 1e3:.1f}ms")
+    print(f"  db calls/update  {result['db_calls_per_update']:10.2f}")
+    for op, n in list(result["db_calls_by_op"].items())[:8]:
+        print(f"    {op:<32} {n:8d}")
+    print(f"  bot calls        {sum(result['bot_calls'].values()):10d}  (injected errors {result['bot_errors']})")
+    print(f"  handler errors   {result['handler_errors']:10d}")
+    print(f"  chat log         {result['chatlog']['written']} written, {result['chatlog']['spooled']} spooled")
+    print(f"  admin mirror     {result['mirror']['submitted']} submitted, {result['mirror']['sent_calls']} sent, "
+          f"{result['mirror']['dropped']} dropped, {result['mirror']['backlog']} left queued")
+    photos = result.get("profile_photos", {})
+    print(f"  profile photos   {photos.get('albums', 0) / max(1, result['matches']):.2f} album calls/match, "
+          f"{photos.get('posted', 0)} posted, {photos.get('referenced', 0)} referenced")
+    outbound = result.get("outbound", {})
+    print(f"  outbound         {outbound.get('sent', 0)} sent, {outbound.get('failed', 0)} failed, "
+          f"{outbound.get('retry_after', 0)} RetryAfter")
+    lifecycle = result.get("lifecycle")
+    if lifecycle:
+        print(f"  lifecycle        {lifecycle['rooms']} rooms and {lifecycle['waiting']} waiters tracked at the end, "
+              f"{lifecycle['rooms_closed']} closed, {lifecycle['waiters_dropped']} dropped")
+    if previous:
+        print(f"compared with {previous['revision']}:")
+        for key in COMPARED + ("match_latency.p95",):
+            if "." in key:
+                outer, inner = key.split(".")
+                old, new = previous[outer][inner], result[outer][inner]
+            else:
+                old, new = previous[key], result[key]
+            change = (new - old) / old * 100 if old else 0.0
+            print(f"  {key:<22} {old:10.3f} -> {new:10.3f}  ({change:+.1f}%)")
+
+def latest_result():
+    files = sorted(RESULTS_DIR.glob("load_*.json"), key=lambda p: p.stat().st_mtime)
+    return json.loads(files[-1].read_text()) if files else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="seconds over which users arrive")
+    parser.add_argument("--think-time", type=float, default=1.5, help="mean seconds between a user's messages")
+    parser.add_argument("--idle-time", type=float, default=2.0, help="mean seconds between chats")
+    parser.add_argument("--max-messages", type=int, default=20)
+    parser.add_argument("--premium-share", type=float, default=0.2)
+    parser.add_argument("--bot-latency", type=float, default=0.04, help="median Bot API latency in seconds")
+    parser.add_argument("--bot-error-rate", type=float, default=0.01)
+    parser.add_argument("--send-rate", type=float, default=100_000,
+                        help="outbound dispatcher global budget (FakeBot has no flood limits)")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="per-call DB latency in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-save", action="store_true", help="don't write benchmarks/results")
+    args = parser.parse_args(argv)
+
+    memory_db.latency = args.db_latency
+    memory_db.jitter = 1.0
+    dispatcher.global_bucket = TokenBucket(args.send_rate, args.send_rate)
+    result = asyncio.run(Simulation(args).run())
+    print_report(result, latest_result())
+    if not args.no_save:
+        path = RESULTS_DIR / f"load_{result['revision']}.json"
+        RESULTS_DIR.mkdir(exist_ok=True)
+        path.write_text(json.dumps(result, indent=2, sort_keys=True))
+        print(f"saved {path}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""webhook_load.py - local load test for the webhook intake
+
+Starts a WebhookServer on localhost with a consumer that drains the
+update queue, then POSTs synthetic message updates over keep-alive
+connections and reports accepted updates/s. For comparison it runs a
+model of the polling loop: one getUpdates round trip per batch of at most
+100 updates, at the given RTT.
+
+Run from the repo root: python -m benchmarks.webhook_load [updates] [connections] [rtt_ms]
+"""
+import asyncio
+import json
+import sys
+import time
+
+from telegram import Bot
+from webhook import WebhookServer
+
+SECRET = "load-test-secret"
+PATH = "/telegram"
+
+def synthetic_update(update_id):
+    user = {"id": 1000 + update_id % 5000, "is_bot": False, "first_name": "Load"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"},
+            "from": user,
+            "text": f"hello {update_id}",
+        },
+    }
+
+async def post_many(port, ids):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    statuses = {}
+    for update_id in ids:
+        body = json.dumps(synthetic_update(update_id)).encode()
+        writer.write(
+            f"POST {PATH} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        status = int(status_line.split()[1])
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+    return statuses
+
+async def webhook_throughput(updates, connections, port=18443):
+    queue = asyncio.Queue()
+    server = WebhookServer(Bot("123456:LOADTEST"), queue, path=PATH, secret=SECRET, max_queue=updates)
+    await server.start("127.0.0.1", port)
+    consumed = 0
+
+    async def consume():
+        nonlocal consumed
+        while True:
+            await queue.get()
+            consumed += 1
+
+    consumer = asyncio.create_task(consume())
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(post_many(port, range(i, updates, connections)) for i in range(connections)))
+    elapsed = time.perf_counter() - t0
+    consumer.cancel()
+    await server.stop()
+    statuses = {}
+    for r in results:
+        for k, v in r.items():
+            statuses[k] = statuses.get(k, 0) + v
+    return updates / elapsed, statuses
+
+async def polling_model(updates, rtt_ms, batch=100):
+    t0 = time.perf_counter()
+    remaining = updates
+    while remaining > 0:
+        await asyncio.sleep(rtt_ms / 1000)
+        remaining -= batch
+    return updates / (time.perf_counter() - t0)
+
+async def main(updates, connections, rtt_ms):
+    rate, statuses = await webhook_throughput(updates, connections)
+    print(f"webhook: {rate:8.0f} updates/s over {connections} connections  statuses={statuses}")
+    polled = await polling_model(updates, rtt_ms)
+    print(f"polling model (rtt={rtt_ms}ms, 100/batch, single consumer): {polled:8.0f} updates/s")
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    updates = args[0] if len(args) > 0 else 20_000
+    connections = args[1] if len(args) > 1 else 40
+    rtt_ms = args[2] if len(args) > 2 else 150
+    asyncio.run(main(updates, connections, rtt_ms))
@@ -1,12 +1,17 @@
 import os
+import asyncio
 import logging
-import json
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+
+# Project modules read their settings from the environment at import time.
+load_dotenv()
+
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, TypeHandler, filters
 )
-from db import db, get_user, update_user
+from db import db, backend, get_user, update_user
+from usercache import cache as user_cache
 from handlers.profile import (
     start_profile, profile_menu, gender_cb, region_cb, country_cb, 
     ASK_GENDER, ASK_REGION, ASK_COUNTRY, PROFILE_MENU
@@ -16,21 +21,40 @@ from handlers.chat import process_message
 from handlers.report import report_partner
 from handlers.admincmds import (
     admin_block, admin_unblock, admin_message, admin_stats, admin_blockword, admin_unblockword,
-    admin_userinfo, admin_roominfo, admin_viewhistory, admin_setpremium
+    admin_userinfo, admin_roominfo, admin_viewhistory, admin_setpremium, admin_exporthistory,
+    admin_diag, admin_broadcast, history_page_cb, report_excerpt_cb
 )
 from handlers.match import (
     find_command, search_conv, end_command, next_command,
-    open_filter_menu, menu_callback_handler, select_filter_cb
+    open_filter_menu, menu_callback_handler, select_filter_cb, start_match
 )
 from handlers.forward import forward_to_admin
-from admin import downgrade_expired_premium
+from premium_expiry import scheduler as expiry_scheduler
+from matchmaker import matchmaker
 from handlers.message_router import route_message
+import moderation
+import i18n
+import ratelimit
+import metrics
+import diagnostics
+from outbound import dispatcher
+from rooms import load_directory
+from indexes import ensure_indexes
+import chatlog
+from retention import retention
+from lifecycle import lifecycle, track_activity
+from broadcast import broadcaster
+from admin_mirror import mirror, load_flagged_rooms
+from persistence import MongoPersistence
+from webhook import run_webhook
+import rooms
+from sharedstate import MongoMatchState
+from cluster import CLUSTER_WORKERS, run_front
 
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 ADMIN_GROUP_ID = int(os.getenv("ADMIN_GROUP_ID"))
-LOCALE_DIR = os.path.join(os.path.dirname(__file__), "locales")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -42,22 +66,19 @@ LANGS = {
     "id": "Indonesian"
 }
 
-def load_locale(lang):
-    path = os.path.join(LOCALE_DIR, f"{lang}.json")
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+LANGUAGE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(locale, callback_data=f"lang_{code}")]
+    for code, locale in LANGS.items()
+])
 
 async def start(update: Update, context):
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(locale, callback_data=f"lang_{code}")]
-        for code, locale in LANGS.items()
-    ])
+    user = await get_user(update.effective_user.id)
+    if user and user.get("bot_blocked"):
+        # Back after blocking the bot; broadcasts reach them again.
+        await update_user(user["user_id"], {"bot_blocked": False})
     await update.message.reply_text(
-        load_locale("en")["welcome"],
-        reply_markup=kb
+        i18n.t("en", "welcome"),
+        reply_markup=LANGUAGE_KEYBOARD
     )
 
 async def language_select_callback(update: Update, context):
@@ -65,46 +86,86 @@ async def language_select_callback(update: Update, context):
     user_id = query.from_user.id
     lang = query.data.split("_", 1)[1]
     await update_user(user_id, {"language": lang})
-    locale = load_locale(lang)
     user = await get_user(user_id)
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(locale.get("edit_profile", "Edit Profile"), callback_data="menu_edit_profile")],
-        [InlineKeyboardButton(locale.get("find", "Find"), callback_data="menu_find")],
-        [InlineKeyboardButton(locale.get("upgrade_tip", "Upgrade"), callback_data="menu_upgrade")],
-        [InlineKeyboardButton("Filters", callback_data="menu_filter")],
-        [InlineKeyboardButton(locale.get("menu_back", "Back"), callback_data="menu_back")]
-    ])
-    await query.edit_message_text(locale.get("main_menu", "Main Menu:"), reply_markup=kb)
+    await query.edit_message_text(i18n.t(lang, "main_menu", "Main Menu:"), reply_markup=i18n.keyboard("main_menu", lang))
     if not user:
         await start_profile(update, context)
 
 async def main_menu(update: Update, context):
     user = await get_user(update.effective_user.id)
     lang = user.get("language", "en") if user else "en"
-    locale = load_locale(lang)
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(locale.get("edit_profile", "Edit Profile"), callback_data="menu_edit_profile")],
-        [InlineKeyboardButton(locale.get("find", "Find"), callback_data="menu_find")],
-        [InlineKeyboardButton(locale.get("upgrade_tip", "Upgrade"), callback_data="menu_upgrade")],
-        [InlineKeyboardButton("Filters", callback_data="menu_filter")],
-        [InlineKeyboardButton(locale.get("menu_back", "Back"), callback_data="menu_back")]
-    ])
     chat_id = update.effective_chat.id
-    await context.bot.send_message(chat_id, locale.get("main_menu", "Main Menu:"), reply_markup=kb)
+    await context.bot.send_message(chat_id, i18n.t(lang, "main_menu", "Main Menu:"), reply_markup=i18n.keyboard("main_menu", lang))
 
 async def menu_callback_handler_entry(update: Update, context):
     await menu_callback_handler(update, context)
 
-def main():
-    app = Application.builder().token(BOT_TOKEN).build()
-    app.bot_data["ADMIN_GROUP_ID"] = ADMIN_GROUP_ID
-    app.bot_data["ADMIN_ID"] = ADMIN_ID
+async def post_init(app):
+    # Application.initialize() replaced bot_data with the persisted copy;
+    # put the process settings back on top of it.
+    app.bot_data.update(app.bot_defaults)
+    await backend.start()
+    await ensure_indexes()
+    await moderation.reload()
+    active = await load_directory()
+    logger.info("Room directory loaded: %d active rooms.", active)
+    waiting = await app.persistence.restore_pool()
+    logger.info("Waiting pool restored: %d users.", waiting)
+    await dispatcher.start()
+    await chatlog.pipeline.start()
+    await load_flagged_rooms()
+    await mirror.start(app.bot, app.bot_data.get("ADMIN_GROUP_ID"))
+    on_match = lambda user_id, partner: start_match(app.bot, app.bot_data, user_id, partner)
+    if rooms.state.batched:
+        await matchmaker.start(on_match)
+    # Cluster mode: periodically pairs waiting users whose requests raced.
+    await rooms.state.start(on_match)
+    await lifecycle.start(app.bot)
+    await broadcaster.start(app.bot, app.bot_data["SHARD"])
+    if app.bot_data["SHARD"] == 0:
+        await expiry_scheduler.start(app.bot)
+        logger.info("Premium expiry scheduler loaded: %d users.", len(expiry_scheduler))
+        await retention.start()
+    await diagnostics.recorder.start()
+    if metrics.METRICS_PORT:
+        await metrics.server.start(port=metrics.METRICS_PORT + app.bot_data["SHARD"])
+
+async def post_shutdown(app):
+    await metrics.server.stop()
+    await diagnostics.recorder.stop()
+    await matchmaker.stop()
+    await rooms.state.stop()
+    await lifecycle.stop()
+    await broadcaster.stop()
+    await expiry_scheduler.stop()
+    await retention.stop()
+    await mirror.stop()
+    await chatlog.pipeline.stop()
+    await dispatcher.stop()
+    await backend.close()
+
+def build_application(with_updater=True, shard=0):
+    builder = (
+        Application.builder().token(BOT_TOKEN).persistence(MongoPersistence())
+        .request(metrics.InstrumentedRequest())
+        .application_class(diagnostics.DiagnosticApplication)
+        .post_init(post_init).post_shutdown(post_shutdown)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    app.bot_defaults = {"ADMIN_GROUP_ID": ADMIN_GROUP_ID, "ADMIN_ID": ADMIN_ID, "SHARD": shard}
+    app.bot_data.update(app.bot_defaults)
+
+    # Ahead of everything else: idle rooms and stale waiters are judged by
+    # the last update from their users.
+    app.add_handler(TypeHandler(Update, track_activity), group=-1)
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("profile", start_profile))
-    app.add_handler(CommandHandler("find", find_command))
+    app.add_handler(CommandHandler("find", ratelimit.rate_limited()(find_command)))
     app.add_handler(CommandHandler("end", end_command))
-    app.add_handler(CommandHandler("next", next_command))
+    app.add_handler(CommandHandler("next", ratelimit.rate_limited()(next_command)))
     app.add_handler(CommandHandler("upgrade", start_upgrade))
     app.add_handler(CommandHandler("report", report_partner))
     app.add_handler(CommandHandler("filters", open_filter_menu))
@@ -114,6 +175,8 @@ def main():
     app.add_handler(CallbackQueryHandler(select_filter_cb, pattern="^(filter_|gender_|region_|country_|language_|back)$"))
 
     profile_conv = ConversationHandler(
+        name="profile_conv",
+        persistent=True,
         entry_points=[CommandHandler('profile', start_profile)],
         states={
             PROFILE_MENU: [CallbackQueryHandler(profile_menu, pattern="^edit_profile$")],
@@ -136,23 +199,119 @@ def main():
     app.add_handler(CommandHandler("userinfo", admin_userinfo, admin_filter))
     app.add_handler(CommandHandler("roominfo", admin_roominfo, admin_filter))
     app.add_handler(CommandHandler("viewhistory", admin_viewhistory, admin_filter))
+    app.add_handler(CommandHandler("exporthistory", admin_exporthistory, admin_filter))
+    app.add_handler(CommandHandler("diag", admin_diag, admin_filter))
+    app.add_handler(CommandHandler("broadcast", admin_broadcast, admin_filter))
+    app.add_handler(CallbackQueryHandler(history_page_cb, pattern="^h[npsx]:"))
+    app.add_handler(CallbackQueryHandler(report_excerpt_cb, pattern="^rx:"))
     app.add_handler(CommandHandler("setpremium", admin_setpremium, admin_filter))
 
     app.add_handler(CallbackQueryHandler(admin_callback))
     # FIXED: use correct media filters!
     app.add_handler(MessageHandler(
-        filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.AUDIO | filters.Sticker,
+        filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.AUDIO | filters.Sticker.ALL,
         route_message
     ))
     app.add_handler(MessageHandler(~filters.COMMAND, route_message))
     app.add_error_handler(lambda update, context: logger.error(msg="Exception while handling an update:", exc_info=context.error))
 
-    async def expiry_job(context):
-        await downgrade_expired_premium()
-    app.job_queue.run_repeating(expiry_job, interval=3600, first=10)
+    async def blocked_words_job(context):
+        await moderation.refresh()
+    app.job_queue.run_repeating(blocked_words_job, interval=moderation.VERSION_CHECK_INTERVAL, first=moderation.VERSION_CHECK_INTERVAL)
+
+    async def rate_limit_sweep_job(context):
+        ratelimit.limiter.sweep()
+    app.job_queue.run_repeating(rate_limit_sweep_job, interval=ratelimit.SWEEP_INTERVAL, first=ratelimit.SWEEP_INTERVAL)
 
-    logger.info("AnonindoChat Bot started (polling).")
-    app.run_polling()
+    async def locales_job(context):
+        i18n.catalog.refresh()
+    app.job_queue.run_repeating(locales_job, interval=i18n.RELOAD_CHECK_INTERVAL, first=i18n.RELOAD_CHECK_INTERVAL)
+
+    metrics.instrument_application(app)
+    register_gauges(app)
+    return app
+
+def register_gauges(app):
+    gauge = metrics.registry.gauge
+    gauge("bot_waiting_users", "Users in the local waiting pool.", fn=lambda: len(rooms.users_online))
+    gauge("bot_active_rooms", "Active rooms in the room directory.", fn=lambda: len(rooms.directory))
+    gauge("bot_update_queue_depth", "Updates waiting to be handled.", fn=app.update_queue.qsize)
+    gauge("bot_chatlog_pending", "Chat log entries not yet written to Mongo.", fn=lambda: len(chatlog.pipeline))
+    gauge("bot_admin_mirror_pending", "Events queued for the admin group.", fn=lambda: len(mirror))
+    gauge("bot_premium_expiries_scheduled", "Premium expiries in the scheduler.", fn=lambda: len(expiry_scheduler))
+    gauge("bot_user_cache_size", "Users in the in-process cache.", fn=lambda: len(user_cache))
+    gauge("bot_outbound_queued", "Sends waiting in the outbound dispatcher.", ("priority",), fn=dispatcher.depths)
+    metrics.registry.counter("bot_outbound_total", "Outbound dispatcher sends by outcome.", ("outcome",),
+                             fn=lambda: dispatcher.stats)
+    metrics.registry.counter("bot_chatlog_retention_total", "Chat log retention work done, by kind.", ("kind",),
+                             fn=lambda: retention.stats)
+    metrics.registry.counter("bot_lifecycle_total", "Idle rooms closed, stale waiters dropped and notices sent.",
+                             ("kind",), fn=lambda: lifecycle.stats)
+    gauge("bot_lifecycle_tracked", "Rooms and waiting users tracked for idle expiry.", ("kind",),
+          fn=lambda: {"rooms": len(lifecycle.rooms), "waiting": len(lifecycle.waiting)})
+    metrics.registry.counter("bot_broadcast_total", "Broadcast sends by outcome, and broadcasts started and completed.",
+                             ("outcome",), fn=lambda: broadcaster.stats)
+    gauge("bot_broadcasts_running", "Broadcasts running in this process.", fn=lambda: len(broadcaster))
+    gauge("bot_event_loop_lag_seconds", "Last measured event loop lag.", fn=lambda: diagnostics.recorder.last_lag)
+
+class ShardRunner:
+    # One worker process in cluster mode: a full Application without an
+    # Updater, fed by the front process.
+    def __init__(self, index, shards, publish):
+        rooms.use_state(MongoMatchState(index, shards, publish))
+        chatlog.pipeline.spool_path = chatlog.SPOOL_FILE.with_name(f"chatlog.{index}.spool")
+        dispatcher.share_budget(shards)
+        self.index = index
+        self.shards = shards
+        self.publish = publish
+        user_cache.publisher = self._publish_user_change
+        self.app = build_application(with_updater=False, shard=index)
+
+    def _publish_user_change(self, user_id):
+        # Partner and admin lookups cache users owned by other shards.
+        for target in range(self.shards):
+            if target != self.index:
+                self.publish(target, {"op": "user", "user_id": user_id})
+
+    async def start(self):
+        await self.app.initialize()
+        await post_init(self.app)
+        await self.app.start()
+
+    async def process(self, data):
+        diagnostics.recorder.mark_intake(data.get("update_id"))
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+
+    def control(self, event):
+        if event["op"] == "user":
+            user_cache.invalidate(event["user_id"], publish=False)
+            if self.index == 0:
+                # Premium granted or revoked on another shard.
+                asyncio.create_task(expiry_scheduler.refresh_user(event["user_id"]))
+        elif event["op"] == "touch":
+            lifecycle.touch_room(event["room_id"])
+        else:
+            rooms.apply_event(event)
+
+    async def stop(self):
+        await self.app.stop()
+        await self.app.shutdown()
+        await post_shutdown(self.app)
+
+def main():
+    if CLUSTER_WORKERS > 1:
+        if not backend.shared:
+            raise SystemExit("STORAGE_BACKEND=local keeps its data in one process; set CLUSTER_WORKERS=1 or use mongo.")
+        logger.info("AnonindoChat Bot started (%s, %d shards).", BOT_MODE, CLUSTER_WORKERS)
+        asyncio.run(run_front(Bot(BOT_TOKEN), "bot:ShardRunner", CLUSTER_WORKERS, BOT_MODE))
+        return
+    app = build_application(with_updater=BOT_MODE != "webhook")
+    if BOT_MODE == "webhook":
+        logger.info("AnonindoChat Bot started (webhook).")
+        asyncio.run(run_webhook(app))
+    else:
+        logger.info("AnonindoChat Bot started (polling).")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
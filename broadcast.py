@@ -0,0 +1,293 @@
+"""broadcast.py - segmented admin broadcasts with resumable progress"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from telegram.error import Forbidden
+from db import db, mark_bot_blocked
+from outbound import TokenBucket, dispatcher, ADMIN, BULK
+
+logger = logging.getLogger(__name__)
+
+# Sends a second for broadcasts; the rest of the outbound budget stays free
+# for chats.
+RATE = float(os.getenv("BROADCAST_RATE", "20"))
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+CHECKPOINT_INTERVAL = float(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", "5"))
+PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "15"))
+# Stopping waits this long for sends already handed to the Bot.
+STOP_TIMEOUT = 10
+BATCH_SIZE = 500
+SEGMENT_FIELDS = ("gender", "region", "country", "language")
+
+def parse_segment(spec):
+    # "all", "premium", "free" and field=value terms joined by commas,
+    # e.g. "premium,region=North_America" (underscores stand for spaces).
+    # Raises ValueError on anything else.
+    query = {}
+    for term in spec.split(","):
+        term = term.strip()
+        if term in ("", "all"):
+            continue
+        if term == "premium":
+            query["is_premium"] = True
+        elif term == "free":
+            query["is_premium"] = {"$ne": True}
+        elif "=" in term:
+            field, value = term.split("=", 1)
+            if field not in SEGMENT_FIELDS:
+                raise ValueError(f"Unknown segment field '{field}'. Use one of: {', '.join(SEGMENT_FIELDS)}.")
+            query[field] = value.replace("_", " ")
+        else:
+            raise ValueError(f"Unknown segment '{term}'.")
+    return query
+
+def audience(spec):
+    # Blocked users and users who blocked the bot are never sent to.
+    return {**parse_segment(spec), "blocked": {"$ne": True}, "bot_blocked": {"$ne": True}}
+
+def progress_text(doc, rate=None):
+    done = doc["sent"] + doc["failed"] + doc["bot_blocked"]
+    lines = [
+        f"📣 Broadcast {doc['_id']} ({doc['segment']}): {doc['state']}",
+        f"{done}/{doc['total']} users: {doc['sent']} sent, {doc['failed']} failed, "
+        f"{doc['bot_blocked']} blocked the bot",
+    ]
+    if doc["state"] == "running" and rate:
+        eta = max(0, doc["total"] - done) / rate
+        lines.append(f"{rate:.1f} msg/s, about {eta / 60:.0f} min left")
+    elif doc.get("finished_at"):
+        lines.append(f"Took {(doc['finished_at'] - doc['created_at']) / 60:.1f} min")
+    return "\n".join(lines)
+
+class _Run:
+    # One broadcast in flight. Users are queued in user_id order and finish
+    # out of order; `checkpoint` is the highest user_id with everything up
+    # to it finished, which is where a resumed run starts again.
+    def __init__(self, doc):
+        self.doc = doc
+        self.checkpoint = doc.get("checkpoint")
+        self.queued = deque()
+        self.finished = set()
+        self.blocked = []
+        self.processed = 0
+        self.started = time.monotonic()
+        self.stopping = False
+        self.cancelled = False
+        self.reported = None
+
+    def queue(self, user_id):
+        self.queued.append(user_id)
+
+    def finish(self, user_id, outcome):
+        self.doc[outcome] += 1
+        self.processed += 1
+        self.finished.add(user_id)
+        while self.queued and self.queued[0] in self.finished:
+            self.finished.discard(self.queued[0])
+            self.checkpoint = self.queued.popleft()
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+class Broadcaster:
+    # Each broadcast is a document in `broadcasts` holding its segment,
+    # content, counters and checkpoint. The users collection is streamed in
+    # user_id order (projection on user_id only) into a pool of workers
+    # that share one token bucket and send at BULK priority. Counters and
+    # the checkpoint are saved every few seconds, so a broadcast cut off by
+    # a restart picks up where it stopped instead of starting over.
+    def __init__(self, rate=RATE, concurrency=CONCURRENCY):
+        self.bucket = TokenBucket(rate, max(1, rate))
+        self.concurrency = concurrency
+        self._runs = {}
+        self._bot = None
+        self.stats = {"sent": 0, "failed": 0, "bot_blocked": 0, "started": 0, "completed": 0}
+
+    def __len__(self):
+        return len(self._runs)
+
+    async def start(self, bot, shard=0):
+        # Picks up this shard's broadcasts that were running at shutdown.
+        self._bot = bot
+        resumed = 0
+        async for doc in db.broadcasts.find({"state": "running", "shard": shard}):
+            self._launch(doc)
+            resumed += 1
+        if resumed:
+            logger.info("Resumed %d broadcasts.", resumed)
+
+    async def stop(self):
+        # Leaves the documents "running"; they resume on the next start.
+        await asyncio.gather(*(self._halt(task, run) for task, run in list(self._runs.values())))
+
+    async def create(self, segment, content, progress_chat, shard=0):
+        # `content` is {"text": ...} or {"from_chat_id": ..., "message_id": ...}
+        # (the message is copied). Returns the new broadcast document.
+        total = await db.users.count_documents(audience(segment))
+        doc = {
+            "_id": uuid.uuid4().hex[:8], "segment": segment, "content": content, "state": "running",
+            "shard": shard, "total": total, "checkpoint": None, "sent": 0, "failed": 0, "bot_blocked": 0,
+            "created_at": time.time(), "finished_at": None,
+            "progress": {"chat_id": progress_chat, "message_id": None},
+        }
+        message = await self._bot.send_message(chat_id=progress_chat, text=progress_text(doc))
+        doc["progress"]["message_id"] = message.message_id
+        await db.broadcasts.insert_one(doc)
+        self._launch(doc)
+        return doc
+
+    async def cancel(self, broadcast_id):
+        entry = self._runs.get(broadcast_id)
+        if entry is not None:
+            await self._halt(*entry, cancelled=True)
+            return True
+        result = await db.broadcasts.update_one({"_id": broadcast_id, "state": "running"},
+                                                {"$set": {"state": "cancelled", "finished_at": time.time()}})
+        return result.modified_count > 0
+
+    async def resume(self, broadcast_id):
+        if broadcast_id in self._runs:
+            return None
+        result = await db.broadcasts.update_one({"_id": broadcast_id, "state": "cancelled"},
+                                                {"$set": {"state": "running", "finished_at": None}})
+        if not result.modified_count:
+            return None
+        doc = await db.broadcasts.find_one({"_id": broadcast_id})
+        self._launch(doc)
+        return doc
+
+    async def recent(self, limit=5):
+        return await db.broadcasts.find({}).sort("created_at", -1).limit(limit).to_list(limit)
+
+    def progress(self, broadcast_id):
+        entry = self._runs.get(broadcast_id)
+        return progress_text(entry[1].doc, entry[1].rate()) if entry else None
+
+    # -- running ------------------------------------------------------------------
+    async def _halt(self, task, run, cancelled=False):
+        # No new sends; the ones in flight finish and are counted, so the
+        # checkpoint covers everyone who actually got the message.
+        run.stopping = True
+        run.cancelled = cancelled
+        try:
+            await asyncio.wait_for(asyncio.shield(task), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _launch(self, doc):
+        run = _Run(doc)
+        task = asyncio.create_task(self._run(run))
+        self._runs[doc["_id"]] = (task, run)
+        self.stats["started"] += 1
+
+    async def _run(self, run):
+        doc = run.doc
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(run, queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report(run))
+        state = "running"
+        try:
+            query = audience(doc["segment"])
+            if run.checkpoint is not None:
+                query["user_id"] = {"$gt": run.checkpoint}
+            cursor = db.users.find(query, {"user_id": 1, "_id": 0}).sort("user_id", 1).batch_size(BATCH_SIZE)
+            async for user in cursor:
+                if run.stopping:
+                    break
+                run.queue(user["user_id"])
+                await queue.put(user["user_id"])
+            await queue.join()
+            state = "cancelled" if run.cancelled else "running" if run.stopping else "done"
+        except asyncio.CancelledError:
+            if run.cancelled:
+                state = "cancelled"
+            raise
+        except Exception:
+            logger.exception("Broadcast %s failed", doc["_id"])
+            state = "cancelled"
+        finally:
+            for task in (*workers, reporter):
+                task.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+            del self._runs[doc["_id"]]
+            doc["state"] = state
+            if state != "running":
+                doc["finished_at"] = time.time()
+            try:
+                await self._checkpoint(run)
+            except Exception:
+                logger.exception("Saving broadcast %s failed", doc["_id"])
+            self._show(run)
+            if state == "done":
+                self.stats["completed"] += 1
+                logger.info("Broadcast %s done: %d sent, %d failed, %d blocked the bot.",
+                            doc["_id"], doc["sent"], doc["failed"], doc["bot_blocked"])
+
+    async def _worker(self, run, queue):
+        content = run.doc["content"]
+        while True:
+            user_id = await queue.get()
+            if run.stopping:
+                queue.task_done()
+                continue
+            try:
+                await self.bucket.acquire()
+                if "text" in content:
+                    await dispatcher.send(BULK, self._bot.send_message, chat_id=user_id, text=content["text"])
+                else:
+                    await dispatcher.send(BULK, self._bot.copy_message, chat_id=user_id,
+                                          from_chat_id=content["from_chat_id"], message_id=content["message_id"])
+                outcome = "sent"
+            except Forbidden:
+                run.blocked.append(user_id)
+                outcome = "bot_blocked"
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                outcome = "failed"
+            run.finish(user_id, outcome)
+            self.stats[outcome] += 1
+            queue.task_done()
+
+    async def _report(self, run):
+        last_progress = time.monotonic()
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            try:
+                await self._checkpoint(run)
+            except Exception:
+                logger.exception("Broadcast %s checkpoint failed", run.doc["_id"])
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                self._show(run)
+
+    async def _checkpoint(self, run):
+        # Blocked users first: a checkpoint never gets ahead of them.
+        if run.blocked:
+            blocked, run.blocked = run.blocked, []
+            await mark_bot_blocked(blocked)
+        doc = run.doc
+        await db.broadcasts.update_one({"_id": doc["_id"]}, {"$set": {
+            "state": doc["state"], "checkpoint": run.checkpoint, "finished_at": doc["finished_at"],
+            "sent": doc["sent"], "failed": doc["failed"], "bot_blocked": doc["bot_blocked"],
+        }})
+
+    def _show(self, run):
+        # Edits the admin's progress message in place.
+        progress = run.doc["progress"]
+        text = progress_text(run.doc, run.rate())
+        if progress.get("message_id") is None or text == run.reported:
+            return
+        run.reported = text
+        dispatcher.post(ADMIN, self._bot.edit_message_text, chat_id=progress["chat_id"],
+                        message_id=progress["message_id"], text=text)
+
+broadcaster = Broadcaster()
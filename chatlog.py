@@ -0,0 +1,200 @@
+"""chatlog.py - write-behind chat log pipeline with a local spool"""
+import asyncio
+import json
+import logging
+import os
+import time
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError
+from db import insert_chat_logs
+from storage import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.getenv("CHATLOG_BATCH_SIZE", "500"))
+FLUSH_INTERVAL = float(os.getenv("CHATLOG_FLUSH_INTERVAL", "1.0"))
+MAX_PENDING = int(os.getenv("CHATLOG_MAX_PENDING", "20000"))
+WRITE_TIMEOUT = float(os.getenv("CHATLOG_WRITE_TIMEOUT", "5.0"))
+REPLAY_INTERVAL = float(os.getenv("CHATLOG_REPLAY_INTERVAL", "30.0"))
+SPOOL_FILE = DATA_DIR / "chatlog.spool"
+
+DUPLICATE_KEY = 11000
+
+def _to_line(entry):
+    return json.dumps({**entry, "_id": str(entry["_id"])}, ensure_ascii=False, default=str) + "\n"
+
+def _from_line(line):
+    entry = json.loads(line)
+    entry["_id"] = ObjectId(entry["_id"])
+    return entry
+
+class ChatLogPipeline:
+    # Entries get their _id up front, so a batch that timed out after
+    # reaching Mongo can be spooled and replayed without duplicating rows.
+    def __init__(self, spool_path=SPOOL_FILE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self._healthy = True
+        self._last_replay = 0.0
+        self.stats = {"submitted": 0, "written": 0, "spooled": 0, "replayed": 0, "failed_flushes": 0}
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def submit(self, room_id, log_data):
+        entry = {"_id": ObjectId(), "room_id": room_id, **log_data}
+        self._buffer.append(entry)
+        self.stats["submitted"] += 1
+        if len(self._buffer) >= self.max_pending:
+            # Backpressure without making the sender wait: the oldest batch
+            # goes to disk and is replayed once Mongo keeps up again.
+            batch = self._buffer[:self.batch_size]
+            del self._buffer[:self.batch_size]
+            self._spool(batch)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def pending_for(self, room_id, limit):
+        # Entries accepted but not yet written, for callers that need the
+        # latest messages of a room right now (report snapshots).
+        entries = [entry for entry in self._buffer if entry["room_id"] == room_id]
+        return entries[-limit:]
+
+    async def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        while self._buffer:
+            if not await self.flush():
+                break
+        if self._buffer:
+            self._spool(self._buffer)
+            self._buffer = []
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                while self._buffer:
+                    if not await self.flush():
+                        break
+                if time.monotonic() - self._last_replay >= REPLAY_INTERVAL:
+                    await self.replay()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Chat log pipeline iteration failed")
+
+    async def _write(self, batch):
+        try:
+            await asyncio.wait_for(insert_chat_logs(batch), timeout=WRITE_TIMEOUT)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != DUPLICATE_KEY for err in errors):
+                raise
+
+    async def flush(self):
+        if not self._buffer:
+            return True
+        batch = self._buffer[:self.batch_size]
+        del self._buffer[:self.batch_size]
+        try:
+            await self._write(batch)
+        except asyncio.CancelledError:
+            self._buffer[:0] = batch
+            raise
+        except Exception as e:
+            self.stats["failed_flushes"] += 1
+            if self._healthy:
+                logger.warning("Chat log flush failed, spooling to %s: %s", self.spool_path, e)
+            self._healthy = False
+            self._spool(batch)
+            return False
+        self._healthy = True
+        self.stats["written"] += len(batch)
+        return True
+
+    def _spool(self, batch):
+        self._spool_lines([_to_line(entry) for entry in batch])
+
+    def _spool_lines(self, lines):
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+        self.stats["spooled"] += len(lines)
+
+    async def replay(self):
+        self._last_replay = time.monotonic()
+        # Move the spool aside so new spills don't interleave with the
+        # replay; a leftover from an interrupted replay goes first.
+        replaying = self.spool_path.with_suffix(".replay")
+        if not replaying.exists():
+            if not self.spool_path.exists():
+                return 0
+            os.replace(self.spool_path, replaying)
+        replayed = 0
+        with open(replaying, "r", encoding="utf-8") as f:
+            batch = []
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(_from_line(line))
+                except (ValueError, KeyError, TypeError, InvalidId):
+                    logger.warning("Skipping corrupt chat log spool line: %r", line[:200])
+                    continue
+                if len(batch) >= self.batch_size:
+                    if not await self._replay_batch(batch, f):
+                        break
+                    replayed += len(batch)
+                    batch = []
+            else:
+                if batch and await self._replay_batch(batch, f):
+                    replayed += len(batch)
+        # Every entry is now in Mongo or back on the spool. Anything that
+        # stops the pass before this point leaves the file for the next
+        # one; entries already written come back as duplicate-key no-ops.
+        os.remove(replaying)
+        self.stats["replayed"] += replayed
+        if replayed:
+            logger.info("Replayed %d spooled chat log entries", replayed)
+        return replayed
+
+    async def _replay_batch(self, batch, f):
+        # False when the write failed, after putting the batch and the rest
+        # of the file back on the spool for the next pass.
+        try:
+            await self._write(batch)
+        except Exception as e:
+            self._healthy = False
+            logger.warning("Chat log replay stopped: %s", e)
+            self._spool(batch)
+            self._spool_lines([line for line in f if line.strip()])
+            return False
+        return True
+
+pipeline = ChatLogPipeline()
+
+def log_chat(room_id, log_data):
+    pipeline.submit(room_id, log_data)
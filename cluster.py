@@ -0,0 +1,154 @@
+"""cluster.py - front process plus user-sharded worker processes"""
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from telegram.ext import Updater
+from webhook import WebhookServer, register_webhook
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "1"))
+
+def update_shard_key(update):
+    # Same user -> same worker, so per-user state (conversations, rate
+    # limits, caches) never has to be shared between processes.
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return update.update_id
+
+def _load(factory):
+    module, _, name = factory.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+class Front:
+    # Owns one inbox per worker plus a shared outbox that workers use to
+    # reach each other (e.g. "this room now includes your user"). Events
+    # addressed to shard None are for the front itself and land in .events.
+    def __init__(self, shards, factory):
+        ctx = multiprocessing.get_context("spawn")
+        self.shards = shards
+        self.inboxes = [ctx.Queue() for _ in range(shards)]
+        self.outbox = ctx.Queue()
+        self.processes = [
+            ctx.Process(target=worker_main, args=(i, shards, self.inboxes[i], self.outbox, factory),
+                        name=f"shard-{i}")
+            for i in range(shards)
+        ]
+        self._relay = threading.Thread(target=self._relay_control, name="shard-control", daemon=True)
+        self.events = queue.Queue()
+        self.dispatched = [0] * shards
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self._relay.start()
+
+    def dispatch(self, key, payload):
+        shard = key % self.shards
+        self.inboxes[shard].put(("update", payload))
+        self.dispatched[shard] += 1
+
+    def _relay_control(self):
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                break
+            target, event = message
+            if target is None:
+                self.events.put(event)
+            else:
+                self.inboxes[target].put(("control", event))
+
+    def stop(self, timeout=30):
+        for inbox in self.inboxes:
+            inbox.put(("stop", None))
+        for process in self.processes:
+            process.join(timeout)
+        self.outbox.put(None)
+        self._relay.join(timeout)
+
+def worker_main(index, shards, inbox, outbox, factory):
+    # Shutdown is driven by the front's "stop" message, not by Ctrl+C
+    # reaching the whole process group.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(format=f"%(asctime)s - shard {index} - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(_worker_loop(index, shards, inbox, outbox, factory))
+
+async def _worker_loop(index, shards, inbox, outbox, factory):
+    runner = _load(factory)(index, shards, lambda target, event: outbox.put((target, event)))
+    await runner.start()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def read_inbox():
+        while True:
+            item = inbox.get()
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+            if item[0] == "stop":
+                break
+
+    threading.Thread(target=read_inbox, name="shard-inbox", daemon=True).start()
+    try:
+        while True:
+            kind, payload = await queue.get()
+            if kind == "stop":
+                break
+            try:
+                if kind == "control":
+                    runner.control(payload)
+                else:
+                    await runner.process(payload)
+            except Exception:
+                logger.exception("Shard %d failed to handle %s", index, kind)
+    finally:
+        await runner.stop()
+
+async def run_front(bot, factory, shards=CLUSTER_WORKERS, mode="polling"):
+    # The front only receives updates and routes them; all handlers run in
+    # the workers built by `factory` ("module:callable").
+    front = Front(shards, factory)
+    front.start()
+    updates = asyncio.Queue()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    async def route():
+        while True:
+            update = await updates.get()
+            front.dispatch(update_shard_key(update), update.to_dict())
+
+    router = asyncio.create_task(route())
+    if mode == "webhook":
+        server = WebhookServer(bot, updates)
+        async with bot:
+            await server.start()
+            await register_webhook(bot)
+            try:
+                await stop.wait()
+            finally:
+                await server.stop()
+    else:
+        updater = Updater(bot, updates)
+        async with updater:
+            await updater.start_polling()
+            try:
+                await stop.wait()
+            finally:
+                await updater.stop()
+    while not updates.empty():
+        await asyncio.sleep(0.05)
+    router.cancel()
+    await asyncio.to_thread(front.stop)
+    logger.info("Front stopped; dispatched per shard: %s", front.dispatched)
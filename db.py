@@ -1,18 +1,59 @@
-import os
-from motor.motor_asyncio import AsyncIOMotorClient
+import time
+import zlib
+from bson import Binary, json_util
+from storage import MONGODB_DB, open_backend
+from usercache import cache as user_cache, is_missing
+from metrics import db_calls, instrument_functions
 
-MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-client = AsyncIOMotorClient(MONGODB_URI)
-db = client["anonindochat"]
+# Mongo or the local journal engine (STORAGE_BACKEND); both hand out a
+# Motor-style database, so everything below is backend-agnostic.
+backend = open_backend()
+db = backend.db
 
 async def get_user(user_id):
-    return await db.users.find_one({"user_id": user_id})
+    doc = user_cache.get(user_id)
+    if is_missing(doc):
+        generation = user_cache.generation()
+        doc = await db.users.find_one({"user_id": user_id})
+        user_cache.store(user_id, doc, generation)
+    # Callers get their own copy; the cached one must not be mutated.
+    return dict(doc) if doc else doc
 
 async def get_user_by_username(username):
-    return await db.users.find_one({"username": username})
+    user_id = user_cache.user_id_for(username)
+    if not is_missing(user_id):
+        doc = await get_user(user_id)
+        if doc and doc.get("username") == username:
+            return doc
+    generation = user_cache.generation()
+    doc = await db.users.find_one({"username": username})
+    if doc:
+        user_cache.store(doc["user_id"], doc, generation)
+    return dict(doc) if doc else doc
 
 async def update_user(user_id, updates):
     await db.users.update_one({"user_id": user_id}, {"$set": updates}, upsert=True)
+    user_cache.patch(user_id, updates)
+
+async def downgrade_premium_users(user_ids, now_iso):
+    # Re-checks the expiry, so a renewal that raced the caller survives.
+    # Returns the ids that were actually downgraded.
+    query = {"user_id": {"$in": list(user_ids)}, "is_premium": True, "premium_expiry": {"$lte": now_iso}}
+    expired = [doc["user_id"] async for doc in db.users.find(query, {"user_id": 1})]
+    if expired:
+        query["user_id"] = {"$in": expired}
+        await db.users.update_many(query, {"$set": {"is_premium": False}})
+    for user_id in expired:
+        user_cache.invalidate(user_id)
+    return expired
+
+async def mark_bot_blocked(user_ids):
+    # Users the Bot API refused to message (blocked the bot, deactivated).
+    # Cleared again when they /start.
+    await db.users.update_many({"user_id": {"$in": list(user_ids)}},
+                               {"$set": {"bot_blocked": True, "bot_blocked_at": time.time()}})
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
 
 async def get_room(room_id):
     return await db.rooms.find_one({"room_id": room_id})
@@ -26,14 +67,35 @@ async def insert_room(room_data):
 async def delete_room(room_id):
     await db.rooms.delete_one({"room_id": room_id})
 
+async def close_rooms(room_ids, reason):
+    # Marks many rooms inactive in one write; the documents stay for
+    # /roominfo and chat log retention.
+    await db.rooms.update_many(
+        {"room_id": {"$in": list(room_ids)}, "active": True},
+        {"$set": {"active": False, "closed_at": time.time(), "closed_reason": reason}},
+    )
+
 async def insert_report(report_data):
-    await db.reports.insert_one(report_data)
+    result = await db.reports.insert_one(report_data)
+    return result.inserted_id
+
+async def get_report(report_id):
+    return await db.reports.find_one({"_id": report_id})
+
+async def _bump_blocked_words_version():
+    await db.meta.update_one({"_id": "blocked_words"}, {"$inc": {"version": 1}}, upsert=True)
 
 async def insert_blocked_word(word):
     await db.blocked_words.update_one({"word": word}, {"$set": {"word": word}}, upsert=True)
+    await _bump_blocked_words_version()
 
 async def remove_blocked_word(word):
     await db.blocked_words.delete_one({"word": word})
+    await _bump_blocked_words_version()
+
+async def get_blocked_words_version():
+    doc = await db.meta.find_one({"_id": "blocked_words"})
+    return doc.get("version", 0) if doc else 0
 
 async def get_blocked_words():
     cursor = db.blocked_words.find({})
@@ -42,6 +104,140 @@ async def get_blocked_words():
 async def log_chat(room_id, log_data):
     await db.chatlogs.insert_one({"room_id": room_id, **log_data})
 
+async def insert_chat_logs(entries):
+    await db.chatlogs.insert_many(entries, ordered=False)
+
+HISTORY_SORT = [("timestamp", 1), ("_id", 1)]
+
+# -- archive tier -------------------------------------------------------------
+# retention.py moves closed rooms' logs into chatlog_archives: segments of
+# up to a few thousand entries, zlib-compressed extended JSON (so _id stays
+# an ObjectId). The readers below merge them back in; an entry found in
+# both tiers (an archive pass that died before deleting) is read once.
+
+# Segments fetched per round trip.
+ARCHIVE_BATCH = 4
+
+def _history_key(doc):
+    return (doc.get("timestamp", 0), doc["_id"])
+
+def pack_chat_entries(entries):
+    return Binary(zlib.compress(json_util.dumps(entries).encode("utf-8")))
+
+def unpack_chat_entries(blob):
+    return json_util.loads(zlib.decompress(blob))
+
+async def insert_chat_archive(room_id, entries):
+    # `entries` in history order. Keyed by the first entry, so re-running
+    # an interrupted pass rewrites the same segment.
+    segment = {
+        "_id": f"{room_id}:{entries[0]['_id']}",
+        "room_id": room_id,
+        "first_ts": entries[0].get("timestamp", 0),
+        "last_ts": entries[-1].get("timestamp", 0),
+        "count": len(entries),
+        "data": pack_chat_entries(entries),
+        "archived_at": time.time(),
+    }
+    await db.chatlog_archives.replace_one({"_id": segment["_id"]}, segment, upsert=True)
+    await db.chatlogs.delete_many({"_id": {"$in": [entry["_id"] for entry in entries]}})
+
+async def _archived(room_id, after=None, before=None, descending=False):
+    # The room's archived entries, decompressed one segment at a time, in
+    # history order or newest first. Segments wholly on the far side of
+    # `after`/`before` are skipped by their first_ts/last_ts.
+    query = {"room_id": room_id}
+    if after is not None:
+        query["last_ts"] = {"$gte": after[0]}
+    if before is not None:
+        query["first_ts"] = {"$lte": before[0]}
+    cursor = db.chatlog_archives.find(query).sort("first_ts", -1 if descending else 1).batch_size(ARCHIVE_BATCH)
+    async for segment in cursor:
+        entries = unpack_chat_entries(segment["data"])
+        if descending:
+            entries.reverse()
+        for doc in entries:
+            key = _history_key(doc)
+            if (after is None or key > tuple(after)) and (before is None or key < tuple(before)):
+                yield doc
+
+def _hot(room_id, after=None, before=None, descending=False):
+    # Keyset query on (timestamp, _id) over the hot tier.
+    query = {"room_id": room_id}
+    if after is not None:
+        ts, oid = after
+        query["$or"] = [{"timestamp": {"$gt": ts}}, {"timestamp": ts, "_id": {"$gt": oid}}]
+    elif before is not None:
+        ts, oid = before
+        query["$or"] = [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "_id": {"$lt": oid}}]
+    return db.chatlogs.find(query).sort([(field, -1 if descending else 1) for field, _ in HISTORY_SORT])
+
+async def _merged(archived, hot, descending=False):
+    # Merges the two tiers, each already in the same order. An entry in
+    # both has the same key on both sides and is yielded once.
+    try:
+        a = await anext(archived, None)
+        b = await anext(hot, None)
+        while a is not None or b is not None:
+            if a is not None and b is not None:
+                ka, kb = _history_key(a), _history_key(b)
+                if ka == kb:
+                    b = await anext(hot, None)
+                    continue
+                take_archived = ka > kb if descending else ka < kb
+            else:
+                take_archived = a is not None
+            if take_archived:
+                yield a
+                a = await anext(archived, None)
+            else:
+                yield b
+                b = await anext(hot, None)
+    finally:
+        await archived.aclose()
+
+async def _take(stream, limit):
+    docs = []
+    async for doc in stream:
+        docs.append(doc)
+        if len(docs) >= limit:
+            break
+    await stream.aclose()
+    return docs
+
+async def get_archived_chat(room_id):
+    # The room's archived entries in history order; [] for the usual case
+    # of a room that was never archived (one indexed lookup).
+    return [doc async for doc in _archived(room_id)]
+
+# -- reads over both tiers ------------------------------------------------------
 async def get_chat_history(room_id):
-    cursor = db.chatlogs.find({"room_id": room_id})
-    return [doc async for doc in cursor]
+    return [doc async for doc in iter_chat_history(room_id)]
+
+async def iter_chat_history(room_id, batch_size=500):
+    # Streams a room's log in send order, holding at most one archive
+    # segment and one cursor batch at a time.
+    async for doc in _merged(_archived(room_id), _hot(room_id).batch_size(batch_size)):
+        yield doc
+
+async def get_chat_history_page(room_id, after=None, before=None, limit=20):
+    # Keyset pagination on (timestamp, _id): `after`/`before` are the
+    # (timestamp, _id) of the last/first entry of the neighbouring page, so
+    # deep pages cost the same as the first one, archived or not.
+    descending = before is not None
+    docs = await _take(_merged(_archived(room_id, after, before, descending),
+                               _hot(room_id, after, before, descending).limit(limit), descending), limit)
+    if descending:
+        docs.reverse()
+    return docs
+
+async def get_recent_chat_messages(room_id, limit):
+    docs = await _hot(room_id, descending=True).limit(limit).to_list(limit)
+    if len(docs) < limit:
+        # Short on hot entries; the rest come from the newest segments.
+        docs = await _take(_merged(_archived(room_id, descending=True),
+                                   _hot(room_id, descending=True).limit(limit), True), limit)
+    docs.reverse()
+    return docs
+
+instrument_functions(globals(), db_calls, __name__)
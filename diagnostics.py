@@ -0,0 +1,298 @@
+"""diagnostics.py - slow-update flight recorder and event-loop lag watchdog"""
+import asyncio
+import cProfile
+import contextvars
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from datetime import datetime
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Finished updates slower than this are kept in the recorder.
+SLOW_UPDATE = float(os.getenv("DIAG_SLOW_UPDATE", "0.5"))
+SLOW_KEEP = int(os.getenv("DIAG_SLOW_KEEP", "50"))
+# Updates still running after this long get their task stack sampled.
+SAMPLE_AFTER = float(os.getenv("DIAG_SAMPLE_AFTER", "2.0"))
+MAX_SAMPLES = 3
+LAG_INTERVAL = float(os.getenv("DIAG_LAG_INTERVAL", "0.25"))
+# Loop blocked for this long -> the watchdog thread dumps the stacks.
+LAG_DUMP = float(os.getenv("DIAG_LAG_DUMP", "1.0"))
+STALL_KEEP = 5
+# A slow update starts a cProfile window of PROFILE_SECONDS, at most once
+# per PROFILE_COOLDOWN.
+PROFILE_SECONDS = float(os.getenv("DIAG_PROFILE_SECONDS", "2.0"))
+PROFILE_COOLDOWN = float(os.getenv("DIAG_PROFILE_COOLDOWN", "300"))
+PROFILE_KEEP = 3
+PROFILE_LINES = 25
+MAX_INTAKE = 10000
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def _describe(update):
+    message = getattr(update, "effective_message", None)
+    if getattr(update, "callback_query", None) is not None:
+        return f"callback {update.callback_query.data!r}"[:48]
+    if message is not None:
+        if message.text:
+            return ("command " + message.text.split()[0]) if message.text.startswith("/") else "text"
+        return "media"
+    return type(update).__name__
+
+def task_stack(task):
+    # Task.get_stack() stops at the outermost coroutine; following cr_await
+    # gives the whole chain down to what the task is waiting on.
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(traceback.FrameSummary(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return "".join(traceback.format_list(frames))
+
+class Trace:
+    __slots__ = ("update_id", "user_id", "kind", "intake", "started", "finished", "task",
+                 "db", "db_calls", "api", "api_calls", "handlers", "samples")
+
+    def __init__(self, update, intake):
+        user = getattr(update, "effective_user", None)
+        self.update_id = getattr(update, "update_id", None)
+        self.user_id = user.id if user else None
+        self.kind = _describe(update)
+        self.started = time.monotonic()
+        self.intake = intake or self.started
+        self.finished = None
+        self.task = asyncio.current_task()
+        self.db = self.api = 0.0
+        self.db_calls = self.api_calls = 0
+        self.handlers = []
+        self.samples = []
+
+    def add(self, kind, elapsed):
+        if kind == "db":
+            self.db += elapsed
+            self.db_calls += 1
+        elif kind == "api":
+            self.api += elapsed
+            self.api_calls += 1
+
+    @property
+    def total(self):
+        return (self.finished or time.monotonic()) - self.intake
+
+    def summary(self):
+        queued = self.started - self.intake
+        other = max(0.0, self.total - queued - self.db - self.api)
+        return (f"{self.total:7.2f}s  update {self.update_id} user {self.user_id} {self.kind} "
+                f"[{', '.join(self.handlers) or '-'}]\n"
+                f"          queued {queued:.3f}s  db {self.db:.3f}s ({self.db_calls})  "
+                f"telegram {self.api:.3f}s ({self.api_calls})  other {other:.3f}s")
+
+class FlightRecorder:
+    # Per-update traces live in a context variable, so db.py and Bot API
+    # timings (metrics.Timed, metrics.InstrumentedRequest) are charged to
+    # the update that caused them. Only slow ones are kept.
+    def __init__(self, slow_update=SLOW_UPDATE, keep=SLOW_KEEP):
+        self.slow_update = slow_update
+        self.slow = deque(maxlen=keep)
+        self.stalls = deque(maxlen=STALL_KEEP)
+        self.profiles = deque(maxlen=PROFILE_KEEP)
+        self.running = {}
+        self.lag = deque(maxlen=240)
+        self.stats = {"updates": 0, "slow": 0, "stalls": 0, "max_lag": 0.0}
+        self._intake = OrderedDict()
+        self._loop = None
+        self._loop_thread = None
+        self._heartbeat = 0.0
+        self._monitor = None
+        self._watchdog = None
+        self._stopping = threading.Event()
+        self._profiler = None
+        self._profile_trigger = None
+        self._last_profile = float("-inf")
+
+    # -- update lifecycle -----------------------------------------------------
+    def mark_intake(self, update_id):
+        # Called where updates enter the process (webhook, cluster inbox) so
+        # queueing time shows up; polling updates start at dequeue.
+        self._intake[update_id] = time.monotonic()
+        if len(self._intake) > MAX_INTAKE:
+            self._intake.popitem(last=False)
+
+    def begin(self, update):
+        trace = Trace(update, self._intake.pop(getattr(update, "update_id", None), None))
+        self.running[id(trace)] = trace
+        return trace
+
+    def finish(self, trace):
+        trace.finished = time.monotonic()
+        self.running.pop(id(trace), None)
+        trace.task = None
+        self.stats["updates"] += 1
+        if trace.total >= self.slow_update:
+            self.stats["slow"] += 1
+            self.slow.append(trace)
+            self._maybe_profile(trace)
+
+    # -- loop lag ---------------------------------------------------------------
+    async def start(self):
+        if self._monitor is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopping.clear()
+        self._monitor = asyncio.create_task(self._run_monitor())
+        self._watchdog = threading.Thread(target=self._run_watchdog, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopping.set()
+        if self._monitor is not None:
+            self._monitor.cancel()
+            try:
+                await self._monitor
+            except asyncio.CancelledError:
+                pass
+            self._monitor = None
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=LAG_INTERVAL * 4)
+            self._watchdog = None
+        self._stop_profile()
+
+    @property
+    def last_lag(self):
+        return self.lag[-1] if self.lag else 0.0
+
+    async def _run_monitor(self):
+        while True:
+            expected = time.monotonic() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(0.0, now - expected)
+            self.lag.append(lag)
+            self.stats["max_lag"] = max(self.stats["max_lag"], lag)
+            self._sample_running(now)
+
+    def _sample_running(self, now):
+        for trace in list(self.running.values()):
+            if now - trace.started < SAMPLE_AFTER or len(trace.samples) >= MAX_SAMPLES or trace.task is None:
+                continue
+            if trace.samples and now - trace.samples[-1][0] < SAMPLE_AFTER:
+                continue
+            trace.samples.append((now, now - trace.started, task_stack(trace.task)))
+
+    def _run_watchdog(self):
+        # A thread, because a blocked loop can't report on itself. One dump
+        # per stall: the loop thread's frame (the code that is blocking) and
+        # every task's suspended stack.
+        dumped_for = None
+        while not self._stopping.wait(LAG_INTERVAL):
+            beat = self._heartbeat
+            blocked = time.monotonic() - beat - LAG_INTERVAL
+            if blocked < LAG_DUMP or dumped_for == beat:
+                continue
+            dumped_for = beat
+            try:
+                self._record_stall(blocked)
+            except Exception:
+                logger.exception("Loop watchdog failed to dump stacks")
+
+    def _record_stall(self, blocked):
+        frame = sys._current_frames().get(self._loop_thread)
+        running = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+        tasks = []
+        for _ in range(3):
+            try:
+                # Reading another thread's task set can race a task being
+                # created; just try again.
+                tasks = list(asyncio.all_tasks(self._loop))
+                break
+            except RuntimeError:
+                continue
+        task_stacks = [f"{task.get_name()}:\n{task_stack(task)}" for task in tasks if not task.done()]
+        self.stats["stalls"] += 1
+        self.stalls.append({"at": time.time(), "blocked": blocked, "running": running, "tasks": task_stacks})
+        logger.warning("Event loop blocked for %.2fs; running:\n%s", blocked, running)
+
+    # -- profiling ----------------------------------------------------------------
+    def _maybe_profile(self, trace):
+        now = time.monotonic()
+        if self._profiler is not None or now - self._last_profile < PROFILE_COOLDOWN or self._loop is None:
+            return
+        self._last_profile = now
+        self._profile_trigger = trace.summary().splitlines()[0].strip()
+        self._profiler = cProfile.Profile()
+        try:
+            self._profiler.enable()
+        except ValueError:
+            # Another profiler is already active on this thread.
+            self._profiler = None
+            return
+        self._loop.call_later(PROFILE_SECONDS, self._stop_profile)
+
+    def _stop_profile(self):
+        profiler, self._profiler = self._profiler, None
+        if profiler is None:
+            return
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        self.profiles.append({"at": time.time(), "trigger": self._profile_trigger, "text": out.getvalue()})
+
+    # -- report -------------------------------------------------------------------
+    def report(self, limit=10):
+        lags = sorted(self.lag)
+        lines = [
+            f"Updates: {self.stats['updates']} handled, {self.stats['slow']} over {self.slow_update:.2f}s, "
+            f"{len(self.running)} running",
+            f"Event loop lag: last {self.last_lag * 1000:.0f}ms, "
+            f"p95 {lags[int(len(lags) * 0.95)] * 1000 if lags else 0:.0f}ms, "
+            f"max {self.stats['max_lag'] * 1000:.0f}ms, stalls {self.stats['stalls']}",
+            "",
+        ]
+        running = sorted(self.running.values(), key=lambda t: t.total, reverse=True)[:limit]
+        if running:
+            lines.append("Running now:")
+            lines.extend(trace.summary() for trace in running)
+            lines.append("")
+        slowest = sorted(self.slow, key=lambda t: t.total, reverse=True)[:limit]
+        lines.append(f"Slowest recent updates ({len(self.slow)} kept):" if slowest else "No slow updates recorded.")
+        for trace in slowest:
+            lines.append(trace.summary())
+            for _, after, stack in trace.samples:
+                lines.append(f"          stack after {after:.1f}s:")
+                lines.extend("            " + line for line in stack.rstrip().splitlines())
+        for stall in reversed(self.stalls):
+            at = datetime.utcfromtimestamp(stall["at"]).strftime("%Y-%m-%d %H:%M:%S")
+            lines += ["", f"Loop blocked {stall['blocked']:.2f}s at {at} UTC, running:", stall["running"].rstrip(),
+                      f"Tasks ({len(stall['tasks'])}):"]
+            lines.extend(stall["tasks"])
+        for profile in reversed(self.profiles):
+            at = datetime.utcfromtimestamp(profile["at"]).strftime("%Y-%m-%d %H:%M:%S")
+            lines += ["", f"Profile {PROFILE_SECONDS:g}s at {at} UTC after: {profile['trigger']}",
+                      profile["text"].rstrip()]
+        return "\n".join(lines) + "\n"
+
+recorder = FlightRecorder()
+
+class DiagnosticApplication(Application):
+    # Opens a trace around each update, covering every handler group.
+    async def process_update(self, update):
+        trace = recorder.begin(update)
+        token = current_trace.set(trace)
+        try:
+            await super().process_update(update)
+        finally:
+            current_trace.reset(token)
+            recorder.finish(trace)
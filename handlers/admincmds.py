@@ -1,6 +1,11 @@
 from telegram import Update
 from admin import block_user, unblock_user, send_admin_message, get_stats, add_blocked_word, remove_blocked_word, approve_premium
-from db import get_user, get_user_by_username, get_room, get_chat_history
+from bson import ObjectId
+from db import get_user, get_user_by_username, get_room, get_report
+from history import render_page, render_excerpt, export_history, parse_callback
+from diagnostics import recorder
+from admin_mirror import profile_photos
+from broadcast import broadcaster, parse_segment, progress_text
 
 def _is_admin(update, context):
     ADMIN_ID = context.bot_data.get("ADMIN_ID")
@@ -69,13 +74,68 @@ async def admin_message(update: Update, context):
     else:
         await update.message.reply_text("Failed to send message.")
 
+BROADCAST_USAGE = (
+    "Usage:\n/broadcast <segment> <text>, or reply to a message with /broadcast <segment> to send a copy of it\n"
+    "/broadcast status | cancel <id> | resume <id>\n"
+    "Segments: all, premium, free, gender=, region=, country=, language=; combine with commas, "
+    "e.g. premium,region=North_America"
+)
+
+async def admin_broadcast(update: Update, context):
+    if not _is_admin(update, context):
+        await update.message.reply_text("Unauthorized.")
+        return
+    args = context.args
+    if not args:
+        await update.message.reply_text(BROADCAST_USAGE)
+        return
+    if args[0] == "status":
+        docs = await broadcaster.recent()
+        lines = [broadcaster.progress(doc["_id"]) or progress_text(doc) for doc in docs]
+        await update.message.reply_text("\n\n".join(lines) or "No broadcasts yet.")
+        return
+    if args[0] == "cancel" and len(args) == 2:
+        if await broadcaster.cancel(args[1]):
+            await update.message.reply_text(f"Broadcast {args[1]} cancelled.")
+        else:
+            await update.message.reply_text(f"No running broadcast {args[1]}.")
+        return
+    if args[0] == "resume" and len(args) == 2:
+        if await broadcaster.resume(args[1]):
+            await update.message.reply_text(f"Broadcast {args[1]} resumed.")
+        else:
+            await update.message.reply_text(f"No cancelled broadcast {args[1]}.")
+        return
+    segment = args[0]
+    try:
+        parse_segment(segment)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\n{BROADCAST_USAGE}")
+        return
+    reply = update.message.reply_to_message
+    if reply is not None:
+        content = {"from_chat_id": reply.chat_id, "message_id": reply.message_id}
+    elif len(args) > 1:
+        content = {"text": " ".join(args[1:])}
+    else:
+        await update.message.reply_text(BROADCAST_USAGE)
+        return
+    # The reply that follows is the progress message, edited as it goes.
+    await broadcaster.create(segment, content, update.effective_chat.id, context.bot_data.get("SHARD", 0))
+
 async def admin_stats(update: Update, context):
     if not _is_admin(update, context):
         await update.message.reply_text("Unauthorized.")
         return
     stats = await get_stats()
     await update.message.reply_text(
-        f"Stats:\nUsers: {stats['users']}\nRooms: {stats['rooms']}\nReports: {stats['reports']}"
+        f"Stats:\nUsers: {stats['users']}\nRooms: {stats['rooms']}\nReports: {stats['reports']}\n"
+        f"User cache: {stats['user_cache']['hits']} hits / {stats['user_cache']['misses']} misses, "
+        f"{stats['user_cache']['size']} cached\n"
+        f"Matchmaking: {stats['matchmaking']['waiting']} waiting, "
+        f"{stats['matchmaking']['matches_per_minute']} matches/min, "
+        f"wait p50 {stats['matchmaking']['wait_p50']:.1f}s / p95 {stats['matchmaking']['wait_p95']:.1f}s, "
+        f"longest {stats['matchmaking']['longest_waiting']:.0f}s"
     )
 
 async def admin_blockword(update: Update, context):
@@ -113,9 +173,9 @@ async def admin_userinfo(update: Update, context):
         f"Gender: {user.get('gender','')}\nRegion: {user.get('region','')}\nCountry: {user.get('country','')}\n"
         f"Premium: {user.get('is_premium', False)}"
     )
-    await update.message.reply_text(txt)
-    for pid in user.get('profile_photos', []):
-        await context.bot.send_photo(chat_id=update.effective_chat.id, photo=pid)
+    notes, album = profile_photos.prepare(update.effective_chat.id, [user])
+    await update.message.reply_text("\n".join([txt, *notes]))
+    profile_photos.post(context.bot, update.effective_chat.id, album)
 
 async def admin_roominfo(update: Update, context):
     if not _is_admin(update, context):
@@ -125,6 +185,7 @@ async def admin_roominfo(update: Update, context):
     room = await get_room(room_id)
     if room:
         users_info = []
+        users = []
         for uid in room["users"]:
             u = await get_user(uid)
             if u:
@@ -135,9 +196,10 @@ async def admin_roominfo(update: Update, context):
                     f"Premium: {u.get('is_premium', False)}"
                 )
                 users_info.append(txt)
-                for pid in u.get('profile_photos', []):
-                    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=pid)
-        await update.message.reply_text(f"RoomID: {room['room_id']}\nUsers:\n" + "\n---\n".join(users_info))
+                users.append(u)
+        notes, album = profile_photos.prepare(update.effective_chat.id, users)
+        await update.message.reply_text(f"RoomID: {room['room_id']}\nUsers:\n" + "\n---\n".join(users_info + notes))
+        profile_photos.post(context.bot, update.effective_chat.id, album)
     else:
         await update.message.reply_text("Room not found.")
 
@@ -146,8 +208,75 @@ async def admin_viewhistory(update: Update, context):
         await update.message.reply_text("Unauthorized.")
         return
     room_id = context.args[0]
-    history = await get_chat_history(room_id)
-    if history:
-        await update.message.reply_text("\n".join([str(msg) for msg in history]))
+    text, markup = await render_page(room_id)
+    if text:
+        await update.message.reply_text(text, reply_markup=markup)
     else:
         await update.message.reply_text("No chat history found.")
+
+async def admin_exporthistory(update: Update, context):
+    if not _is_admin(update, context):
+        await update.message.reply_text("Unauthorized.")
+        return
+    await _send_export(context.bot, update.effective_chat.id, context.args[0])
+
+async def admin_diag(update: Update, context):
+    # Flight recorder report for this process (in cluster mode, the shard
+    # that handles the admin's updates).
+    if not _is_admin(update, context):
+        await update.message.reply_text("Unauthorized.")
+        return
+    report = recorder.report()
+    if len(report) <= 4000:
+        await update.message.reply_text(report)
+    else:
+        await context.bot.send_document(update.effective_chat.id, document=report.encode(),
+                                        filename="diag.txt", caption="Diagnostics report")
+
+async def _send_export(bot, chat_id, room_id):
+    out, count = await export_history(room_id)
+    try:
+        if not count:
+            await bot.send_message(chat_id, "No chat history found.")
+            return
+        await bot.send_document(chat_id, document=out, filename=f"room_{room_id}.ndjson.gz",
+                                caption=f"Room {room_id}: {count} messages")
+    finally:
+        out.close()
+
+async def history_page_cb(update: Update, context):
+    query = update.callback_query
+    if not _is_admin(update, context):
+        await query.answer("Unauthorized.")
+        return
+    await query.answer()
+    kind, room_id, position = parse_callback(query.data)
+    if kind == "hx":
+        await _send_export(context.bot, query.message.chat_id, room_id)
+        return
+    if kind == "hs":
+        text, markup = await render_page(room_id)
+        if text:
+            await context.bot.send_message(query.message.chat_id, text, reply_markup=markup)
+        else:
+            await context.bot.send_message(query.message.chat_id, "No chat history found.")
+        return
+    if kind == "hn":
+        text, markup = await render_page(room_id, after=position)
+    else:
+        text, markup = await render_page(room_id, before=position)
+    if text:
+        await query.edit_message_text(text, reply_markup=markup)
+
+async def report_excerpt_cb(update: Update, context):
+    query = update.callback_query
+    if not _is_admin(update, context):
+        await query.answer("Unauthorized.")
+        return
+    await query.answer()
+    report_id = query.data.split(":", 1)[1]
+    report = await get_report(ObjectId(report_id)) if ObjectId.is_valid(report_id) else None
+    if not report:
+        await context.bot.send_message(query.message.chat_id, "Report not found.")
+        return
+    await context.bot.send_message(query.message.chat_id, render_excerpt(report))
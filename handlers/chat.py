@@ -1,40 +1,35 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from db import get_room, update_room, log_chat, get_blocked_words
+from chatlog import log_chat
+from rooms import room_of, partner_of
+from moderation import find_blocked_word
+from ratelimit import limiter, RATE_LIMIT_TEXT
+from outbound import dispatcher, RELAY
+from handlers.message_router import on_delivery_failure
 import time
 
-user_rate_limit = {}
-
 async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
-    room_id = context.bot_data.get("user_room_map", {}).get(user_id)
+    room_id = room_of(user_id)
     if not room_id:
         await update.message.reply_text("Not in a room. Use /find to start a chat.")
         return
-    blocked_words = await get_blocked_words()
-    for word in blocked_words:
-        if word.lower() in text.lower():
-            await update.message.reply_text("Your message contains a blocked word. Please be respectful.")
-            return
+    if find_blocked_word(text):
+        await update.message.reply_text("Your message contains a blocked word. Please be respectful.")
+        return
+    if not limiter.allow(user_id, "text"):
+        await update.message.reply_text(RATE_LIMIT_TEXT)
+        return
     now = time.time()
-    last_time = user_rate_limit.get(user_id, 0)
-    if now - last_time < 2.0:
-        await update.message.reply_text("Rate limit: Please wait before sending another message.")
+    other_id = partner_of(user_id)
+    if not other_id:
+        await update.message.reply_text("Your chat partner is not available.")
         return
-    user_rate_limit[user_id] = now
-    await log_chat(room_id, {
+    relay = dispatcher.post(RELAY, context.bot.send_message, chat_id=other_id, text=text)
+    relay.add_done_callback(on_delivery_failure(context.bot, room_id, other_id, user_id))
+    log_chat(room_id, {
         "user_id": user_id,
         "text": text,
         "timestamp": now
     })
-    room = await get_room(room_id)
-    if not room or "users" not in room:
-        await update.message.reply_text("Chat room error. Please use /find again.")
-        return
-    other_id = [uid for uid in room["users"] if uid != user_id]
-    if not other_id:
-        await update.message.reply_text("Your chat partner is not available.")
-        return
-    other_id = other_id[0]
-    await context.bot.send_message(chat_id=other_id, text=text)
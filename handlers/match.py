@@ -1,8 +1,10 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ConversationHandler, CommandHandler, CallbackQueryHandler
-from db import get_user, get_room, delete_room
-from rooms import add_to_pool, remove_from_pool, users_online, create_room, close_room
-import random
+from db import get_user, delete_room
+from rooms import request_match, create_room, close_room, directory, room_of, partner_of
+from outbound import dispatcher, NOTICE, ADMIN
+from admin_mirror import profile_photos
+from handlers.message_router import on_delivery_failure
 
 SELECT_FILTER, SELECT_GENDER, SELECT_REGION, SELECT_COUNTRY, SELECT_LANGUAGE, CONFIRM_SEARCH = range(6)
 REGIONS = ['Africa', 'Europe', 'Asia', 'North America', 'South America', 'Oceania', 'Antarctica']
@@ -10,15 +12,33 @@ COUNTRIES = ['Indonesia', 'Malaysia', 'India', 'Russia', 'Arab', 'USA', 'Iran',
 GENDERS = ['male', 'female', 'other']
 LANGUAGES = ['en', 'ar', 'hi', 'id']
 
+# Markups are immutable, so the same objects are reused for every reply.
+FILTER_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Filter by Gender", callback_data="filter_gender")],
+    [InlineKeyboardButton("Filter by Region", callback_data="filter_region")],
+    [InlineKeyboardButton("Filter by Country", callback_data="filter_country")],
+    [InlineKeyboardButton("Filter by Language", callback_data="filter_language")],
+    [InlineKeyboardButton("Proceed to Search", callback_data="filter_none")],
+    [InlineKeyboardButton("Back", callback_data="back")]
+])
+GENDER_FILTER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Male", callback_data="gender_male"),
+     InlineKeyboardButton("Female", callback_data="gender_female"),
+     InlineKeyboardButton("Other", callback_data="gender_other")],
+    [InlineKeyboardButton("Back", callback_data="back")]
+])
+REGION_FILTER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(region, callback_data=f"region_{region}")] for region in REGIONS
+] + [[InlineKeyboardButton("Back", callback_data="back")]])
+COUNTRY_FILTER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(country, callback_data=f"country_{country}")] for country in COUNTRIES
+] + [[InlineKeyboardButton("Back", callback_data="back")]])
+LANGUAGE_FILTER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(lang.upper(), callback_data=f"language_{lang}")] for lang in LANGUAGES
+] + [[InlineKeyboardButton("Back", callback_data="back")]])
+
 def get_filter_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Filter by Gender", callback_data="filter_gender")],
-        [InlineKeyboardButton("Filter by Region", callback_data="filter_region")],
-        [InlineKeyboardButton("Filter by Country", callback_data="filter_country")],
-        [InlineKeyboardButton("Filter by Language", callback_data="filter_language")],
-        [InlineKeyboardButton("Proceed to Search", callback_data="filter_none")],
-        [InlineKeyboardButton("Back", callback_data="back")]
-    ])
+    return FILTER_MENU
 
 async def open_filter_menu(update, context):
     user_id = update.effective_user.id
@@ -58,31 +78,16 @@ async def select_filter_cb(update, context):
     chat_id = query.message.chat_id
     data = query.data
     if data == "filter_gender":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Male", callback_data="gender_male"),
-             InlineKeyboardButton("Female", callback_data="gender_female"),
-             InlineKeyboardButton("Other", callback_data="gender_other")],
-            [InlineKeyboardButton("Back", callback_data="back")]
-        ])
-        await query.edit_message_text("Select preferred gender:", reply_markup=kb)
+        await query.edit_message_text("Select preferred gender:", reply_markup=GENDER_FILTER_KEYBOARD)
         return SELECT_GENDER
     if data == "filter_region":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(region, callback_data=f"region_{region}")] for region in REGIONS
-        ] + [[InlineKeyboardButton("Back", callback_data="back")]])
-        await query.edit_message_text("Select preferred region:", reply_markup=kb)
+        await query.edit_message_text("Select preferred region:", reply_markup=REGION_FILTER_KEYBOARD)
         return SELECT_REGION
     if data == "filter_country":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(country, callback_data=f"country_{country}")] for country in COUNTRIES
-        ] + [[InlineKeyboardButton("Back", callback_data="back")]])
-        await query.edit_message_text("Select preferred country:", reply_markup=kb)
+        await query.edit_message_text("Select preferred country:", reply_markup=COUNTRY_FILTER_KEYBOARD)
         return SELECT_COUNTRY
     if data == "filter_language":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(lang.upper(), callback_data=f"language_{lang}")] for lang in LANGUAGES
-        ] + [[InlineKeyboardButton("Back", callback_data="back")]])
-        await query.edit_message_text("Select preferred language:", reply_markup=kb)
+        await query.edit_message_text("Select preferred language:", reply_markup=LANGUAGE_FILTER_KEYBOARD)
         return SELECT_LANGUAGE
     if data == "filter_none":
         return await do_search(update, context)
@@ -110,19 +115,6 @@ async def select_filter_cb(update, context):
         await query.edit_message_text(f"Language filter set: {language}.", reply_markup=get_filter_menu())
         return SELECT_FILTER
 
-async def set_users_room_map(context, user1, user2, room_id):
-    if "user_room_map" not in context.bot_data:
-        context.bot_data["user_room_map"] = {}
-    context.bot_data["user_room_map"][user1] = room_id
-    context.bot_data["user_room_map"][user2] = room_id
-
-async def remove_users_room_map(context, user1, user2=None):
-    if "user_room_map" not in context.bot_data:
-        return
-    context.bot_data["user_room_map"].pop(user1, None)
-    if user2 is not None:
-        context.bot_data["user_room_map"].pop(user2, None)
-
 def get_admin_room_meta(room, user1, user2, users_data):
     def meta(u):
         return (
@@ -134,6 +126,24 @@ def get_admin_room_meta(room, user1, user2, users_data):
           f"👤 User2:\n{meta(users_data[1])}\n"
     return txt
 
+async def start_match(bot, bot_data, user_id, partner):
+    # Opens the room and tells both users and the admin group. Used for
+    # immediate matches and for pairs made by the matchmaker's ticks.
+    room_id = await create_room(user_id, partner)
+    for uid in (user_id, partner):
+        notice = dispatcher.post(NOTICE, bot.send_message, chat_id=uid, text="🎉 Match found! Say hi to your partner.")
+        notice.add_done_callback(on_delivery_failure(bot, room_id, uid))
+    admin_group = bot_data.get('ADMIN_GROUP_ID')
+    if admin_group:
+        # Queued behind user traffic; the match doesn't wait for the group.
+        users = [await get_user(user_id), await get_user(partner)]
+        room = directory.get(room_id)
+        notes, album = profile_photos.prepare(admin_group, users)
+        txt = "\n".join([get_admin_room_meta(room, user_id, partner, users), *notes])
+        dispatcher.post(ADMIN, bot.send_message, chat_id=admin_group, text=txt)
+        profile_photos.post(bot, admin_group, album)
+    return room_id
+
 async def find_command(update, context):
     # update can be Message or CallbackQuery, so get chat_id correctly
     if hasattr(update, "effective_chat"):
@@ -147,55 +157,32 @@ async def find_command(update, context):
         await context.bot.send_message(chat_id, "Please setup your profile first with /profile.")
         return
 
-    if user_id in context.bot_data.get("user_room_map", {}):
+    if room_of(user_id):
         await context.bot.send_message(chat_id, "You are already in a chat. Use /end or /next to leave first.")
         return
 
-    candidates = [uid for uid in users_online if uid != user_id]
-    if candidates:
-        partner = random.choice(candidates)
-        remove_from_pool(partner)
-        room_id = await create_room(user_id, partner)
-        await set_users_room_map(context, user_id, partner, room_id)
-        remove_from_pool(user_id)
-        await context.bot.send_message(chat_id, "🎉 Match found! Say hi to your partner.")
-        await context.bot.send_message(partner, "🎉 Match found! Say hi to your partner.")
-        partner_obj = await get_user(partner)
-        admin_group = context.bot_data.get('ADMIN_GROUP_ID')
-        if admin_group:
-            room = await get_room(room_id)
-            txt = get_admin_room_meta(room, user_id, partner, [user, partner_obj])
-            await context.bot.send_message(chat_id=admin_group, text=txt)
-            for u in [user, partner_obj]:
-                for pid in u.get('profile_photos', []):
-                    await context.bot.send_photo(chat_id=admin_group, photo=pid)
+    partner = await request_match(user_id, user, user.get("matching_preferences"))
+    if partner:
+        await start_match(context.bot, context.bot_data, user_id, partner)
     else:
-        add_to_pool(user_id)
-        await context.bot.send_message(chat_id, "You have been added to the finding pool! Wait for a match.")
+        # Posted so it stays behind /next's "You have left the chat."
+        dispatcher.post(NOTICE, context.bot.send_message, chat_id=chat_id,
+                        text="You have been added to the finding pool! Wait for a match.")
 
 async def end_command(update, context):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    user_room_map = context.bot_data.get("user_room_map", {})
-    room_id = user_room_map.get(user_id)
+    room_id = room_of(user_id)
     if not room_id:
         await context.bot.send_message(chat_id, "You are not in a room.")
         return
-    room = await get_room(room_id)
-    other_id = None
-    if room and "users" in room:
-        for uid in room["users"]:
-            context.bot_data["user_room_map"].pop(uid, None)
-            if uid != user_id:
-                other_id = uid
+    other_id = partner_of(user_id)
     await close_room(room_id)
     await delete_room(room_id)
-    await context.bot.send_message(chat_id, "You have left the chat.")
+    dispatcher.post(NOTICE, context.bot.send_message, chat_id=chat_id, text="You have left the chat.")
     if other_id:
-        try:
-            await context.bot.send_message(other_id, "Your chat partner has left the chat.")
-        except Exception:
-            pass
+        dispatcher.post(NOTICE, context.bot.send_message, chat_id=other_id,
+                        text="Your chat partner has left the chat.")
 
 async def next_command(update, context):
     await end_command(update, context)
@@ -203,49 +190,23 @@ async def next_command(update, context):
 
 async def do_search(update, context):
     query = update.callback_query
+    user_id = query.from_user.id
     filters = context.user_data.get("search_filters", {})
-    from db import get_user
-    candidates = []
-    for uid in users_online:
-        if uid == query.from_user.id:
-            continue
-        u = await get_user(uid)
-        if not u:
-            continue
-        ok = True
-        if filters.get("gender") and u.get("gender") != filters["gender"]:
-            ok = False
-        if filters.get("region") and u.get("region") != filters["region"]:
-            ok = False
-        if filters.get("country") and u.get("country") != filters["country"]:
-            ok = False
-        if filters.get("language") and u.get("language") != filters["language"]:
-            ok = False
-        if ok:
-            candidates.append(uid)
-    if not candidates:
-        await query.edit_message_text("No users found matching your criteria. Try again later.", reply_markup=get_filter_menu())
+    if room_of(user_id):
+        await query.edit_message_text("You are already in a chat. Use /end or /next to leave first.")
         return ConversationHandler.END
-    partner = random.choice(candidates)
-    users_online.discard(query.from_user.id)
-    users_online.discard(partner)
-    room_id = await create_room(query.from_user.id, partner)
-    await set_users_room_map(context, query.from_user.id, partner, room_id)
-    await query.edit_message_text("🎉 Match found! Say hi to your partner.")
-    await context.bot.send_message(partner, "🎉 Match found! Say hi to your partner.")
-    user1 = await get_user(query.from_user.id)
-    user2 = await get_user(partner)
-    admin_group = context.bot_data.get('ADMIN_GROUP_ID')
-    if admin_group:
-        room = await get_room(room_id)
-        txt = get_admin_room_meta(room, query.from_user.id, partner, [user1, user2])
-        await context.bot.send_message(chat_id=admin_group, text=txt)
-        for u in [user1, user2]:
-            for pid in u.get('profile_photos', []):
-                await context.bot.send_photo(chat_id=admin_group, photo=pid)
+    user = await get_user(user_id)
+    partner = await request_match(user_id, user, filters)
+    if partner:
+        await query.edit_message_text("🎉 Match found!")
+        await start_match(context.bot, context.bot_data, user_id, partner)
+    else:
+        await query.edit_message_text("Searching with your filters. You'll be notified when a match is found.")
     return ConversationHandler.END
 
 search_conv = ConversationHandler(
+    name="search_conv",
+    persistent=True,
     entry_points=[CommandHandler('searchmypreferences', open_filter_menu)],
     states={
         SELECT_FILTER: [CallbackQueryHandler(select_filter_cb, pattern="^filter_"), CallbackQueryHandler(select_filter_cb, pattern="^back$")],
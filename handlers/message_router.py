@@ -1,33 +1,80 @@
 from telegram import Update
-from db import get_room, log_chat, get_blocked_words, get_user
+from telegram.error import Forbidden
+from chatlog import log_chat
+from db import mark_bot_blocked
+from rooms import room_of, partner_of, close_room, directory
+from moderation import find_blocked_word
 from handlers.forward import forward_to_admin
+from ratelimit import limiter, message_kind, RATE_LIMIT_TEXT
+from outbound import dispatcher, RELAY, NOTICE
+import asyncio
+import logging
 import time
 
-user_rate_limit = {}
+logger = logging.getLogger(__name__)
+
+DELIVERY_FAILED_TEXT = "Failed to deliver message to partner."
+PARTNER_GONE_TEXT = "Your chat partner can no longer be reached, so the chat was closed. Use /find to meet someone new."
+
+async def partner_unreachable(bot, room_id, user_id):
+    # user_id blocked the bot (or deleted their account): the room is
+    # closed and whoever is left is told. Later failures for the same room
+    # find it already closed.
+    room = directory.get(room_id)
+    if room is None or room_of(user_id) != room_id:
+        return
+    others = [uid for uid in room["users"] if uid != user_id]
+    await close_room(room_id)
+    await mark_bot_blocked([user_id])
+    for other_id in others:
+        dispatcher.post(NOTICE, bot.send_message, chat_id=other_id, text=PARTNER_GONE_TEXT)
+
+def _partner_unreachable_later(bot, room_id, user_id):
+    async def run():
+        try:
+            await partner_unreachable(bot, room_id, user_id)
+        except Exception:
+            logger.exception("Closing room %s after user %s became unreachable failed", room_id, user_id)
+    asyncio.create_task(run())
+
+def on_delivery_failure(bot, room_id, recipient_id, sender_id=None):
+    # Done callback for sends posted to a room member. The handler has
+    # moved on by the time a send fails, so the outcome is dealt with here:
+    # a Forbidden closes the room, anything else tells the sender.
+    def callback(future):
+        if future.cancelled() or future.exception() is None:
+            return
+        if isinstance(future.exception(), Forbidden):
+            _partner_unreachable_later(bot, room_id, recipient_id)
+        elif sender_id is not None:
+            dispatcher.post(NOTICE, bot.send_message, chat_id=sender_id, text=DELIVERY_FAILED_TEXT)
+    return callback
 
 async def route_message(update: Update, context):
     user_id = update.effective_user.id
     message = update.message
-    room_id = context.bot_data.get("user_room_map", {}).get(user_id)
+    room_id = room_of(user_id)
     admin_group = context.bot_data.get("ADMIN_GROUP_ID")
 
-    blocked_words = await get_blocked_words()
     text = message.text or message.caption or ""
-    for word in blocked_words:
-        if word.lower() in text.lower():
-            await message.reply_text("Your message contains a blocked word. Please be respectful.")
-            return
+    if find_blocked_word(text):
+        await message.reply_text("Your message contains a blocked word. Please be respectful.")
+        return
 
-    now = time.time()
-    last_time = user_rate_limit.get(user_id, 0)
-    if now - last_time < 1.5:
-        await message.reply_text("Rate limit: Please wait before sending another message.")
+    if not limiter.allow(user_id, message_kind(message)):
+        await message.reply_text(RATE_LIMIT_TEXT)
         return
-    user_rate_limit[user_id] = now
+    now = time.time()
 
     # If user is in a room, forward to partner and admin group, also log chat
     if room_id:
-        await log_chat(room_id, {
+        other_id = partner_of(user_id)
+        if not other_id:
+            await message.reply_text("Your chat partner is not available.")
+            return
+        relay = dispatcher.post(RELAY, message.copy, chat_id=other_id)
+        relay.add_done_callback(on_delivery_failure(context.bot, room_id, other_id, user_id))
+        log_chat(room_id, {
             "user_id": user_id,
             "content_type": (
                 message.effective_attachment.__class__.__name__
@@ -36,19 +83,6 @@ async def route_message(update: Update, context):
             "text": text,
             "timestamp": now
         })
-        room = await get_room(room_id)
-        if not room or "users" not in room:
-            await message.reply_text("Chat room error. Please use /find again.")
-            return
-        other_id = [uid for uid in room["users"] if uid != user_id]
-        if not other_id:
-            await message.reply_text("Your chat partner is not available.")
-            return
-        other_id = other_id[0]
-        try:
-            await message.copy(chat_id=other_id)
-        except Exception:
-            await message.reply_text("Failed to deliver message to partner.")
         if admin_group:
             await forward_to_admin(update, context)
     else:
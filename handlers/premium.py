@@ -1,6 +1,7 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from db import get_user
 from admin import approve_premium
+from outbound import dispatcher, NOTICE, ADMIN
 
 async def start_upgrade(update: Update, context):
     await update.message.reply_text('Please upload payment proof (photo, screenshot, or document)')
@@ -11,9 +12,10 @@ async def handle_proof(update: Update, context):
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton('Approve', callback_data=f'approve:{user.id}'), InlineKeyboardButton('Decline', callback_data=f'decline:{user.id}')]
     ])
-    await context.bot.send_message(chat_id=admin_group, text=f'Payment proof from user {user.id}', reply_markup=kb)
+    # Same chat, so the copy stays right after its header.
+    dispatcher.post(ADMIN, context.bot.send_message, chat_id=admin_group, text=f'Payment proof from user {user.id}', reply_markup=kb)
     if update.message.photo or update.message.document:
-        await context.bot.copy_message(chat_id=admin_group, from_chat_id=update.effective_chat.id, message_id=update.message.message_id)
+        dispatcher.post(ADMIN, context.bot.copy_message, chat_id=admin_group, from_chat_id=update.effective_chat.id, message_id=update.message.message_id)
     await update.message.reply_text('Proof sent to admins for review.')
 
 async def admin_callback(update: Update, context):
@@ -25,14 +27,8 @@ async def admin_callback(update: Update, context):
     uid = int(uid)
     if action == 'approve':
         expiry = await approve_premium(uid)
-        try:
-            await context.bot.send_message(chat_id=uid, text=f'You are premium until {expiry}')
-        except Exception:
-            pass
+        dispatcher.post(NOTICE, context.bot.send_message, chat_id=uid, text=f'You are premium until {expiry}')
         await query.edit_message_text(f'Approved user {uid}')
     else:
         await query.edit_message_text(f'Declined user {uid}')
-        try:
-            await context.bot.send_message(chat_id=uid, text='Your request was declined.')
-        except Exception:
-            pass
+        dispatcher.post(NOTICE, context.bot.send_message, chat_id=uid, text='Your request was declined.')
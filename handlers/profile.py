@@ -2,24 +2,33 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ConversationHandler
 from db import get_user, update_user
 from models import default_user
+from admin_mirror import profile_photos
+import i18n
 
 ASK_GENDER, ASK_REGION, ASK_COUNTRY, PROFILE_MENU = range(4)
 
 REGIONS = ['Africa', 'Europe', 'Asia', 'North America', 'South America', 'Oceania', 'Antarctica']
 COUNTRIES = ['Indonesia', 'Malaysia', 'India', 'Russia', 'Arab', 'USA', 'Iran', 'Nigeria', 'Brazil', 'Turkey']
 
+# Markups are immutable, so the same objects are reused for every reply.
+GENDER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton('Male', callback_data='gender_male'), InlineKeyboardButton('Female', callback_data='gender_female')],
+    [InlineKeyboardButton('Other', callback_data='gender_other'), InlineKeyboardButton('Skip', callback_data='gender_skip')],
+    [InlineKeyboardButton("Back", callback_data="menu_back")]
+])
+REGION_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(region, callback_data=f"region_{region}")] for region in REGIONS
+] + [[InlineKeyboardButton("Back", callback_data="menu_back")]])
+COUNTRY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(country, callback_data=f"country_{country}")] for country in COUNTRIES
+] + [[InlineKeyboardButton("Back", callback_data="menu_back")]])
+
 async def start_profile(update: Update, context):
     user = update.effective_user
     existing = await get_user(user.id)
     if existing:
         prof = existing
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Edit Profile", callback_data="menu_edit_profile")],
-            [InlineKeyboardButton("Find", callback_data="menu_find")],
-            [InlineKeyboardButton("Upgrade", callback_data="menu_upgrade")],
-            [InlineKeyboardButton("Filters", callback_data="menu_filter")],
-            [InlineKeyboardButton("Back", callback_data="menu_back")]
-        ])
+        kb = i18n.keyboard("main_menu", "en")
         txt = f"Your Profile:\nGender: {prof.get('gender','')}\nRegion: {prof.get('region','')}\nCountry: {prof.get('country','')}"
         await update.message.reply_text(txt, reply_markup=kb)
         return PROFILE_MENU
@@ -28,29 +37,19 @@ async def start_profile(update: Update, context):
     try:
         user_photos = await context.bot.get_user_profile_photos(user.id)
         for photo in user_photos.photos[:3]:
-            photos.append(photo[-1].file_id)
+            photos.append({"file_id": photo[-1].file_id, "file_unique_id": photo[-1].file_unique_id})
     except Exception:
         pass
     profdata["profile_photos"] = photos
     await update_user(user.id, profdata)
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton('Male', callback_data='gender_male'), InlineKeyboardButton('Female', callback_data='gender_female')],
-        [InlineKeyboardButton('Other', callback_data='gender_other'), InlineKeyboardButton('Skip', callback_data='gender_skip')],
-        [InlineKeyboardButton("Back", callback_data="menu_back")]
-    ])
-    await update.message.reply_text('Select your gender:', reply_markup=kb)
+    await update.message.reply_text('Select your gender:', reply_markup=GENDER_KEYBOARD)
     return ASK_GENDER
 
 async def profile_menu(update: Update, context):
     query = update.callback_query
     await query.answer()
     if query.data == "menu_edit_profile":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton('Male', callback_data='gender_male'), InlineKeyboardButton('Female', callback_data='gender_female')],
-            [InlineKeyboardButton('Other', callback_data='gender_other'), InlineKeyboardButton('Skip', callback_data='gender_skip')],
-            [InlineKeyboardButton("Back", callback_data="menu_back")]
-        ])
-        await query.edit_message_text('Select your gender:', reply_markup=kb)
+        await query.edit_message_text('Select your gender:', reply_markup=GENDER_KEYBOARD)
         return ASK_GENDER
     if query.data == "menu_find":
         from handlers.match import find_command
@@ -75,10 +74,7 @@ async def gender_cb(update: Update, context):
     gender = query.data.split('_', 1)[1]
     if gender != "skip":
         await update_user(query.from_user.id, {"gender": gender})
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(region, callback_data=f"region_{region}")] for region in REGIONS
-    ] + [[InlineKeyboardButton("Back", callback_data="menu_back")]])
-    await query.edit_message_text('Gender saved. Now select your region:', reply_markup=kb)
+    await query.edit_message_text('Gender saved. Now select your region:', reply_markup=REGION_KEYBOARD)
     return ASK_REGION
 
 async def region_cb(update: Update, context):
@@ -86,10 +82,7 @@ async def region_cb(update: Update, context):
     await query.answer()
     region = query.data.split('_', 1)[1]
     await update_user(query.from_user.id, {"region": region})
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(country, callback_data=f"country_{country}")] for country in COUNTRIES
-    ] + [[InlineKeyboardButton("Back", callback_data="menu_back")]])
-    await query.edit_message_text('Region saved. Now select your country:', reply_markup=kb)
+    await query.edit_message_text('Region saved. Now select your country:', reply_markup=COUNTRY_KEYBOARD)
     return ASK_COUNTRY
 
 async def country_cb(update: Update, context):
@@ -107,9 +100,9 @@ async def country_cb(update: Update, context):
     )
     await query.edit_message_text('Profile saved! You can now use the chat.')
     if admin_group:
-        await context.bot.send_message(chat_id=admin_group, text=profile_text)
-        for file_id in user.get('profile_photos', []):
-            await context.bot.send_photo(chat_id=admin_group, photo=file_id)
+        notes, album = profile_photos.prepare(admin_group, [user])
+        await context.bot.send_message(chat_id=admin_group, text="\n".join([profile_text, *notes]))
+        profile_photos.post(context.bot, admin_group, album)
     from bot import main_menu
     await main_menu(update, context)
     return
@@ -1,23 +1,31 @@
-import time
-from telegram import Update
-from db import get_room, get_chat_history, insert_report
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from db import insert_report
+from models import default_report
+from rooms import room_of, partner_of
+from history import build_snapshot
+from admin_mirror import mirror
+from outbound import dispatcher, ADMIN
 
 async def report_partner(update: Update, context):
     user_id = update.effective_user.id
-    room_id = context.user_data.get("room_id")
-    room = await get_room(room_id)
-    other_id = [uid for uid in room["users"] if uid != user_id][0]
-    chat_history = await get_chat_history(room_id)
-    await insert_report({
-        "room_id": room_id,
-        "reporter_id": user_id,
-        "reported_id": other_id,
-        "chat_history": chat_history,
-        "created_at": time.time(),
-        "reviewed": False
-    })
+    room_id = room_of(user_id)
+    other_id = partner_of(user_id)
+    if not room_id or not other_id:
+        await update.message.reply_text("Not in a room. Use /find to start a chat.")
+        return
+    snapshot = await build_snapshot(room_id)
+    report_id = await insert_report(default_report(room_id, user_id, other_id, snapshot))
+    mirror.flag_room(room_id)
     admin_group = int(context.bot_data.get('ADMIN_GROUP_ID'))
-    await context.bot.send_message(chat_id=admin_group, text=f"User {user_id} reported user {other_id} in room {room_id}.\nChat history attached.")
-    # Optionally send chat log as a file
-    # ... (add file send logic if needed)
+    # The log itself is fetched only when an admin asks for it.
+    kb = InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"Last {snapshot['excerpt_count']} messages", callback_data=f"rx:{report_id}"),
+        InlineKeyboardButton("Full history", callback_data=f"hs:{room_id}")
+    ]])
+    dispatcher.post(
+        ADMIN, context.bot.send_message,
+        chat_id=admin_group,
+        text=f"User {user_id} reported user {other_id} in room {room_id}.",
+        reply_markup=kb
+    )
     await update.message.reply_text("Report sent to admin. Thank you for helping keep our platform safe.")
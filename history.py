@@ -0,0 +1,119 @@
+"""history.py - paged chat history views, gzip NDJSON export and report snapshots"""
+import gzip
+import json
+import os
+import tempfile
+import time
+import zlib
+from datetime import datetime
+from bson import Binary, ObjectId
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from db import iter_chat_history, get_chat_history_page, get_recent_chat_messages
+import chatlog
+
+PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+TEXT_LIMIT = 4096
+LINE_LIMIT = 300
+REPORT_EXCERPT_SIZE = int(os.getenv("REPORT_EXCERPT_SIZE", "50"))
+# Exports are written to a temp file that stays in memory up to this size.
+EXPORT_SPOOL_MAX = 1 << 20
+
+def _line(doc):
+    ts = doc.get("timestamp")
+    stamp = datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else "?"
+    content_type = doc.get("content_type", "text")
+    body = doc.get("text") or ""
+    if content_type != "text":
+        body = f"[{content_type}] {body}".rstrip()
+    if len(body) > LINE_LIMIT:
+        body = body[:LINE_LIMIT] + "…"
+    return f"[{stamp}] {doc.get('user_id')}: {body}"
+
+def _cursor(doc):
+    return f"{doc.get('timestamp', 0)!r}:{doc['_id']}"
+
+def parse_callback(data):
+    # "hn:<room>:<ts>:<oid>" (next page) / "hp:..." (previous page)
+    # / "hs:<room>" (first page) / "hx:<room>" (export).
+    kind, _, rest = data.partition(":")
+    if kind in ("hs", "hx"):
+        return kind, rest, None
+    room_id, ts, oid = rest.rsplit(":", 2)
+    return kind, room_id, (float(ts), ObjectId(oid))
+
+async def render_page(room_id, after=None, before=None):
+    # Returns (text, markup), or (None, None) when there is nothing there.
+    docs = await get_chat_history_page(room_id, after=after, before=before, limit=PAGE_SIZE + 1)
+    if not docs:
+        return None, None
+    more = len(docs) > PAGE_SIZE
+    # One extra row tells us whether a further page exists in the
+    # direction we moved.
+    if before is not None:
+        has_prev, has_next = more, True
+        docs = docs[-PAGE_SIZE:]
+    else:
+        has_prev, has_next = after is not None, more
+        docs = docs[:PAGE_SIZE]
+    text = f"Room {room_id} history"
+    shown = 0
+    for doc in docs:
+        line = _line(doc)
+        if len(text) + len(line) + 1 > TEXT_LIMIT:
+            break
+        text += "\n" + line
+        shown += 1
+    if shown < len(docs):
+        # Whatever did not fit starts the next page.
+        docs = docs[:shown]
+        has_next = True
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀ Prev", callback_data=f"hp:{room_id}:{_cursor(docs[0])}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ▶", callback_data=f"hn:{room_id}:{_cursor(docs[-1])}"))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton("Export (.ndjson.gz)", callback_data=f"hx:{room_id}")])
+    return text, InlineKeyboardMarkup(rows)
+
+async def export_history(room_id):
+    # Streams the log through gzip into a temp file; the caller sends it
+    # and closes it. Returns (file, count).
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+    count = 0
+    with gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        async for doc in iter_chat_history(room_id):
+            doc["_id"] = str(doc["_id"])
+            gz.write(json.dumps(doc, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+            count += 1
+    out.seek(0)
+    return out, count
+
+async def build_snapshot(room_id, limit=REPORT_EXCERPT_SIZE):
+    # A report keeps a pointer into the room's log (everything up to
+    # `until`) plus a zlib-compressed copy of the last `limit` messages, so
+    # the document stays small however long the room ran. Entries still in
+    # the write-behind buffer are included.
+    pending = chatlog.pipeline.pending_for(room_id, limit)
+    stored = await get_recent_chat_messages(room_id, limit - len(pending)) if len(pending) < limit else []
+    excerpt = stored + pending
+    payload = json.dumps(excerpt, ensure_ascii=False, default=str).encode("utf-8")
+    return {
+        "history": {"room_id": room_id, "until": time.time()},
+        "excerpt": Binary(zlib.compress(payload)),
+        "excerpt_count": len(excerpt),
+    }
+
+def load_excerpt(report):
+    if report.get("excerpt") is not None:
+        return json.loads(zlib.decompress(report["excerpt"]))
+    # Reports filed before snapshots embedded the full log.
+    return report.get("chat_history", [])[-REPORT_EXCERPT_SIZE:]
+
+def render_excerpt(report):
+    text = f"Report {report['_id']} excerpt (room {report['room_id']})"
+    lines = [_line(doc) for doc in load_excerpt(report)]
+    # Keep the newest lines when the excerpt is longer than one message.
+    while lines and len(text) + sum(len(line) + 1 for line in lines) > TEXT_LIMIT:
+        lines.pop(0)
+    return "\n".join([text] + lines) if lines else text + "\n(no messages)"
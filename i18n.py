@@ -0,0 +1,95 @@
+"""i18n.py - locale catalogs loaded once, with cached per-language keyboards"""
+import json
+import logging
+import os
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+LOCALE_DIR = os.path.join(os.path.dirname(__file__), "locales")
+DEFAULT_LANG = "en"
+RELOAD_CHECK_INTERVAL = int(os.getenv("LOCALE_RELOAD_INTERVAL", "30"))
+
+class Catalog:
+    # Every catalog is complete after load: keys missing from a translation
+    # are filled from the default language, so lookups never fall through to
+    # disk or to a second dict. Keyboards are built on first use per
+    # (name, lang) and kept until the next reload.
+    def __init__(self, directory=LOCALE_DIR, default=DEFAULT_LANG):
+        self.directory = directory
+        self.default = default
+        self.locales = {default: {}}
+        self._mtimes = {}
+        self._builders = {}
+        self._keyboards = {}
+
+    def _scan(self):
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".json")]
+        except OSError:
+            return {}
+        return {n[:-5]: os.stat(os.path.join(self.directory, n)).st_mtime for n in names}
+
+    def load(self):
+        mtimes = self._scan()
+        raw = {}
+        for lang in mtimes:
+            try:
+                with open(os.path.join(self.directory, f"{lang}.json"), "r", encoding="utf-8") as f:
+                    raw[lang] = json.load(f)
+            except Exception as e:
+                # Keep serving the previous version of a file that is
+                # mid-edit or broken.
+                logger.warning("Could not load locale %s: %s", lang, e)
+                raw[lang] = self.locales.get(lang, {})
+        base = raw.get(self.default, {})
+        self.locales = {lang: {**base, **strings} for lang, strings in raw.items()}
+        self.locales.setdefault(self.default, base)
+        self._mtimes = mtimes
+        self._keyboards = {}
+        return len(self.locales)
+
+    def refresh(self):
+        # Cheap stat() of the catalog directory; reloads only on change.
+        if self._scan() != self._mtimes:
+            count = self.load()
+            logger.info("Locales reloaded: %d languages.", count)
+            return True
+        return False
+
+    def get(self, lang):
+        return self.locales.get(lang) or self.locales[self.default]
+
+    def text(self, lang, key, default=None):
+        return self.get(lang).get(key, key if default is None else default)
+
+    def register_keyboard(self, name, builder):
+        # builder(locale_dict) -> InlineKeyboardMarkup
+        self._builders[name] = builder
+
+    def keyboard(self, name, lang=DEFAULT_LANG):
+        lang = lang if lang in self.locales else self.default
+        markup = self._keyboards.get((name, lang))
+        if markup is None:
+            markup = self._keyboards[(name, lang)] = self._builders[name](self.get(lang))
+        return markup
+
+catalog = Catalog()
+
+def t(lang, key, default=None):
+    return catalog.text(lang, key, default)
+
+def keyboard(name, lang=DEFAULT_LANG):
+    return catalog.keyboard(name, lang)
+
+def _main_menu(locale):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(locale.get("edit_profile", "Edit Profile"), callback_data="menu_edit_profile")],
+        [InlineKeyboardButton(locale.get("find", "Find"), callback_data="menu_find")],
+        [InlineKeyboardButton(locale.get("upgrade_tip", "Upgrade"), callback_data="menu_upgrade")],
+        [InlineKeyboardButton("Filters", callback_data="menu_filter")],
+        [InlineKeyboardButton(locale.get("menu_back", "Back"), callback_data="menu_back")]
+    ])
+
+catalog.register_keyboard("main_menu", _main_menu)
+catalog.load()
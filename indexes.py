@@ -0,0 +1,117 @@
+"""indexes.py - declarative index registry, startup bootstrap and plan checks
+
+Run `python indexes.py --check` to create the indexes and fail (exit 1) if
+any hot-path query still plans a collection scan.
+"""
+import asyncio
+import logging
+import sys
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from db import db
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    "users": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username"),
+        IndexModel([("is_premium", ASCENDING), ("premium_expiry", ASCENDING)], name="premium_expiry"),
+    ],
+    "rooms": [
+        IndexModel([("room_id", ASCENDING)], name="room_id_unique", unique=True),
+        IndexModel([("active", ASCENDING)], name="active"),
+    ],
+    "chatlogs": [
+        IndexModel([("room_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)], name="room_timestamp_id"),
+        IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+    ],
+    "chatlog_archives": [
+        IndexModel([("room_id", ASCENDING), ("first_ts", ASCENDING)], name="room_first_ts"),
+        IndexModel([("last_ts", ASCENDING)], name="last_ts"),
+    ],
+    "reports": [
+        IndexModel([("reviewed", ASCENDING)], name="reviewed"),
+        IndexModel([("room_id", ASCENDING)], name="room_id"),
+    ],
+    "blocked_words": [
+        IndexModel([("word", ASCENDING)], name="word_unique", unique=True),
+    ],
+    "waiting": [
+        IndexModel([("since", ASCENDING)], name="since"),
+        IndexModel([("shard", ASCENDING), ("since", ASCENDING)], name="shard_since"),
+    ],
+    "persistence": [
+        IndexModel([("kind", ASCENDING)], name="kind"),
+    ],
+    "broadcasts": [
+        IndexModel([("state", ASCENDING), ("shard", ASCENDING)], name="state_shard"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+}
+
+# (label, collection, filter, sort) for the queries that run per message or
+# per scheduled job. Each must be answered from an index.
+QUERY_PLANS = [
+    ("get_user", "users", {"user_id": 1}, None),
+    ("get_user_by_username", "users", {"username": "someone"}, None),
+    ("get_room", "rooms", {"room_id": "abcd1234"}, None),
+    ("load_directory", "rooms", {"active": True}, None),
+    ("iter_chat_history", "chatlogs", {"room_id": "abcd1234"}, [("timestamp", ASCENDING), ("_id", ASCENDING)]),
+    ("premium_expiry_load", "users", {"is_premium": True, "premium_expiry": {"$ne": None}}, None),
+    ("unreviewed_reports", "reports", {"reviewed": False}, None),
+    ("get_archived_chat", "chatlog_archives", {"room_id": "abcd1234"}, [("first_ts", ASCENDING)]),
+    ("archived_history_page", "chatlog_archives", {"room_id": "abcd1234", "last_ts": {"$gte": 0}}, [("first_ts", ASCENDING)]),
+    ("retention_candidates", "chatlogs", {"timestamp": {"$lt": 0}, "room_id": {"$gt": ""}}, [("room_id", ASCENDING)]),
+    ("expired_archives", "chatlog_archives", {"last_ts": {"$lt": 0}}, None),
+    ("claim_waiting", "waiting", {"_id": {"$ne": 1}}, [("since", ASCENDING)]),
+    ("sweep_waiting", "waiting", {"shard": 0}, [("since", ASCENDING)]),
+    ("persistence_restore", "persistence", {"kind": "user_data"}, None),
+    ("broadcast_segment", "users", {"user_id": {"$gt": 0}, "blocked": {"$ne": True}}, [("user_id", ASCENDING)]),
+    ("resume_broadcasts", "broadcasts", {"state": "running", "shard": 0}, None),
+]
+
+async def ensure_indexes():
+    for collection, models in INDEXES.items():
+        try:
+            await db[collection].create_indexes(models)
+        except OperationFailure as e:
+            # Usually existing duplicates blocking a unique index; the bot
+            # still runs, the plan check will point at the missing index.
+            logger.error("Could not create indexes on %s: %s", collection, e)
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+async def check_query_plans():
+    # Returns the labels of queries whose winning plan scans a collection.
+    failures = []
+    for label, collection, query, sort in QUERY_PLANS:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explained = await cursor.explain()
+        winning = explained.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in set(_stages(winning)):
+            failures.append(label)
+    return failures
+
+async def _main(check):
+    await ensure_indexes()
+    if not check:
+        return 0
+    failures = await check_query_plans()
+    for label in failures:
+        print(f"COLLSCAN: {label}")
+    print("all query plans use indexes" if not failures else f"{len(failures)} query plan(s) scan collections")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main("--check" in sys.argv)))
@@ -0,0 +1,249 @@
+"""lifecycle.py - closes idle rooms and drops stale waiters"""
+import asyncio
+import logging
+import math
+import os
+import time
+import rooms
+from db import close_rooms
+from outbound import TokenBucket, dispatcher, NOTICE
+
+logger = logging.getLogger(__name__)
+
+# A room nobody has sent anything to for this long is closed.
+ROOM_IDLE_TIMEOUT = float(os.getenv("ROOM_IDLE_TIMEOUT", "1800"))
+# A waiting user with no updates for this long leaves the pool.
+WAITING_TTL = float(os.getenv("WAITING_TTL", "900"))
+TICK_INTERVAL = float(os.getenv("LIFECYCLE_TICK_INTERVAL", "5"))
+NOTIFY_RATE = float(os.getenv("LIFECYCLE_NOTIFY_RATE", "10"))
+# Rooms closed per update_many.
+CLOSE_BATCH = 500
+# Cluster mode: activity in a room owned by another shard is forwarded at
+# most this often per room.
+FORWARD_INTERVAL = 60
+ROOM_IDLE_TEXT = "This chat was closed after a long time without messages. Use /find to meet someone new."
+WAITING_EXPIRED_TEXT = "You were taken out of the finding pool after waiting a long time. Use /find to search again."
+
+class TimerWheel:
+    # Hashed timing wheel: a key lives in the slot of its deadline's tick,
+    # and advance() only visits the slots whose ticks have passed. Touching
+    # a key just moves its deadline; the key stays where it is and is
+    # re-slotted when its old slot comes round, so a busy room costs one
+    # re-slot per timeout, not one per message. Keys expire up to one tick
+    # late.
+    def __init__(self, tick, horizon, now=None):
+        self.tick = tick
+        self._slots = [set() for _ in range(max(1, math.ceil(horizon / tick)) + 1)]
+        self._deadline = {}
+        self._slot_of = {}
+        self._next = int((time.time() if now is None else now) // tick)
+
+    def __len__(self):
+        return len(self._deadline)
+
+    def __contains__(self, key):
+        return key in self._deadline
+
+    def _place(self, key, deadline):
+        index = max(int(deadline // self.tick), self._next) % len(self._slots)
+        self._slots[index].add(key)
+        self._slot_of[key] = index
+
+    def schedule(self, key, deadline):
+        if key not in self._deadline:
+            self._place(key, deadline)
+        elif deadline < self._deadline[key]:
+            self._slots[self._slot_of[key]].discard(key)
+            self._place(key, deadline)
+        self._deadline[key] = deadline
+
+    def touch(self, key, deadline):
+        # schedule() for keys already in the wheel; later deadlines only.
+        if key in self._deadline and deadline > self._deadline[key]:
+            self._deadline[key] = deadline
+
+    def cancel(self, key):
+        if self._deadline.pop(key, None) is not None:
+            self._slots[self._slot_of.pop(key)].discard(key)
+
+    def advance(self, now):
+        # Keys whose deadline has passed, in no particular order. After a
+        # stall longer than a revolution each slot is visited once.
+        last = int(now // self.tick)
+        if last < self._next:
+            return []
+        expired = []
+        ticks = range(self._next, last + 1)
+        if len(ticks) > len(self._slots):
+            ticks = ticks[-len(self._slots):]
+        self._next = last + 1
+        for tick in ticks:
+            index = tick % len(self._slots)
+            keys, self._slots[index] = self._slots[index], set()
+            for key in keys:
+                deadline = self._deadline[key]
+                if deadline <= now:
+                    del self._deadline[key]
+                    del self._slot_of[key]
+                    expired.append(key)
+                else:
+                    self._place(key, deadline)
+        return expired
+
+class Lifecycle:
+    # Last activity per room and per waiting user. rooms.py reports rooms
+    # opening and closing and users starting and stopping to wait; every
+    # update from a user pushes their room's and their wait's deadline out
+    # (see track_activity). In cluster mode a room is reaped by the shard
+    # owning its lowest user id, the others forward activity to it.
+    def __init__(self, room_timeout=ROOM_IDLE_TIMEOUT, waiting_ttl=WAITING_TTL, tick_interval=TICK_INTERVAL):
+        self.room_timeout = room_timeout
+        self.waiting_ttl = waiting_ttl
+        self.tick_interval = tick_interval
+        self.rooms = TimerWheel(tick_interval, room_timeout)
+        self.waiting = TimerWheel(tick_interval, waiting_ttl)
+        self._forwarded = {}
+        self._unclosed = []
+        self._bot = None
+        self._task = None
+        self._notifier = None
+        self._notify_queue = asyncio.Queue()
+        self.bucket = TokenBucket(NOTIFY_RATE, NOTIFY_RATE)
+        self.stats = {"ticks": 0, "rooms_closed": 0, "waiters_dropped": 0, "notified": 0, "notify_failed": 0}
+
+    # -- hooks (called from rooms.py) -------------------------------------------
+    def room_opened(self, room_id, users):
+        if rooms.state.owns_room(users):
+            self.rooms.schedule(room_id, time.time() + self.room_timeout)
+
+    def room_closed(self, room_id):
+        self.rooms.cancel(room_id)
+        self._forwarded.pop(room_id, None)
+
+    def waiting_started(self, user_id):
+        self.waiting.schedule(user_id, time.time() + self.waiting_ttl)
+
+    def waiting_ended(self, user_id):
+        self.waiting.cancel(user_id)
+
+    # -- activity ---------------------------------------------------------------
+    def seen(self, user_id, now=None):
+        now = time.time() if now is None else now
+        if user_id in self.waiting:
+            self.waiting.touch(user_id, now + self.waiting_ttl)
+        room_id = rooms.room_of(user_id)
+        if room_id is None:
+            return
+        if room_id in self.rooms:
+            self.rooms.touch(room_id, now + self.room_timeout)
+        elif now - self._forwarded.get(room_id, 0) >= FORWARD_INTERVAL:
+            room = rooms.directory.get(room_id)
+            if room is not None:
+                self._forwarded[room_id] = now
+                rooms.state.room_active(room_id, room["users"])
+
+    def touch_room(self, room_id):
+        # Activity forwarded by another shard.
+        self.rooms.touch(room_id, time.time() + self.room_timeout)
+
+    # -- running ----------------------------------------------------------------
+    async def start(self, bot):
+        self._bot = bot
+        now = time.time()
+        for room in rooms.directory.rooms():
+            self.room_opened(room["room_id"], room["users"])
+        for user_id in await rooms.state.waiting_users():
+            self.waiting.schedule(user_id, now + self.waiting_ttl)
+        rooms.watch(self)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self._notifier = asyncio.create_task(self._notify_loop())
+
+    async def stop(self):
+        rooms.watch(None)
+        for task in (self._task, self._notifier):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._notifier = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Lifecycle tick failed")
+
+    async def tick(self, now=None):
+        now = time.time() if now is None else now
+        self.stats["ticks"] += 1
+        closed = await self.close_idle_rooms(self.rooms.advance(now))
+        dropped = await self.drop_waiters(self.waiting.advance(now))
+        if closed or dropped:
+            logger.info("Lifecycle: %d idle rooms closed, %d stale waiters dropped.", closed, dropped)
+        return closed, dropped
+
+    async def close_idle_rooms(self, room_ids):
+        # Out of the directory first, so nothing more is relayed into them;
+        # Mongo follows in batches, and a failed batch is retried next tick.
+        for room_id in room_ids:
+            users = rooms.directory.unbind(room_id)
+            if users:
+                rooms.state.room_unbound(room_id, users)
+                self._forwarded.pop(room_id, None)
+                self._unclosed.append(room_id)
+                for user_id in users:
+                    self._notify_queue.put_nowait((user_id, ROOM_IDLE_TEXT))
+        pending, self._unclosed = self._unclosed, []
+        for start in range(0, len(pending), CLOSE_BATCH):
+            batch = pending[start:start + CLOSE_BATCH]
+            try:
+                await close_rooms(batch, "idle")
+            except Exception:
+                logger.exception("Closing %d idle rooms failed; retrying next tick", len(pending) - start)
+                self._unclosed.extend(pending[start:])
+                break
+            self.stats["rooms_closed"] += len(batch)
+        return len(pending) - len(self._unclosed)
+
+    async def drop_waiters(self, user_ids):
+        if not user_ids:
+            return 0
+        try:
+            dropped = await rooms.state.drop_waiting(user_ids)
+        except Exception:
+            # Due again on the next tick.
+            for user_id in user_ids:
+                self.waiting.schedule(user_id, time.time())
+            raise
+        for user_id in dropped:
+            self._notify_queue.put_nowait((user_id, WAITING_EXPIRED_TEXT))
+        self.stats["waiters_dropped"] += len(dropped)
+        return len(dropped)
+
+    async def _notify_loop(self):
+        # Up to a second's worth of notices per batch, sent together.
+        while True:
+            batch = [await self._notify_queue.get()]
+            while len(batch) < max(1, int(NOTIFY_RATE)) and not self._notify_queue.empty():
+                batch.append(self._notify_queue.get_nowait())
+            sends = []
+            for user_id, text in batch:
+                # Matched again while the notice was queued.
+                if text == WAITING_EXPIRED_TEXT and rooms.room_of(user_id):
+                    continue
+                await self.bucket.acquire()
+                sends.append(dispatcher.send(NOTICE, self._bot.send_message, chat_id=user_id, text=text))
+            for result in await asyncio.gather(*sends, return_exceptions=True):
+                self.stats["notify_failed" if isinstance(result, Exception) else "notified"] += 1
+
+async def track_activity(update, context):
+    # Registered in a handler group ahead of the others; sees every update.
+    if update.effective_user:
+        lifecycle.seen(update.effective_user.id)
+
+lifecycle = Lifecycle()
@@ -0,0 +1,141 @@
+"""matchmaker.py - tick-based batch pairing over the waiting pool"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from rooms import users_online
+
+logger = logging.getLogger(__name__)
+
+TICK_INTERVAL = float(os.getenv("MATCH_TICK_INTERVAL", "0.5"))
+STATS_WINDOW = 1000
+# Incompatible class heads looked at per user before giving up for this tick.
+MAX_SCAN = int(os.getenv("MATCH_MAX_SCAN", "512"))
+
+def _accepts(prefs, attrs):
+    return all(not want or want == have for want, have in zip(prefs, attrs))
+
+class Matchmaker:
+    # Each tick takes waiting users oldest first and pairs each with the
+    # longest-waiting user of a mutually compatible class (users sharing
+    # attrs and prefs). Only class heads are compared, so a tick costs
+    # roughly classes + matches, not waiting users.
+    def __init__(self, pool, tick_interval=TICK_INTERVAL, max_scan=MAX_SCAN):
+        self.pool = pool
+        self.tick_interval = tick_interval
+        self.max_scan = max_scan
+        self._task = None
+        self._stopping = False
+        self._on_match = None
+        self._announcing = set()
+        self._waits = deque(maxlen=STATS_WINDOW)
+        self._recent = deque(maxlen=STATS_WINDOW)
+        self.totals = {"ticks": 0, "matches": 0, "tick_seconds": 0.0}
+
+    def tick(self, now=None):
+        now = time.time() if now is None else now
+        started = time.perf_counter()
+        classes = self.pool.classes
+        heads = sorted((next(iter(queue.values())), key) for key, queue in classes.items())
+        # Candidate partners are looked at in the order their classes' heads
+        # arrived, so the first compatible one is the longest waiting.
+        order = [key for _, key in heads]
+        heapq.heapify(heads)
+        first = 0
+        pairs = []
+        while heads:
+            since, key = heapq.heappop(heads)
+            # A class is gone from the pool once its last user is paired.
+            queue = classes.get(key)
+            if not queue:
+                continue
+            user_id, head_since = next(iter(queue.items()))
+            if head_since != since:
+                heapq.heappush(heads, (head_since, key))
+                continue
+            while first < len(order) and order[first] not in classes:
+                first += 1
+            attrs, prefs = key
+            partner = None
+            scanned = 0
+            for other in itertools.islice(order, first, None):
+                other_queue = classes.get(other)
+                if other_queue is None or len(other_queue) < (2 if other == key else 1):
+                    continue
+                scanned += 1
+                if scanned > self.max_scan:
+                    break
+                if not (_accepts(prefs, other[0]) and _accepts(other[1], attrs)):
+                    continue
+                entries = iter(other_queue)
+                candidate = next(entries)
+                partner = next(entries) if candidate == user_id else candidate
+                break
+            if partner is None:
+                # Nobody compatible with this class is waiting (or the
+                # compatible ones are too deep this tick); the rest of the
+                # class has the same constraints, so skip it until next tick.
+                continue
+            partner_since = classes[self.pool.attrs_key(partner)][partner]
+            self.pool.discard(user_id)
+            self.pool.discard(partner)
+            pairs.append((user_id, partner))
+            self._waits.append(now - head_since)
+            self._waits.append(now - partner_since)
+            if queue:
+                heapq.heappush(heads, (next(iter(queue.values())), key))
+        self.totals["ticks"] += 1
+        self.totals["matches"] += len(pairs)
+        self.totals["tick_seconds"] += time.perf_counter() - started
+        if pairs:
+            self._recent.append((now, len(pairs)))
+        return pairs
+
+    def stats(self, now=None):
+        now = time.time() if now is None else now
+        waits = sorted(self._waits)
+        window = [count for at, count in self._recent if now - at <= 60]
+        oldest = min((next(iter(q.values())) for q in self.pool.classes.values()), default=None)
+        return {
+            "waiting": len(self.pool),
+            "matches_per_minute": sum(window),
+            "wait_p50": waits[len(waits) // 2] if waits else 0.0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "longest_waiting": now - oldest if oldest is not None else 0.0,
+            **self.totals,
+        }
+
+    async def start(self, on_match):
+        # on_match(user_id, partner_id) is awaited as its own task per pair.
+        self._on_match = on_match
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping:
+            await asyncio.sleep(self.tick_interval)
+            try:
+                for user_id, partner in self.tick():
+                    task = asyncio.create_task(self._announce(user_id, partner))
+                    self._announcing.add(task)
+                    task.add_done_callback(self._announcing.discard)
+            except Exception:
+                logger.exception("Matchmaker tick failed")
+
+    async def _announce(self, user_id, partner):
+        try:
+            await self._on_match(user_id, partner)
+        except Exception:
+            logger.exception("Failed to start match %s <-> %s", user_id, partner)
+
+matchmaker = Matchmaker(users_online)
@@ -0,0 +1,291 @@
+"""metrics.py - latency histograms, counters and gauges on a Prometheus endpoint"""
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import time
+from bisect import bisect_left
+from telegram.ext import ApplicationHandlerStop, ConversationHandler
+from telegram.request import HTTPXRequest
+from diagnostics import current_trace
+
+logger = logging.getLogger(__name__)
+
+# The endpoint has no auth: loopback only unless a scraper on another host
+# is meant to reach it (then set METRICS_LISTEN=0.0.0.0 behind a firewall).
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+# 0 turns the endpoint off. Cluster shards listen on METRICS_PORT + shard.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_PATH = "/metrics"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    # Incremented directly, or read at scrape time from `fn`, which returns
+    # a number, or a dict of label value -> number for a one-label metric
+    # (how the existing `stats` dicts are exposed).
+    type = "counter"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        values = self._values
+        if self.fn is not None:
+            try:
+                result = self.fn()
+            except Exception:
+                logger.exception("Metric %s failed", self.name)
+                result = {}
+            values = {(k,): v for k, v in result.items()} if isinstance(result, dict) else {(): result}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {_number(value)}")
+        return lines
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, *labels, value):
+        self._values[labels] = value
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+class Histogram:
+    # Per label set: one count per bucket (not cumulative, so an observation
+    # is a bisect and one increment), plus sum and count.
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def series(self, labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        return series
+
+    def observe(self, value, *labels):
+        series = self.series(labels)
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bounds = self.buckets + (float("inf"),)
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        # Re-registering a name replaces it, so setup code can run twice.
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=(), fn=None):
+        return self.register(Counter(name, help, labels, fn))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.register(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+class Timed:
+    # Latency histogram, error counter and in-flight gauge for one kind of
+    # call (handlers, DB functions, Bot API methods), keyed by one label.
+    # `kind` also charges the time to the current update's trace.
+    def __init__(self, registry, prefix, label, what, kind=None):
+        self.label = label
+        self.kind = kind
+        self.seconds = registry.histogram(f"{prefix}_seconds", f"{what} latency in seconds.", (label,))
+        self.errors = registry.counter(f"{prefix}_errors_total", f"{what} calls that raised or failed.", (label,))
+        self.in_flight = registry.gauge(f"{prefix}_in_flight", f"{what} calls in progress.", (label,))
+
+    def wrap(self, fn, key=None):
+        # The label is fixed per wrapper, so the series are looked up once
+        # here; a call costs two clock reads, a bisect and a few increments.
+        key = key or fn.__name__
+        labels = (key,)
+        series = self.seconds.series(labels)
+        counts, buckets = series[0], self.seconds.buckets
+        errors, kind = self.errors, self.kind
+        in_flight = self.in_flight._values
+        in_flight.setdefault(labels, 0)
+        clock = time.perf_counter
+
+        @functools.wraps(fn)
+        async def timed(*args, **kwargs):
+            in_flight[labels] += 1
+            trace = current_trace.get()
+            if trace is not None and kind == "handler":
+                trace.handlers.append(key)
+            started = clock()
+            try:
+                return await fn(*args, **kwargs)
+            except (ApplicationHandlerStop, asyncio.CancelledError):
+                raise
+            except Exception:
+                errors.inc(key)
+                raise
+            finally:
+                elapsed = clock() - started
+                counts[bisect_left(buckets, elapsed)] += 1
+                series[1] += elapsed
+                series[2] += 1
+                in_flight[labels] -= 1
+                if trace is not None:
+                    trace.add(kind, elapsed)
+        timed.__wrapped_timed__ = True
+        return timed
+
+handlers = Timed(registry, "bot_handler", "handler", "Update handler", kind="handler")
+db_calls = Timed(registry, "bot_db", "op", "db.py function", kind="db")
+api_calls = Timed(registry, "bot_api", "method", "Bot API request", kind="api")
+
+def instrument_functions(namespace, timed, module):
+    # Wraps the coroutine functions defined in `module` in place, so later
+    # `from module import name` imports get the timed version. Async
+    # generators are left alone; their callers' latency covers them.
+    for name, fn in list(namespace.items()):
+        if (inspect.iscoroutinefunction(fn) and getattr(fn, "__module__", None) == module
+                and not name.startswith("_") and not getattr(fn, "__wrapped_timed__", False)):
+            namespace[name] = timed.wrap(fn, name)
+
+def _iter_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from _iter_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from _iter_handlers(state_handlers)
+            yield from _iter_handlers(handler.fallbacks)
+        else:
+            yield handler
+
+def instrument_application(app):
+    # Times every handler callback registered on `app`, including the ones
+    # inside conversations.
+    count = 0
+    for group in app.handlers.values():
+        for handler in _iter_handlers(group):
+            callback = handler.callback
+            if not getattr(callback, "__wrapped_timed__", False):
+                handler.callback = handlers.wrap(callback, getattr(callback, "__name__", "handler"))
+                count += 1
+    return count
+
+class InstrumentedRequest(HTTPXRequest):
+    # Times each Bot API request by method name. Non-2xx responses count as
+    # errors here even though PTB turns them into exceptions upstream.
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        api_calls.in_flight.inc(endpoint)
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            api_calls.errors.inc(endpoint)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            api_calls.seconds.observe(elapsed, endpoint)
+            api_calls.in_flight.dec(endpoint)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add("api", elapsed)
+        if not 200 <= code < 300:
+            api_calls.errors.inc(endpoint)
+        return code, payload
+
+class MetricsServer:
+    # GET /metrics over plain HTTP/1.1; one request per connection, which
+    # is how Prometheus scrapes.
+    def __init__(self, registry=registry, path=METRICS_PATH):
+        self.registry = registry
+        self.path = path
+        self._server = None
+
+    async def start(self, host=METRICS_LISTEN, port=METRICS_PORT):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info("Metrics endpoint listening on %s:%d%s", host, port, self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split(" ")
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == self.path:
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+server = MetricsServer()
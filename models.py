@@ -28,12 +28,12 @@ def default_room(room_id, user1, user2):
         "reports": []
     }
 
-def default_report(room_id, reporter_id, reported_id, chat_history):
+def default_report(room_id, reporter_id, reported_id, snapshot):
     return {
         "room_id": room_id,
         "reporter_id": reporter_id,
         "reported_id": reported_id,
-        "chat_history": chat_history,
+        **snapshot,
         "created_at": datetime.utcnow().isoformat(),
         "reviewed": False
     }
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""moderation.py - compiled blocked-word matcher for the message hot path"""
+import asyncio
+import logging
+import time
+import unicodedata
+from db import get_blocked_words, get_blocked_words_version
+
+logger = logging.getLogger(__name__)
+
+VERSION_CHECK_INTERVAL = 60
+
+# Look-alike characters folded onto the letter they imitate. Applied after
+# NFKC + casefold, so fullwidth and most compatibility forms are already gone.
+_CONFUSABLES = {
+    # Cyrillic
+    "а": "a", "в": "b", "е": "e", "ё": "e", "к": "k", "м": "m", "н": "h", "о": "o",
+    "р": "p", "с": "c", "т": "t", "у": "y", "х": "x", "ѕ": "s", "і": "i", "ј": "j",
+    # Greek
+    "α": "a", "β": "b", "ε": "e", "η": "n", "ι": "i", "κ": "k", "ν": "v", "ο": "o",
+    "ρ": "p", "τ": "t", "υ": "u", "χ": "x",
+    # common leetspeak
+    "0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a", "$": "s",
+    # Arabic letter variants
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+    "ک": "ك", "ی": "ي", "ہ": "ه",
+    # Devanagari candrabindu to anusvara (nukta letters are split by NFKC
+    # and the nukta itself is dropped below)
+    "ँ": "ं",
+}
+
+# Marks that do not change the word: Arabic harakat and tatweel, the
+# Devanagari nukta, and zero-width joiners.
+_DROPPED = (
+    [chr(c) for c in range(0x064B, 0x0653)]
+    + ["\u0670", "\u0640", "\u093c", "\u200b", "\u200c", "\u200d", "\u2060", "\ufeff"]
+)
+
+_TABLE = str.maketrans({**_CONFUSABLES, **{c: None for c in _DROPPED}})
+
+def normalize(text):
+    if not text.isascii():
+        text = unicodedata.normalize("NFKC", text)
+    return text.casefold().translate(_TABLE)
+
+class BlockedWordMatcher:
+    # Aho-Corasick automaton over the normalised blocked words. Transitions
+    # live in one flat dict keyed by (state << 21 | codepoint) to keep
+    # memory down with tens of thousands of terms.
+    def __init__(self, words=()):
+        self.build(words)
+
+    def build(self, words):
+        terms = []
+        seen = set()
+        for word in words:
+            term = normalize(word.strip()) if word else ""
+            if term and term not in seen:
+                seen.add(term)
+                terms.append((term, word))
+        goto = {}
+        children = [[]]
+        out = [-1]
+        for idx, (term, _) in enumerate(terms):
+            node = 0
+            for ch in term:
+                key = (node << 21) | ord(ch)
+                nxt = goto.get(key)
+                if nxt is None:
+                    nxt = len(out)
+                    goto[key] = nxt
+                    children.append([])
+                    children[node].append((ord(ch), nxt))
+                    out.append(-1)
+                node = nxt
+            if out[node] < 0:
+                out[node] = idx
+        fail = [0] * len(out)
+        queue = [child for _, child in children[0]]
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for code, child in children[node]:
+                f = fail[node]
+                while f and ((f << 21) | code) not in goto:
+                    f = fail[f]
+                target = goto.get((f << 21) | code, 0)
+                fail[child] = target if target != child else 0
+                if out[child] < 0:
+                    out[child] = out[fail[child]]
+                queue.append(child)
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self._words = [original for _, original in terms]
+
+    def __len__(self):
+        return len(self._words)
+
+    def find(self, text):
+        if not text or not self._words:
+            return None
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in normalize(text):
+            code = ord(ch)
+            while True:
+                nxt = goto.get((node << 21) | code)
+                if nxt is not None:
+                    node = nxt
+                    break
+                if not node:
+                    break
+                node = fail[node]
+            if out[node] >= 0:
+                return self._words[out[node]]
+        return None
+
+matcher = BlockedWordMatcher()
+_version = None
+
+def find_blocked_word(text):
+    return matcher.find(text)
+
+async def reload():
+    # Build off the event loop and swap in one assignment; messages keep
+    # using the previous automaton until the new one is ready.
+    global matcher, _version
+    version = await get_blocked_words_version()
+    words = await get_blocked_words()
+    started = time.perf_counter()
+    matcher = await asyncio.to_thread(BlockedWordMatcher, words)
+    _version = version
+    logger.info("Blocked word matcher built: %d terms in %.1f ms", len(matcher), (time.perf_counter() - started) * 1000)
+
+async def refresh():
+    # Periodic check so other processes' edits are picked up: one small
+    # read, full rebuild only when the version moved.
+    if await get_blocked_words_version() != _version:
+        await reload()
@@ -0,0 +1,293 @@
+"""outbound.py - prioritised Bot API send dispatcher with per-chat ordering"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first. BULK (broadcasts) only gets the
+# budget nothing else wants.
+RELAY, NOTICE, ADMIN, BULK = 0, 1, 2, 3
+PRIORITY_NAMES = {RELAY: "relay", NOTICE: "notice", ADMIN: "admin", BULK: "bulk"}
+
+# Telegram allows about 30 requests a second per bot, about one message a
+# second into a private chat and roughly 20 a minute into a group.
+GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "28"))
+PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", "1"))
+PRIVATE_BURST = float(os.getenv("OUTBOUND_PRIVATE_BURST", "3"))
+GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))
+GROUP_BURST = float(os.getenv("OUTBOUND_GROUP_BURST", "5"))
+CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "64"))
+MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+IDLE_SWEEP = 60
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens=1):
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # Used after a RetryAfter: nothing goes out until the window passes.
+        self.tokens = -seconds * self.rate
+        self.updated = time.monotonic()
+
+def _retry_seconds(e):
+    delay = e.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+class _Send:
+    __slots__ = ("priority", "method", "kwargs", "future", "attempts")
+
+    def __init__(self, priority, method, kwargs, future):
+        self.priority = priority
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+class _Chat:
+    # One chat's FIFO plus its flood bucket. At most one send per chat is in
+    # flight, which is what keeps a chat's messages in order.
+    __slots__ = ("chat_id", "queue", "bucket", "busy", "scheduled")
+
+    def __init__(self, chat_id, bucket):
+        self.chat_id = chat_id
+        self.queue = deque()
+        self.bucket = bucket
+        self.busy = False
+        self.scheduled = False
+
+class Dispatcher:
+    # Chats whose head message may go now sit in a heap ordered by that
+    # message's priority; chats waiting on their bucket (or a RetryAfter)
+    # sit in a timer heap. One loop moves them along and spends the global
+    # budget on the most urgent chat first.
+    def __init__(self, global_rate=GLOBAL_RATE, concurrency=CONCURRENCY):
+        self.global_rate = global_rate
+        self.private = (PRIVATE_RATE, PRIVATE_BURST)
+        self.group = (GROUP_RATE, GROUP_BURST)
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []
+        self._timers = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._sending = set()
+        self._task = None
+        self._queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.stats = {"submitted": 0, "sent": 0, "failed": 0, "retry_after": 0}
+
+    def __len__(self):
+        return sum(self._queued.values())
+
+    def depths(self):
+        return {PRIORITY_NAMES[priority]: count for priority, count in self._queued.items()}
+
+    def share_budget(self, shares):
+        # Cluster shards send from separate processes; each gets its slice
+        # of the bot-wide and per-group budgets.
+        self.global_rate = GLOBAL_RATE / shares
+        self.global_bucket = TokenBucket(self.global_rate, max(1, self.global_rate))
+        self.group = (GROUP_RATE / shares, max(1, GROUP_BURST // shares))
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    # -- submitting -------------------------------------------------------------
+    def submit(self, priority, method, **kwargs):
+        # Returns a future for the call's result. `method` is a bound Bot
+        # method (or anything awaitable with the same kwargs); the chat it
+        # is queued under is kwargs["chat_id"].
+        future = asyncio.get_running_loop().create_future()
+        if not self.running:
+            # Not started (scripts, tools): send straight away.
+            task = asyncio.ensure_future(method(**kwargs))
+            task.add_done_callback(lambda t: _settle(future, t))
+            return future
+        chat_id = kwargs["chat_id"]
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            rate, burst = self.group if isinstance(chat_id, int) and chat_id < 0 else self.private
+            chat = self._chats[chat_id] = _Chat(chat_id, TokenBucket(rate, burst))
+        chat.queue.append(_Send(priority, method, kwargs, future))
+        self._queued[priority] += 1
+        self.stats["submitted"] += 1
+        self._schedule(chat)
+        return future
+
+    async def send(self, priority, method, **kwargs):
+        return await self.submit(priority, method, **kwargs)
+
+    def post(self, priority, method, **kwargs):
+        # Fire and forget; failures are logged instead of raised.
+        future = self.submit(priority, method, **kwargs)
+        future.add_done_callback(_log_failure)
+        return future
+
+    # -- scheduling ---------------------------------------------------------------
+    def _schedule(self, chat):
+        if chat.busy or chat.scheduled or not chat.queue:
+            return
+        chat.scheduled = True
+        delay = chat.bucket.wait_time()
+        if delay > 0:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._seq), chat))
+        else:
+            heapq.heappush(self._ready, (chat.queue[0].priority, next(self._seq), chat))
+        self._wakeup.set()
+
+    def _promote_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, seq, chat = heapq.heappop(self._timers)
+            if chat.queue:
+                heapq.heappush(self._ready, (chat.queue[0].priority, seq, chat))
+            else:
+                chat.scheduled = False
+        return self._timers[0][0] - now if self._timers else None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, drain=True, timeout=10):
+        if self._task is None:
+            return
+        if drain:
+            deadline = time.monotonic() + timeout
+            while (len(self) or self._sending) and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for chat in self._chats.values():
+            while chat.queue:
+                item = chat.queue.popleft()
+                self._queued[item.priority] -= 1
+                if not item.future.done():
+                    item.future.cancel()
+        self._chats.clear()
+        self._ready.clear()
+        self._timers.clear()
+
+    async def _run(self):
+        last_sweep = time.monotonic()
+        while True:
+            self._wakeup.clear()
+            next_timer = self._promote_timers()
+            if not self._ready:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=next_timer)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._slots.acquire()
+            await self.global_bucket.acquire()
+            self._promote_timers()
+            _, _, chat = heapq.heappop(self._ready)
+            chat.scheduled = False
+            if not chat.bucket.try_acquire():
+                self.global_bucket.tokens = min(self.global_bucket.capacity, self.global_bucket.tokens + 1)
+                self._slots.release()
+                self._schedule(chat)
+                continue
+            item = chat.queue.popleft()
+            self._queued[item.priority] -= 1
+            chat.busy = True
+            task = asyncio.create_task(self._deliver(chat, item))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+            if time.monotonic() - last_sweep > IDLE_SWEEP:
+                last_sweep = time.monotonic()
+                self._sweep()
+
+    async def _deliver(self, chat, item):
+        try:
+            item.attempts += 1
+            result = await item.method(**item.kwargs)
+        except RetryAfter as e:
+            delay = _retry_seconds(e)
+            self.stats["retry_after"] += 1
+            if item.attempts <= MAX_RETRIES and not item.future.done():
+                # Back to the head of its chat so order is kept; the chat
+                # (only) waits out the flood window.
+                logger.warning("Flood control on chat %s, retrying in %.1fs", chat.chat_id, delay)
+                chat.queue.appendleft(item)
+                self._queued[item.priority] += 1
+                chat.bucket.pause(delay)
+            else:
+                self.stats["failed"] += 1
+                _fail(item.future, e)
+        except asyncio.CancelledError:
+            item.future.cancel()
+            raise
+        except Exception as e:
+            self.stats["failed"] += 1
+            _fail(item.future, e)
+        else:
+            self.stats["sent"] += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            chat.busy = False
+            self._slots.release()
+            self._schedule(chat)
+
+    def _sweep(self):
+        # Drop chats with nothing queued whose bucket has refilled; they'd
+        # be recreated with a full bucket anyway.
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.queue and not chat.busy and not chat.scheduled and chat.bucket.wait_time(chat.bucket.capacity) == 0:
+                del self._chats[chat_id]
+
+def _settle(future, task):
+    if future.done():
+        return
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+def _fail(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Outbound send failed: %s", future.exception())
+
+dispatcher = Dispatcher()
@@ -0,0 +1,163 @@
+"""persistence.py - incremental Mongo-backed BasePersistence for PTB state"""
+import asyncio
+import logging
+import pickle
+from bson import Binary
+from pymongo import DeleteOne, UpdateOne
+from telegram.ext import BasePersistence, PersistenceInput
+from db import db
+from rooms import users_online, room_of
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+def _dump(value):
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+class MongoPersistence(BasePersistence):
+    # Every update_* call only records the changed entry. Entries queued in
+    # the same persistence round (PTB gathers them) go out together as one
+    # bulk_write, and unchanged values are never rewritten.
+    def __init__(self, collection=None, update_interval=30):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.collection = collection if collection is not None else db.persistence
+        self._written = {}
+        self._pending = {}
+        self._commit_task = None
+        users_online.track_changes()
+
+    def _queue(self, doc_id, doc):
+        if doc is not None:
+            blob = doc.get("data")
+            if blob is not None and self._written.get(doc_id) == blob:
+                self._pending.pop(doc_id, None)
+                return
+        self._pending[doc_id] = doc
+
+    async def _commit(self):
+        while self._pending:
+            if self._commit_task is None or self._commit_task.done():
+                self._commit_task = asyncio.create_task(self._commit_soon())
+            await asyncio.shield(self._commit_task)
+
+    async def _commit_soon(self):
+        # Let the rest of this persistence round queue its entries first.
+        await asyncio.sleep(0)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        while self._pending:
+            batch = []
+            while self._pending and len(batch) < BATCH_SIZE:
+                doc_id, doc = self._pending.popitem()
+                batch.append((doc_id, doc))
+            ops = [
+                DeleteOne({"_id": doc_id}) if doc is None
+                else UpdateOne({"_id": doc_id}, {"$set": doc}, upsert=True)
+                for doc_id, doc in batch
+            ]
+            try:
+                await self.collection.bulk_write(ops, ordered=False)
+            except Exception:
+                # Keep newer values queued since the failed batch was built.
+                for doc_id, doc in batch:
+                    self._pending.setdefault(doc_id, doc)
+                raise
+            for doc_id, doc in batch:
+                if doc is None:
+                    self._written.pop(doc_id, None)
+                elif doc.get("data") is not None:
+                    self._written[doc_id] = doc["data"]
+
+    async def _load(self, kind):
+        result = []
+        async for doc in self.collection.find({"kind": kind}):
+            if "data" in doc:
+                self._written[doc["_id"]] = doc["data"]
+            result.append(doc)
+        return result
+
+    async def get_user_data(self):
+        return {doc["key"]: pickle.loads(doc["data"]) for doc in await self._load("user_data")}
+
+    async def get_chat_data(self):
+        return {doc["key"]: pickle.loads(doc["data"]) for doc in await self._load("chat_data")}
+
+    async def get_bot_data(self):
+        docs = await self._load("bot_data")
+        return pickle.loads(docs[0]["data"]) if docs else {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        docs = await self.collection.find({"kind": "conversation", "name": name}).to_list(None)
+        return {tuple(doc["key"]): pickle.loads(doc["state"]) for doc in docs}
+
+    async def update_user_data(self, user_id, data):
+        self._queue(f"user:{user_id}", {"kind": "user_data", "key": user_id, "data": Binary(_dump(data))})
+        await self._commit()
+
+    async def update_chat_data(self, chat_id, data):
+        self._queue(f"chat:{chat_id}", {"kind": "chat_data", "key": chat_id, "data": Binary(_dump(data))})
+        await self._commit()
+
+    async def update_bot_data(self, data):
+        self._queue("bot", {"kind": "bot_data", "key": "bot", "data": Binary(_dump(data))})
+        # bot_data is written every round, which makes it the natural place
+        # to pick up the waiting pool's changes since the last round.
+        self._queue_pool_changes()
+        await self._commit()
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        doc_id = f"conv:{name}:{':'.join(map(str, key))}"
+        if new_state is None:
+            self._queue(doc_id, None)
+        else:
+            self._queue(doc_id, {"kind": "conversation", "name": name, "key": list(key), "state": Binary(_dump(new_state))})
+        await self._commit()
+
+    async def drop_chat_data(self, chat_id):
+        self._queue(f"chat:{chat_id}", None)
+        await self._commit()
+
+    async def drop_user_data(self, user_id):
+        self._queue(f"user:{user_id}", None)
+        await self._commit()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _queue_pool_changes(self):
+        for user_id in users_online.drain_dirty():
+            entry = users_online.entry(user_id)
+            if entry is None:
+                self._queue(f"waiting:{user_id}", None)
+            else:
+                self._queue(f"waiting:{user_id}", {"kind": "waiting", "key": user_id, **entry})
+
+    async def flush(self):
+        self._queue_pool_changes()
+        await self._write_pending()
+
+    async def restore_pool(self):
+        docs = [
+            doc async for doc in self.collection.find({"kind": "waiting"}, {"key": 1, "attrs": 1, "prefs": 1, "since": 1})
+            if not room_of(doc["key"])
+        ]
+        # Oldest first, so the matchmaker's queues come back in order.
+        docs.sort(key=lambda doc: doc.get("since") or 0)
+        for doc in docs:
+            users_online.add(doc["key"], doc.get("attrs"), doc.get("prefs"), doc.get("since"))
+        users_online.drain_dirty()
+        return len(docs)
@@ -0,0 +1,194 @@
+"""premium_expiry.py - fires premium downgrades at their expiry time"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from outbound import TokenBucket, dispatcher, NOTICE
+from db import db, get_user, downgrade_premium_users
+
+logger = logging.getLogger(__name__)
+
+# Expiries this close together are applied in the same update_many.
+BATCH_WINDOW = float(os.getenv("PREMIUM_EXPIRY_BATCH_WINDOW", "0.25"))
+# Full reload from Mongo; picks up renewals made by other processes.
+RECONCILE_INTERVAL = float(os.getenv("PREMIUM_EXPIRY_RECONCILE_INTERVAL", "3600"))
+NOTIFY_RATE = float(os.getenv("PREMIUM_EXPIRY_NOTIFY_RATE", "20"))
+MAX_SLEEP = 3600
+RETRY_DELAY = 5
+EXPIRED_TEXT = "Your premium subscription has expired. Use /upgrade to renew."
+
+def expiry_timestamp(expiry):
+    # premium_expiry is stored as a naive UTC ISO string.
+    if not expiry:
+        return None
+    if isinstance(expiry, datetime):
+        moment = expiry
+    else:
+        try:
+            moment = datetime.fromisoformat(expiry)
+        except ValueError:
+            return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+class ExpiryScheduler:
+    # Min-heap of (expiry, user_id). Renewals and cancellations only update
+    # _due; stale heap entries are skipped when they surface. Only shard 0
+    # runs the scheduler; elsewhere schedule() and cancel() do nothing and
+    # shard 0 picks the change up through the published user change.
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._notifier = None
+        self._notify_queue = asyncio.Queue()
+        self._stopping = False
+        self._bot = None
+        self.bucket = TokenBucket(NOTIFY_RATE, NOTIFY_RATE)
+        self.stats = {"scheduled": 0, "downgraded": 0, "batches": 0, "notified": 0, "notify_failed": 0}
+
+    def __len__(self):
+        return len(self._due)
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def schedule(self, user_id, expiry):
+        if not self.running:
+            return
+        ts = expiry_timestamp(expiry)
+        if ts is None:
+            self.cancel(user_id)
+            return
+        self._due[user_id] = ts
+        heapq.heappush(self._heap, (ts, user_id))
+        self.stats["scheduled"] += 1
+        if self._heap[0][0] == ts:
+            self._wakeup.set()
+
+    def cancel(self, user_id):
+        self._due.pop(user_id, None)
+
+    def next_due(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        due = []
+        while True:
+            ts = self.next_due()
+            if ts is None or ts > now:
+                return due
+            entry = heapq.heappop(self._heap)
+            del self._due[entry[1]]
+            due.append(entry)
+
+    async def refresh_user(self, user_id):
+        user = await get_user(user_id)
+        if user and user.get("is_premium") and user.get("premium_expiry"):
+            self.schedule(user_id, user["premium_expiry"])
+        else:
+            self.cancel(user_id)
+
+    async def load(self):
+        heap, due = [], {}
+        cursor = db.users.find({"is_premium": True, "premium_expiry": {"$ne": None}}, {"user_id": 1, "premium_expiry": 1})
+        async for doc in cursor:
+            ts = expiry_timestamp(doc.get("premium_expiry"))
+            if ts is not None:
+                due[doc["user_id"]] = ts
+                heap.append((ts, doc["user_id"]))
+        heapq.heapify(heap)
+        self._heap, self._due = heap, due
+        self._wakeup.set()
+        return len(due)
+
+    async def start(self, bot):
+        self._bot = bot
+        if self._task is None:
+            self._stopping = False
+            await self.load()
+            self._task = asyncio.create_task(self._run())
+            self._notifier = asyncio.create_task(self._notify_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self._notifier is not None:
+            self._notifier.cancel()
+            try:
+                await self._notifier
+            except asyncio.CancelledError:
+                pass
+            self._notifier = None
+
+    async def _run(self):
+        last_reconcile = time.monotonic()
+        while not self._stopping:
+            self._wakeup.clear()
+            ts = self.next_due()
+            delay = MAX_SLEEP if ts is None else max(0.0, ts - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=min(delay, MAX_SLEEP))
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                break
+            try:
+                if time.monotonic() - last_reconcile >= RECONCILE_INTERVAL:
+                    last_reconcile = time.monotonic()
+                    await self.load()
+                await self.fire()
+            except Exception:
+                logger.exception("Premium expiry run failed")
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def fire(self, now=None):
+        now = time.time() if now is None else now
+        cutoff = now + BATCH_WINDOW
+        due = self.pop_due(cutoff)
+        if not due:
+            return []
+        try:
+            expired = await downgrade_premium_users([user_id for _, user_id in due],
+                                                    datetime.utcfromtimestamp(cutoff).isoformat())
+        except Exception:
+            for ts, user_id in due:
+                if user_id not in self._due:
+                    self._due[user_id] = ts
+                    heapq.heappush(self._heap, (ts, user_id))
+            raise
+        self.stats["batches"] += 1
+        self.stats["downgraded"] += len(expired)
+        for user_id in expired:
+            self._notify_queue.put_nowait(user_id)
+        if expired:
+            logger.info("Premium expired for %d users.", len(expired))
+        return expired
+
+    async def _notify_loop(self):
+        # Up to a second's worth of notices per batch, handed to the
+        # dispatcher without waiting on delivery.
+        while True:
+            batch = [await self._notify_queue.get()]
+            while len(batch) < max(1, int(NOTIFY_RATE)) and not self._notify_queue.empty():
+                batch.append(self._notify_queue.get_nowait())
+            for user_id in batch:
+                await self.bucket.acquire()
+                future = dispatcher.post(NOTICE, self._bot.send_message, chat_id=user_id, text=EXPIRED_TEXT)
+                future.add_done_callback(self._notified)
+
+    def _notified(self, future):
+        failed = future.cancelled() or future.exception() is not None
+        self.stats["notify_failed" if failed else "notified"] += 1
+
+scheduler = ExpiryScheduler()
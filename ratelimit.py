@@ -0,0 +1,122 @@
+"""ratelimit.py - per-user token buckets for messages and commands"""
+import functools
+import os
+import time
+from array import array
+from collections import OrderedDict
+
+def _limit(kind, rate, burst):
+    prefix = f"RATE_LIMIT_{kind.upper()}"
+    return float(os.getenv(f"{prefix}_RATE", str(rate))), float(os.getenv(f"{prefix}_BURST", str(burst)))
+
+# (tokens per second, bucket size) per kind of action.
+LIMITS = {
+    "text": _limit("text", 1 / 1.5, 3),
+    "media": _limit("media", 1 / 3, 2),
+    "command": _limit("command", 1 / 2, 3),
+}
+MAX_ENTRIES = int(os.getenv("RATE_LIMIT_MAX_ENTRIES", "200000"))
+EVICT_BATCH = 32
+SWEEP_INTERVAL = 300
+
+RATE_LIMIT_TEXT = "Rate limit: Please wait before sending another message."
+
+class BucketTable:
+    # Token buckets for one kind of action, stored as two parallel float
+    # arrays indexed by slot; the OrderedDict maps user -> slot in
+    # least-recently-used order. A bucket untouched for burst/rate seconds
+    # is full again, so dropping it loses nothing - that is the idle TTL.
+    __slots__ = ("rate", "burst", "idle", "max_entries", "_slots", "_tokens", "_stamps", "_free", "stats")
+
+    def __init__(self, rate, burst, max_entries=MAX_ENTRIES):
+        self.rate = rate
+        self.burst = burst
+        self.idle = burst / rate
+        self.max_entries = max_entries
+        self._slots = OrderedDict()
+        self._tokens = array("d")
+        self._stamps = array("d")
+        self._free = []
+        self.stats = {"allowed": 0, "limited": 0, "evicted": 0, "forced_evictions": 0}
+
+    def __len__(self):
+        return len(self._slots)
+
+    def allow(self, key, now=None, cost=1.0):
+        now = time.monotonic() if now is None else now
+        slot = self._slots.get(key)
+        if slot is None:
+            self._evict(now, EVICT_BATCH)
+            slot = self._alloc()
+            self._slots[key] = slot
+            tokens = self.burst
+        else:
+            self._slots.move_to_end(key)
+            tokens = min(self.burst, self._tokens[slot] + (now - self._stamps[slot]) * self.rate)
+        self._stamps[slot] = now
+        if tokens >= cost:
+            self._tokens[slot] = tokens - cost
+            self.stats["allowed"] += 1
+            return True
+        self._tokens[slot] = tokens
+        self.stats["limited"] += 1
+        return False
+
+    def _alloc(self):
+        if self._free:
+            return self._free.pop()
+        self._tokens.append(0.0)
+        self._stamps.append(0.0)
+        return len(self._tokens) - 1
+
+    def _evict(self, now, limit=None):
+        cutoff = now - self.idle
+        evicted = 0
+        while self._slots and (limit is None or evicted < limit):
+            key, slot = next(iter(self._slots.items()))
+            if self._stamps[slot] > cutoff:
+                if len(self._slots) < self.max_entries:
+                    break
+                # Over the cap with nobody idle: forget the least recently
+                # seen user, who gets a full bucket next time.
+                self.stats["forced_evictions"] += 1
+            del self._slots[key]
+            self._free.append(slot)
+            evicted += 1
+        self.stats["evicted"] += evicted
+        return evicted
+
+    def sweep(self, now=None):
+        return self._evict(time.monotonic() if now is None else now)
+
+class RateLimiter:
+    def __init__(self, limits=LIMITS, max_entries=MAX_ENTRIES):
+        self.tables = {kind: BucketTable(rate, burst, max_entries) for kind, (rate, burst) in limits.items()}
+
+    def allow(self, user_id, kind="text"):
+        return self.tables[kind].allow(user_id)
+
+    def sweep(self):
+        return sum(table.sweep() for table in self.tables.values())
+
+    def stats(self):
+        return {kind: {**table.stats, "size": len(table)} for kind, table in self.tables.items()}
+
+limiter = RateLimiter()
+
+def message_kind(message):
+    return "media" if message.effective_attachment else "text"
+
+def rate_limited(kind="command", reply="Please wait a moment before using this command again."):
+    # Wraps a handler so it is skipped (with a short reply) when the user
+    # is out of tokens for `kind`.
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if update.effective_user and not limiter.allow(update.effective_user.id, kind):
+                if update.effective_message:
+                    await update.effective_message.reply_text(reply)
+                return None
+            return await handler(update, context)
+        return wrapper
+    return decorator
@@ -0,0 +1,131 @@
+"""retention.py - archives closed rooms' chat logs and expires old archives"""
+import asyncio
+import logging
+import os
+import time
+from db import db, insert_chat_archive, HISTORY_SORT
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+# Closed rooms whose last message is older than this move to the archive.
+ARCHIVE_AFTER_DAYS = float(os.getenv("CHATLOG_ARCHIVE_AFTER_DAYS", "7"))
+# Archives whose last message is older than this are deleted unless a
+# report points at the room. 0 keeps them forever.
+DELETE_AFTER_DAYS = float(os.getenv("CHATLOG_DELETE_AFTER_DAYS", "180"))
+INTERVAL = float(os.getenv("CHATLOG_RETENTION_INTERVAL", "3600"))
+ROOMS_PER_PASS = int(os.getenv("CHATLOG_RETENTION_ROOMS_PER_PASS", "500"))
+SEGMENT_SIZE = 2000
+
+class ChatLogRetention:
+    # Hot tier: `chatlogs`, one document per message, indexed for paging.
+    # Archive tier: `chatlog_archives`, compressed per-room segments (see
+    # db.insert_chat_archive). Runs on shard 0 only; every step is safe to
+    # repeat, so an interrupted pass is finished by the next one.
+    def __init__(self, archive_after=ARCHIVE_AFTER_DAYS * DAY, delete_after=DELETE_AFTER_DAYS * DAY,
+                 interval=INTERVAL, rooms_per_pass=ROOMS_PER_PASS):
+        self.archive_after = archive_after
+        self.delete_after = delete_after
+        self.interval = interval
+        self.rooms_per_pass = rooms_per_pass
+        # room_id the last pass stopped after; None starts from the top.
+        self._last_room = None
+        self._task = None
+        self.stats = {"passes": 0, "rooms_archived": 0, "messages_archived": 0, "segments": 0,
+                      "rooms_deleted": 0, "rooms_kept_for_reports": 0}
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Chat log retention pass failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self, now=None):
+        now = time.time() if now is None else now
+        archived = await self.archive_closed_rooms(now - self.archive_after)
+        deleted = await self.delete_expired(now - self.delete_after) if self.delete_after > 0 else 0
+        self.stats["passes"] += 1
+        if archived or deleted:
+            logger.info("Chat log retention: %d rooms archived, %d rooms' archives deleted.", archived, deleted)
+        return archived, deleted
+
+    # -- archiving ----------------------------------------------------------------
+    async def archive_closed_rooms(self, cutoff):
+        # Walks rooms with old messages in room_id order, one indexed lookup
+        # per room, carrying on after the room the last pass stopped at. Open
+        # rooms are stepped over, so they can't hold the walk up; at the end
+        # it wraps round to the first room on the next pass.
+        archived = 0
+        for _ in range(self.rooms_per_pass):
+            query = {"timestamp": {"$lt": cutoff}}
+            if self._last_room is not None:
+                query["room_id"] = {"$gt": self._last_room}
+            doc = await db.chatlogs.find_one(query, {"room_id": 1}, sort=[("room_id", 1)])
+            if doc is None:
+                self._last_room = None
+                break
+            self._last_room = room_id = doc["room_id"]
+            if await self._archivable(room_id, cutoff):
+                await self.archive_room(room_id)
+                archived += 1
+        return archived
+
+    async def _archivable(self, room_id, cutoff):
+        # Closed (end_command deletes the room; close_room marks it
+        # inactive) and quiet since the cutoff.
+        if await db.rooms.find_one({"room_id": room_id, "active": True}, {"_id": 1}):
+            return False
+        newest = await db.chatlogs.find_one({"room_id": room_id}, {"timestamp": 1},
+                                            sort=[(field, -1) for field, _ in HISTORY_SORT])
+        return newest is not None and newest.get("timestamp", 0) < cutoff
+
+    async def archive_room(self, room_id):
+        segment = []
+        cursor = db.chatlogs.find({"room_id": room_id}).sort(HISTORY_SORT).batch_size(SEGMENT_SIZE)
+        async for doc in cursor:
+            segment.append(doc)
+            if len(segment) >= SEGMENT_SIZE:
+                await self._write(room_id, segment)
+                segment = []
+        if segment:
+            await self._write(room_id, segment)
+        self.stats["rooms_archived"] += 1
+
+    async def _write(self, room_id, segment):
+        await insert_chat_archive(room_id, segment)
+        self.stats["segments"] += 1
+        self.stats["messages_archived"] += len(segment)
+
+    # -- expiry -------------------------------------------------------------------
+    async def delete_expired(self, cutoff):
+        expired = await db.chatlog_archives.distinct("room_id", {"last_ts": {"$lt": cutoff}})
+        if not expired:
+            return 0
+        reported = set(await db.reports.distinct("room_id", {"room_id": {"$in": expired}}))
+        deleted = 0
+        for room_id in expired:
+            if room_id in reported:
+                self.stats["rooms_kept_for_reports"] += 1
+                continue
+            # Only segments wholly past the horizon go.
+            await db.chatlog_archives.delete_many({"room_id": room_id, "last_ts": {"$lt": cutoff}})
+            deleted += 1
+        self.stats["rooms_deleted"] += deleted
+        return deleted
+
+retention = ChatLogRetention()
@@ -1,29 +1,241 @@
 import uuid, time
+from collections import OrderedDict
 from db import db, insert_room, get_room, update_room
 from models import default_room
 
-users_online = set()  # Keep in memory for now
+POOL_FIELDS = ("gender", "region", "country", "language")
+
+def _prefs_tuple(prefs):
+    prefs = prefs or {}
+    return tuple(prefs.get(field) or "" for field in POOL_FIELDS)
+
+class MatchPool:
+    # Waiting users with their filter attributes, grouped by (attrs, prefs)
+    # class in arrival order, which is what the batch matchmaker pairs on.
+    # A class is dropped once its last user leaves, so `classes` only holds
+    # combinations somebody is waiting with.
+    def __init__(self):
+        self._attrs = {}
+        self._meta = {}
+        self.classes = {}
+        self._dirty = None
+
+    def track_changes(self):
+        # Opt-in so the set doesn't grow when nothing persists the pool.
+        if self._dirty is None:
+            self._dirty = set()
+
+    def drain_dirty(self):
+        dirty, self._dirty = self._dirty, (set() if self._dirty is not None else None)
+        return dirty or ()
+
+    def __contains__(self, user_id):
+        return user_id in self._attrs
+
+    def __len__(self):
+        return len(self._attrs)
+
+    def __iter__(self):
+        return iter(list(self._attrs))
+
+    def add(self, user_id, user=None, prefs=None, since=None):
+        user = user or {}
+        attrs = tuple(user.get(field) or "" for field in POOL_FIELDS)
+        prefs = _prefs_tuple(prefs)
+        if user_id in self._attrs:
+            # Searching again keeps the user's place in the queue.
+            if self._attrs[user_id] == attrs and self._meta[user_id][1] == prefs:
+                return
+            since = since or self._meta[user_id][0]
+            self.discard(user_id)
+        since = since or time.time()
+        self._attrs[user_id] = attrs
+        self._meta[user_id] = (since, prefs)
+        self.classes.setdefault((attrs, prefs), OrderedDict())[user_id] = since
+        if self._dirty is not None:
+            self._dirty.add(user_id)
+
+    def discard(self, user_id):
+        attrs = self._attrs.pop(user_id, None)
+        if attrs is None:
+            return
+        since, prefs = self._meta.pop(user_id)
+        queue = self.classes[(attrs, prefs)]
+        del queue[user_id]
+        if not queue:
+            del self.classes[(attrs, prefs)]
+        if self._dirty is not None:
+            self._dirty.add(user_id)
+
+    def attrs(self, user_id):
+        attrs = self._attrs.get(user_id)
+        return dict(zip(POOL_FIELDS, attrs)) if attrs else None
+
+    def attrs_key(self, user_id):
+        # The user's (attrs, prefs) class key.
+        return self._attrs[user_id], self._meta[user_id][1]
+
+    def entry(self, user_id):
+        attrs = self._attrs.get(user_id)
+        if attrs is None:
+            return None
+        since, prefs = self._meta[user_id]
+        return {
+            "attrs": dict(zip(POOL_FIELDS, attrs)),
+            "prefs": {field: value for field, value in zip(POOL_FIELDS, prefs) if value},
+            "since": since,
+        }
+
+class RoomDirectory:
+    # user -> room -> partner for every active room, kept in step with the
+    # rooms collection so the relay path never has to read Mongo.
+    def __init__(self):
+        self._rooms = {}
+        self._user_room = {}
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def bind(self, room_id, users, created_at=None):
+        users = tuple(users)
+        self._rooms[room_id] = {"room_id": room_id, "users": users, "created_at": created_at}
+        for uid in users:
+            self._user_room[uid] = room_id
+
+    def unbind(self, room_id):
+        room = self._rooms.pop(room_id, None)
+        if room is None:
+            return ()
+        for uid in room["users"]:
+            if self._user_room.get(uid) == room_id:
+                del self._user_room[uid]
+        return room["users"]
+
+    def get(self, room_id):
+        return self._rooms.get(room_id)
+
+    def rooms(self):
+        return list(self._rooms.values())
+
+    def room_of(self, user_id):
+        return self._user_room.get(user_id)
+
+    def partner_of(self, user_id):
+        room = self._rooms.get(self._user_room.get(user_id))
+        if room is None:
+            return None
+        for uid in room["users"]:
+            if uid != user_id:
+                return uid
+        return None
+
+class LocalMatchState:
+    # Waiting pool and room events for a single process. Sharded workers
+    # swap in sharedstate.MongoMatchState so users on different shards can
+    # still be paired.
+    # Matches are made by the matchmaker's ticks, not at request time.
+    batched = True
+
+    async def start(self, on_match):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def request_match(self, user_id, user=None, prefs=None):
+        users_online.add(user_id, user, prefs)
+        return None
+
+    async def add_waiting(self, user_id, user=None, prefs=None):
+        users_online.add(user_id, user, prefs)
+
+    async def remove_waiting(self, user_id):
+        users_online.discard(user_id)
+
+    async def drop_waiting(self, user_ids):
+        # Returns the users that were still waiting.
+        dropped = [uid for uid in user_ids if uid in users_online]
+        for uid in dropped:
+            users_online.discard(uid)
+        return dropped
+
+    async def waiting_users(self):
+        return list(users_online)
+
+    def owns_room(self, users):
+        return True
+
+    def room_bound(self, room_id, users, created_at):
+        pass
+
+    def room_unbound(self, room_id, users):
+        pass
+
+    def room_active(self, room_id, users):
+        pass
+
+users_online = MatchPool()
+directory = RoomDirectory()
+state = LocalMatchState()
+# lifecycle.Lifecycle while it runs; told about rooms and waits starting
+# and ending.
+watcher = None
+
+def use_state(backend):
+    global state
+    state = backend
+
+def watch(target):
+    global watcher
+    watcher = target
+
+def apply_event(event):
+    # Room changes made by another shard for users this shard owns.
+    if event["op"] == "bind":
+        directory.bind(event["room_id"], event["users"], event.get("created_at"))
+        if watcher:
+            watcher.room_opened(event["room_id"], event["users"])
+    elif event["op"] == "unbind":
+        directory.unbind(event["room_id"])
+        if watcher:
+            watcher.room_closed(event["room_id"])
+
+async def load_directory():
+    async for room in db.rooms.find({"active": True}, {"room_id": 1, "users": 1, "created_at": 1}):
+        directory.bind(room["room_id"], room.get("users", []), room.get("created_at"))
+    return len(directory)
 
 async def create_room(user1: int, user2: int):
     room_id = uuid.uuid4().hex[:8]
     room_data = default_room(room_id, user1, user2)
     await insert_room(room_data)
-    users_online.discard(user1)
-    users_online.discard(user2)
+    directory.bind(room_id, (user1, user2), room_data["created_at"])
+    state.room_bound(room_id, (user1, user2), room_data["created_at"])
+    await state.remove_waiting(user1)
+    await state.remove_waiting(user2)
+    if watcher:
+        watcher.room_opened(room_id, (user1, user2))
+        watcher.waiting_ended(user1)
+        watcher.waiting_ended(user2)
     return room_id
 
 async def close_room(room_id: str):
+    users = directory.unbind(room_id)
+    state.room_unbound(room_id, users)
+    if watcher:
+        watcher.room_closed(room_id)
     await update_room(room_id, {"active": False})
 
-async def find_match_for(user_id: int, prefer_filters=None):
-    # Prefer filters: gender, region, country, premium_only
-    candidates = [uid for uid in users_online if uid != user_id]
-    # TODO: Use DB to filter based on matching_preferences
-    # For now, just pick the first available
-    return candidates[0] if candidates else None
+def room_of(user_id: int):
+    return directory.room_of(user_id)
 
-def add_to_pool(user_id: int):
-    users_online.add(user_id)
+def partner_of(user_id: int):
+    return directory.partner_of(user_id)
 
-def remove_from_pool(user_id: int):
-    users_online.discard(user_id)
\ No newline at end of file
+async def request_match(user_id: int, user=None, prefs=None):
+    # Returns a partner straight away when the backend matches on request;
+    # otherwise the user waits and the matchmaker pairs them on its next tick.
+    partner = await state.request_match(user_id, user, prefs)
+    if partner is None and watcher:
+        watcher.waiting_started(user_id)
+    return partner
@@ -0,0 +1,161 @@
+"""sharedstate.py - cross-shard matchmaking state backed by Mongo"""
+import asyncio
+import logging
+import os
+import time
+from db import db
+from rooms import POOL_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# How often each shard looks for pairs among its own waiting users.
+SWEEP_INTERVAL = float(os.getenv("MATCH_SWEEP_INTERVAL", "5"))
+
+def shard_of(user_id, shards):
+    return user_id % shards
+
+def _attrs(user):
+    user = user or {}
+    return {field: user.get(field) or "" for field in POOL_FIELDS}
+
+def _partner_query(user_id, filters=None, attrs=None):
+    # `filters` are the requester's prefs, applied to the waiters'
+    # attributes. `attrs` are the requester's own; when given, waiters
+    # whose prefs rule the requester out are skipped. Waiting documents
+    # written before prefs were stored accept anyone.
+    query = {"_id": {"$ne": user_id}}
+    for field, value in (filters or {}).items():
+        if field in POOL_FIELDS and value:
+            query[field] = value
+    if attrs is not None:
+        for field in POOL_FIELDS:
+            query[f"prefs.{field}"] = {"$in": ["", None, attrs.get(field) or ""]}
+    return query
+
+class MongoMatchState:
+    # The waiting pool lives in one collection so any shard can claim any
+    # waiting user; find_one_and_delete makes the claim atomic. Room
+    # bindings are pushed to the shards owning the other user so their
+    # in-memory directories stay current without Mongo reads on relay.
+    def __init__(self, shard, shards, publish, collection=None):
+        self.shard = shard
+        self.shards = shards
+        self.publish = publish
+        self.collection = collection if collection is not None else db.waiting
+        self._task = None
+
+    # Cross-shard pairing stays claim-on-request. Filtering is mutual, as
+    # in the local matchmaker: the requester's prefs are applied to the
+    # waiter's attributes and the waiter's stored prefs to the requester's.
+    batched = False
+
+    async def request_match(self, user_id, user=None, prefs=None):
+        partner = await self.claim(user_id, prefs, _attrs(user))
+        if partner is None:
+            await self.add_waiting(user_id, user, prefs)
+            # Two users on different shards can both miss each other's
+            # claim and both end up waiting. Now that this one is visible,
+            # look again; sweep() catches whatever still slips through.
+            partner = await self._rematch(await self.collection.find_one({"_id": user_id}))
+        return partner
+
+    async def add_waiting(self, user_id, user=None, prefs=None):
+        prefs = prefs or {}
+        await self.collection.update_one(
+            {"_id": user_id},
+            {"$set": {**_attrs(user), "prefs": {field: prefs.get(field) or "" for field in POOL_FIELDS},
+                      "shard": self.shard, "since": time.time()}},
+            upsert=True,
+        )
+
+    async def remove_waiting(self, user_id):
+        await self.collection.delete_one({"_id": user_id})
+
+    async def claim(self, user_id, filters=None, attrs=None):
+        doc = await self.collection.find_one_and_delete(_partner_query(user_id, filters, attrs), sort=[("since", 1)])
+        return doc["_id"] if doc else None
+
+    async def _rematch(self, doc):
+        # Pairs an already waiting user with a compatible waiter. The user
+        # leaves the pool before claiming, so a concurrent claim of them
+        # and this one can't both succeed: whichever delete comes second
+        # finds nothing.
+        if doc is None:
+            return None
+        query = _partner_query(doc["_id"], doc.get("prefs"), _attrs(doc))
+        if await self.collection.find_one(query, {"_id": 1}) is None:
+            return None
+        if not (await self.collection.delete_one({"_id": doc["_id"]})).deleted_count:
+            return None
+        partner = await self.collection.find_one_and_delete(query, sort=[("since", 1)])
+        if partner is None:
+            # Taken by someone else meanwhile; back in line, same place.
+            await self.collection.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+            return None
+        return partner["_id"]
+
+    async def sweep(self, on_match):
+        # Retries this shard's waiting users, oldest first. Returns the
+        # number of pairs made.
+        matched = 0
+        waiting = await self.collection.find({"shard": self.shard}).sort("since", 1).to_list(None)
+        for doc in waiting:
+            partner = await self._rematch(doc)
+            if partner is not None:
+                await on_match(doc["_id"], partner)
+                matched += 1
+        return matched
+
+    async def start(self, on_match):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(on_match))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, on_match):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                matched = await self.sweep(on_match)
+                if matched:
+                    logger.info("Waiting pool sweep paired %d users.", matched * 2)
+            except Exception:
+                logger.exception("Waiting pool sweep failed")
+
+    async def drop_waiting(self, user_ids):
+        # Returns the users that were still waiting. One delete each, so a
+        # user claimed in between is not reported as dropped.
+        results = await asyncio.gather(*(self.collection.delete_one({"_id": uid}) for uid in user_ids))
+        return [uid for uid, result in zip(user_ids, results) if result.deleted_count]
+
+    async def waiting_users(self):
+        # The ones this shard answers for.
+        return [doc["_id"] async for doc in self.collection.find({}, {"_id": 1})
+                if shard_of(doc["_id"], self.shards) == self.shard]
+
+    def owns_room(self, users):
+        # Idle rooms are closed by the shard owning the lowest user id.
+        return shard_of(min(users), self.shards) == self.shard
+
+    def _notify(self, event, users):
+        for target in {shard_of(uid, self.shards) for uid in users}:
+            if target != self.shard:
+                self.publish(target, event)
+
+    def room_bound(self, room_id, users, created_at):
+        self._notify({"op": "bind", "room_id": room_id, "users": list(users), "created_at": created_at}, users)
+
+    def room_unbound(self, room_id, users):
+        self._notify({"op": "unbind", "room_id": room_id}, users)
+
+    def room_active(self, room_id, users):
+        target = shard_of(min(users), self.shards)
+        if target != self.shard:
+            self.publish(target, {"op": "touch", "room_id": room_id})
@@ -1,51 +1,710 @@
+"""storage.py - storage backends: MongoDB through Motor, or a local embedded engine
 
-"""storage.py - atomic JSON storage helpers"""
-import json
-from pathlib import Path
-from tempfile import NamedTemporaryFile
+db.py talks to a Motor-style database handle: `db.<collection>` with the
+collection methods this project uses (find/find_one with the $-operators
+we query with, updates with $set/$unset/$inc/$setOnInsert/$push,
+bulk_write, find_one_and_delete, distinct, count_documents). Two
+backends provide one, picked by STORAGE_BACKEND:
+
+- mongo (default): Motor on MONGODB_URI.
+- local: MemoryDatabase, an in-process engine with hash indexes, made
+  durable by JournalDatabase: every write appends the document's new
+  state to a journal, and the journal is periodically compacted into a
+  snapshot. A write costs one appended line instead of a rewrite of the
+  data set. Single process only (CLUSTER_WORKERS=1).
+"""
+import asyncio
+import logging
 import os
+import random
 import threading
+import time
+from collections import Counter
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import (
+    BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+)
+
+logger = logging.getLogger(__name__)
 
 BASE = Path(__file__).parent
 DATA_DIR = BASE / 'data'
 DATA_DIR.mkdir(exist_ok=True)
 
-USER_FILE = DATA_DIR / 'user_data.json'
-ROOMS_FILE = DATA_DIR / 'rooms.json'
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")  # mongo | local
+MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+MONGODB_DB = os.getenv("MONGODB_DB", "anonindochat")
+LOCAL_DB_PATH = Path(os.getenv("LOCAL_DB_PATH", str(DATA_DIR / "local")))
+# The journal is fsynced this often; a crash of the machine (not just the
+# process) can lose at most this much.
+LOCAL_DB_FSYNC_INTERVAL = float(os.getenv("LOCAL_DB_FSYNC_INTERVAL", "1.0"))
+# Compact once the journal holds more records than live documents, and at
+# least this many.
+LOCAL_DB_COMPACT_MIN = int(os.getenv("LOCAL_DB_COMPACT_MIN", "10000"))
+# Same variable as cluster.py; the local engine cannot be shared by shards.
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "1"))
+COMPACT_CHUNK = 1000
 
 _lock = threading.Lock()
 
-def _atomic_write(path: Path, data):
+def _atomic_write(path: Path, text):
     tmp = None
     with _lock:
         tmp = NamedTemporaryFile('w', delete=False, dir=str(path.parent), encoding='utf-8')
         try:
-            json.dump(data, tmp, ensure_ascii=False, indent=2)
+            tmp.write(text)
             tmp.flush()
             os.fsync(tmp.fileno())
         finally:
             tmp.close()
         os.replace(tmp.name, path)
 
-def load_json(path: Path, default=None):
-    if default is None:
-        default = {}
+def _copy(value):
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+def _get(doc, path):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            if part not in value:
+                return _MISSING
+            value = value[part]
+        else:
+            return _MISSING
+    return value
+
+_MISSING = object()
+
+def _hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+def _compare(a, b, op):
     try:
-        if path.exists():
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception:
-        return default
-    return default
+        return op(a, b)
+    except TypeError:
+        return False
+
+_OPS = {
+    "$lt": lambda a, b: _compare(a, b, lambda x, y: x < y),
+    "$lte": lambda a, b: _compare(a, b, lambda x, y: x <= y),
+    "$gt": lambda a, b: _compare(a, b, lambda x, y: x > y),
+    "$gte": lambda a, b: _compare(a, b, lambda x, y: x >= y),
+}
+
+def _matches_value(value, cond):
+    if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+        for op, arg in cond.items():
+            present = value is not _MISSING
+            if op == "$eq":
+                if not _equals(value, arg):
+                    return False
+            elif op == "$ne":
+                if _equals(value, arg):
+                    return False
+            elif op == "$in":
+                if not any(_equals(value, item) for item in arg):
+                    return False
+            elif op == "$nin":
+                if any(_equals(value, item) for item in arg):
+                    return False
+            elif op == "$exists":
+                if present != bool(arg):
+                    return False
+            elif op in _OPS:
+                if not present or not _OPS[op](value, arg):
+                    return False
+            else:
+                raise NotImplementedError(f"query operator {op}")
+        return True
+    return _equals(value, cond)
+
+def _equals(value, cond):
+    if value is _MISSING:
+        return cond is None
+    if isinstance(value, list) and not isinstance(cond, list):
+        return cond in value
+    return value == cond
+
+def matches(doc, query):
+    for key, cond in (query or {}).items():
+        if key == "$or":
+            if not any(matches(doc, sub) for sub in cond):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, sub) for sub in cond):
+                return False
+        elif not _matches_value(_get(doc, key), cond):
+            return False
+    return True
+
+def _set_path(doc, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+def _unset_path(doc, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+def apply_update(doc, update, inserting=False):
+    if not any(key.startswith("$") for key in update):
+        # Replacement document.
+        kept = doc.get("_id")
+        doc.clear()
+        doc.update(_copy(update))
+        if kept is not None:
+            doc["_id"] = kept
+        return
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == "$set":
+                _set_path(doc, path, _copy(value))
+            elif op == "$setOnInsert":
+                if inserting:
+                    _set_path(doc, path, _copy(value))
+            elif op == "$unset":
+                _unset_path(doc, path)
+            elif op == "$inc":
+                current = _get(doc, path)
+                _set_path(doc, path, (0 if current is _MISSING else current) + value)
+            elif op == "$push":
+                current = _get(doc, path)
+                _set_path(doc, path, ([] if current is _MISSING else current) + [_copy(value)])
+            else:
+                raise NotImplementedError(f"update operator {op}")
+
+def _project(doc, projection):
+    if not projection:
+        return _copy(doc)
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    if include:
+        out = {k: _copy(doc[k]) for k in include if k in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        return out
+    exclude = {k for k, v in projection.items() if not v}
+    return {k: _copy(v) for k, v in doc.items() if k not in exclude}
+
+def _sort_key(value):
+    # Mongo's cross-type order, reduced to what we store.
+    if value is _MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (4, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, ObjectId):
+        return (3, value.binary)
+    return (5, repr(value))
+
+def sort_docs(docs, sort):
+    for field, direction in reversed(list(sort)):
+        docs.sort(key=lambda d: _sort_key(_get(d, field)), reverse=direction < 0)
+    return docs
+
+class MemoryCursor:
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key, direction=None):
+        self._sort = [(key, direction or 1)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def _run(self):
+        docs = self._collection._select(self._query)
+        if self._sort:
+            docs = sort_docs(docs, self._sort)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [_project(doc, self._projection) for doc in docs]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._results is None:
+            await self._collection._db._op(self._collection.name, "find")
+            self._results = iter(self._run())
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        await self._collection._db._op(self._collection.name, "find")
+        docs = self._run()
+        return docs if length is None else docs[:length]
+
+    async def explain(self):
+        return {"queryPlanner": {"winningPlan": {"stage": "MEMORY"}}}
+
+class MemoryCollection:
+    # Documents by _id in insertion order plus a hash index per indexed
+    # field (the first key of each create_indexes model), which is what
+    # keeps equality lookups O(1) for large harness runs.
+    def __init__(self, db, name):
+        self._db = db
+        self.name = name
+        self._docs = {}
+        self._indexes = {}
+        self._unique = set()
+
+    # -- indexing ---------------------------------------------------------
+    def _index_add(self, doc):
+        for field, index in self._indexes.items():
+            value = _get(doc, field)
+            if value is _MISSING:
+                continue
+            bucket = index.setdefault(_hashable(value), set())
+            if field in self._unique and bucket and doc["_id"] not in bucket:
+                raise DuplicateKeyError(f"E11000 duplicate key on {self.name}.{field}: {value!r}", 11000)
+            bucket.add(doc["_id"])
+
+    def _index_remove(self, doc):
+        for field, index in self._indexes.items():
+            value = _get(doc, field)
+            if value is _MISSING:
+                continue
+            bucket = index.get(_hashable(value))
+            if bucket is not None:
+                bucket.discard(doc["_id"])
+                if not bucket:
+                    del index[_hashable(value)]
+
+    def _select(self, query):
+        query = query or {}
+        if "_id" in query and not isinstance(query["_id"], dict):
+            doc = self._docs.get(query["_id"])
+            return [doc] if doc is not None and matches(doc, query) else []
+        for field, index in self._indexes.items():
+            cond = query.get(field, _MISSING)
+            if cond is _MISSING or isinstance(cond, (dict, list)):
+                continue
+            ids = index.get(_hashable(cond), ())
+            return [doc for doc in (self._docs[i] for i in ids) if matches(doc, query)]
+        return [doc for doc in self._docs.values() if matches(doc, query)]
+
+    def _store(self, doc):
+        doc.setdefault("_id", ObjectId())
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key on {self.name}._id: {doc['_id']!r}", 11000)
+        self._index_add(doc)
+        self._docs[doc["_id"]] = doc
+        self._db._saved(self.name, doc)
+        return doc["_id"]
+
+    def _replace(self, doc, update, inserting=False):
+        self._index_remove(doc)
+        before = _copy(doc)
+        apply_update(doc, update, inserting)
+        try:
+            self._index_add(doc)
+        except DuplicateKeyError:
+            doc.clear()
+            doc.update(before)
+            self._index_add(doc)
+            raise
+        if doc == before:
+            return False
+        self._db._saved(self.name, doc)
+        return True
+
+    def _upsert_doc(self, query, update):
+        doc = {k: _copy(v) for k, v in query.items()
+               if not k.startswith("$") and not (isinstance(v, dict) and any(x.startswith("$") for x in v))}
+        apply_update(doc, update, inserting=True)
+        return self._store(doc)
+
+    # -- Motor API ----------------------------------------------------------
+    async def create_indexes(self, models):
+        await self._db._op(self.name, "create_indexes")
+        names = []
+        for model in models:
+            spec = model.document
+            field = next(iter(spec["key"]))
+            if field not in self._indexes:
+                self._indexes[field] = {}
+                for doc in self._docs.values():
+                    self._index_add(doc)
+            if spec.get("unique"):
+                self._unique.add(field)
+            names.append(spec.get("name", field))
+        return names
+
+    async def create_index(self, keys, **kwargs):
+        from pymongo import IndexModel
+        return (await self.create_indexes([IndexModel(keys, **kwargs)]))[0]
+
+    def find(self, query=None, projection=None, **kwargs):
+        cursor = MemoryCursor(self, query, projection)
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        if kwargs.get("limit"):
+            cursor.limit(kwargs["limit"])
+        return cursor
 
-def save_users(data: dict):
-    _atomic_write(USER_FILE, data)
+    async def find_one(self, query=None, projection=None, sort=None):
+        await self._db._op(self.name, "find_one")
+        docs = self._select(query)
+        if sort:
+            docs = sort_docs(docs, sort)
+        return _project(docs[0], projection) if docs else None
 
-def save_rooms(data: dict):
-    _atomic_write(ROOMS_FILE, data)
+    async def find_one_and_delete(self, query, sort=None, projection=None):
+        await self._db._op(self.name, "find_one_and_delete")
+        docs = self._select(query)
+        if sort:
+            docs = sort_docs(docs, sort)
+        if not docs:
+            return None
+        doc = self._docs.pop(docs[0]["_id"])
+        self._index_remove(doc)
+        self._db._deleted(self.name, doc["_id"])
+        return _project(doc, projection)
 
-def load_users():
-    return load_json(USER_FILE, {})
+    async def insert_one(self, doc):
+        await self._db._op(self.name, "insert_one")
+        stored = _copy(doc)
+        inserted_id = self._store(stored)
+        doc.setdefault("_id", inserted_id)
+        return InsertOneResult(inserted_id, True)
 
-def load_rooms():
-    return load_json(ROOMS_FILE, {})
+    async def insert_many(self, docs, ordered=True):
+        await self._db._op(self.name, "insert_many")
+        ids, errors = [], []
+        for i, doc in enumerate(docs):
+            stored = _copy(doc)
+            try:
+                ids.append(self._store(stored))
+                doc.setdefault("_id", stored["_id"])
+            except DuplicateKeyError as e:
+                errors.append({"index": i, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(ids)})
+        return InsertManyResult(ids, True)
+
+    def _update(self, query, update, upsert, many):
+        docs = self._select(query)
+        if not many:
+            docs = docs[:1]
+        modified = sum(1 for doc in docs if self._replace(doc, update))
+        raw = {"n": len(docs), "nModified": modified}
+        if not docs and upsert:
+            raw["upserted"] = self._upsert_doc(query, update)
+            raw["n"] = 1
+        return raw
+
+    async def update_one(self, query, update, upsert=False):
+        await self._db._op(self.name, "update_one")
+        return UpdateResult(self._update(query, update, upsert, many=False), True)
+
+    async def update_many(self, query, update, upsert=False):
+        await self._db._op(self.name, "update_many")
+        return UpdateResult(self._update(query, update, upsert, many=True), True)
+
+    async def replace_one(self, query, doc, upsert=False):
+        await self._db._op(self.name, "replace_one")
+        return UpdateResult(self._update(query, doc, upsert, many=False), True)
+
+    def _delete(self, query, many):
+        docs = self._select(query)
+        if not many:
+            docs = docs[:1]
+        for doc in docs:
+            self._index_remove(self._docs.pop(doc["_id"]))
+            self._db._deleted(self.name, doc["_id"])
+        return {"n": len(docs)}
+
+    async def delete_one(self, query):
+        await self._db._op(self.name, "delete_one")
+        return DeleteResult(self._delete(query, many=False), True)
+
+    async def delete_many(self, query):
+        await self._db._op(self.name, "delete_many")
+        return DeleteResult(self._delete(query, many=True), True)
+
+    async def count_documents(self, query):
+        await self._db._op(self.name, "count_documents")
+        return len(self._select(query))
+
+    async def estimated_document_count(self):
+        await self._db._op(self.name, "estimated_document_count")
+        return len(self._docs)
+
+    async def distinct(self, field, query=None):
+        await self._db._op(self.name, "distinct")
+        seen = {}
+        for doc in self._select(query):
+            value = _get(doc, field)
+            if value is not _MISSING:
+                seen.setdefault(_hashable(value), value)
+        return list(seen.values())
+
+    async def bulk_write(self, ops, ordered=True):
+        await self._db._op(self.name, "bulk_write")
+        result = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0,
+                  "upserted": [], "writeErrors": []}
+        for i, op in enumerate(ops):
+            kind = type(op).__name__
+            try:
+                if kind == "InsertOne":
+                    self._store(_copy(op._doc))
+                    result["nInserted"] += 1
+                elif kind in ("UpdateOne", "UpdateMany", "ReplaceOne"):
+                    raw = self._update(op._filter, op._doc, op._upsert, many=kind == "UpdateMany")
+                    if "upserted" in raw:
+                        result["nUpserted"] += 1
+                        result["upserted"].append({"index": i, "_id": raw["upserted"]})
+                    else:
+                        result["nMatched"] += raw["n"]
+                        result["nModified"] += raw["nModified"]
+                elif kind in ("DeleteOne", "DeleteMany"):
+                    result["nRemoved"] += self._delete(op._filter, many=kind == "DeleteMany")["n"]
+                else:
+                    raise NotImplementedError(kind)
+            except DuplicateKeyError as e:
+                result["writeErrors"].append({"index": i, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+class MemoryDatabase:
+    # Attribute and item access return the same collection object, like
+    # Motor, so modules can hold `db` and index into it freely. Every call
+    # is counted by (collection, op).
+    def __init__(self, name="memory"):
+        self.name = name
+        self.calls = Counter()
+        self._collections = {}
+
+    async def _op(self, collection, op):
+        self.calls[(collection, op)] += 1
+        await asyncio.sleep(0)
+
+    def _saved(self, collection, doc):
+        pass
+
+    def _deleted(self, collection, doc_id):
+        pass
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = MemoryCollection(self, name)
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+class JournalDatabase(MemoryDatabase):
+    # <path>/snapshot.jsonl holds one {"c": collection, "d": doc} line per
+    # document; <path>/journal.jsonl appends the same for every write, or
+    # {"c": collection, "x": _id} for a delete. Records are full documents,
+    # so replaying snapshot then journal in order is idempotent.
+    #
+    # Compaction moves the journal aside to journal.jsonl.1, keeps writing
+    # to a fresh journal, serialises the documents in chunks between which
+    # the loop keeps running, replaces the snapshot and drops .1. Until
+    # then a restart replays snapshot, .1 and the journal, which is still
+    # correct; a document changed mid-compaction is in the new journal too.
+    def __init__(self, path=LOCAL_DB_PATH, name="local"):
+        super().__init__(name)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._snapshot = self.path / "snapshot.jsonl"
+        self._journal_path = self.path / "journal.jsonl"
+        self._moved = self.path / "journal.jsonl.1"
+        self._records = 0
+        self._dirty = False
+        self._compacting = False
+        self.stats = {"loaded": 0, "written": 0, "compactions": 0}
+        self._load()
+        self._journal = open(self._journal_path, "a", encoding="utf-8")
+
+    # -- loading ------------------------------------------------------------
+    def _load(self):
+        for path in (self._snapshot, self._moved, self._journal_path):
+            if path.exists():
+                self._replay(path)
+        self.stats["loaded"] = sum(len(c._docs) for c in self._collections.values())
+
+    def _replay(self, path):
+        with open(path, encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    record = json_util.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-append.
+                    logger.warning("Skipping unreadable record %s:%d", path.name, number)
+                    continue
+                docs = self[record["c"]]._docs
+                if "d" in record:
+                    docs[record["d"]["_id"]] = record["d"]
+                else:
+                    docs.pop(record["x"], None)
+                if path != self._snapshot:
+                    self._records += 1
+
+    # -- writing ------------------------------------------------------------
+    def _append(self, record):
+        # One buffered write, flushed to the OS so a process crash loses
+        # nothing; fsync happens in flush().
+        self._journal.write(json_util.dumps(record) + "\n")
+        self._journal.flush()
+        self._records += 1
+        self._dirty = True
+        self.stats["written"] += 1
+
+    def _saved(self, collection, doc):
+        self._append({"c": collection, "d": doc})
+
+    def _deleted(self, collection, doc_id):
+        self._append({"c": collection, "x": doc_id})
+
+    def flush(self):
+        if self._dirty:
+            self._dirty = False
+            os.fsync(self._journal.fileno())
+
+    def wants_compaction(self):
+        live = sum(len(c._docs) for c in self._collections.values())
+        return not self._compacting and self._records > max(LOCAL_DB_COMPACT_MIN, live)
+
+    async def compact(self):
+        if self._compacting:
+            return
+        self._compacting = True
+        started = time.monotonic()
+        try:
+            self.flush()
+            self._journal.close()
+            if self._moved.exists():
+                # Left by a compaction that died; keep its records ahead of
+                # the journal's.
+                with open(self._moved, "a", encoding="utf-8") as out, open(self._journal_path, encoding="utf-8") as f:
+                    out.writelines(f)
+                os.remove(self._journal_path)
+            else:
+                os.replace(self._journal_path, self._moved)
+            self._journal = open(self._journal_path, "a", encoding="utf-8")
+            self._records = 0
+            lines = []
+            for collection in list(self._collections.values()):
+                docs = list(collection._docs.values())
+                for i in range(0, len(docs), COMPACT_CHUNK):
+                    lines.extend(json_util.dumps({"c": collection.name, "d": doc}) + "\n"
+                                 for doc in docs[i:i + COMPACT_CHUNK])
+                    await asyncio.sleep(0)
+            await asyncio.to_thread(_atomic_write, self._snapshot, "".join(lines))
+            os.remove(self._moved)
+            self.stats["compactions"] += 1
+            logger.info("Local storage compacted: %d documents in %.2fs", len(lines), time.monotonic() - started)
+        finally:
+            self._compacting = False
+
+    def close(self):
+        self.flush()
+        self._journal.close()
+
+class MongoBackend:
+    shared = True
+
+    def __init__(self, uri=MONGODB_URI, name=MONGODB_DB):
+        from motor.motor_asyncio import AsyncIOMotorClient
+        self.client = AsyncIOMotorClient(uri)
+        self.db = self.client[name]
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        self.client.close()
+
+class LocalBackend:
+    # Runs the journal's fsync and compaction in the background.
+    shared = False
+
+    def __init__(self, path=LOCAL_DB_PATH):
+        self.db = JournalDatabase(path)
+        self._task = None
+        logger.info("Local storage at %s: %d documents loaded.", path, self.db.stats["loaded"])
+
+    async def start(self):
+        if CLUSTER_WORKERS > 1:
+            # Each shard would load its own copy and journal over the others.
+            raise RuntimeError("STORAGE_BACKEND=local keeps its data in one process; set CLUSTER_WORKERS=1 or use mongo.")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.db.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(LOCAL_DB_FSYNC_INTERVAL)
+            try:
+                self.db.flush()
+                if self.db.wants_compaction():
+                    await self.db.compact()
+            except Exception:
+                logger.exception("Local storage maintenance failed")
+
+BACKENDS = {"mongo": MongoBackend, "local": LocalBackend}
+
+def open_backend(kind=STORAGE_BACKEND):
+    try:
+        return BACKENDS[kind]()
+    except KeyError:
+        raise ValueError(f"Unknown STORAGE_BACKEND {kind!r}; expected one of {', '.join(BACKENDS)}") from None
@@ -0,0 +1,25 @@
+"""Shared test setup. Project modules read their settings at import time,
+so the environment is fixed here, before any of them is imported: storage
+is the local engine in a throwaway directory, never a real Mongo."""
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ["STORAGE_BACKEND"] = "local"
+os.environ["LOCAL_DB_PATH"] = tempfile.mkdtemp(prefix="anonindochat-tests-")
+
+@pytest.fixture
+def db():
+    # The process-wide database, emptied before each test.
+    from db import db as database
+
+    async def clear():
+        for name in list(database._collections):
+            await database[name].delete_many({})
+    asyncio.run(clear())
+    return database
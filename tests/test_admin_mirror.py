@@ -0,0 +1,16 @@
+from admin_mirror import AdminMirror, TEXT_LIMIT
+
+HEADER = "📢 Room #abcd1234\n👥 1 (@someone) ↔ 2 (@other)\nRoom Created: 2026-01-01T00:00:00"
+
+def test_digest_chunks_fit_the_text_limit():
+    lines = ["short line"] * 50 + ["x" * 10_000] + ["y" * (TEXT_LIMIT - 5)] * 3 + ["z" * 300] * 40
+    chunks = list(AdminMirror._digest_chunks(HEADER, lines))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= TEXT_LIMIT for chunk in chunks)
+    assert all(chunk.startswith(HEADER) for chunk in chunks)
+
+def test_digest_keeps_lines_in_order():
+    lines = [f"line {i}" for i in range(2000)]
+    chunks = list(AdminMirror._digest_chunks(HEADER, lines))
+    body = [line for chunk in chunks for line in chunk.split("\n")[HEADER.count("\n") + 2:]]
+    assert body == lines
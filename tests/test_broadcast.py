@@ -0,0 +1,49 @@
+import asyncio
+from broadcast import Broadcaster, _Run
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append(chat_id)
+
+    async def edit_message_text(self, chat_id, message_id, text):
+        pass
+
+def _doc(checkpoint=None):
+    return {"_id": "b1", "segment": "all", "content": {"text": "hi"}, "state": "running", "shard": 0,
+            "total": 10, "checkpoint": checkpoint, "sent": 0, "failed": 0, "bot_blocked": 0,
+            "created_at": 0, "finished_at": None, "progress": {"chat_id": 99, "message_id": None}}
+
+def test_checkpoint_only_covers_a_finished_prefix():
+    run = _Run(_doc())
+    for user_id in (1, 2, 3, 4, 5):
+        run.queue(user_id)
+    run.finish(2, "sent")
+    run.finish(4, "failed")
+    assert run.checkpoint is None
+    run.finish(1, "sent")
+    assert run.checkpoint == 2
+    run.finish(5, "bot_blocked")
+    assert run.checkpoint == 2
+    run.finish(3, "sent")
+    assert run.checkpoint == 5
+    assert (run.doc["sent"], run.doc["failed"], run.doc["bot_blocked"]) == (3, 1, 1)
+
+def test_resume_starts_after_the_checkpoint(db):
+    bot = FakeBot()
+
+    async def run():
+        await db.users.insert_many([{"user_id": user_id} for user_id in range(1, 11)])
+        doc = _doc(checkpoint=4)
+        await db.broadcasts.insert_one(dict(doc))
+        broadcaster = Broadcaster(rate=1000, concurrency=3)
+        broadcaster._bot = bot
+        broadcaster._launch(doc)
+        await broadcaster._runs["b1"][0]
+        return await db.broadcasts.find_one({"_id": "b1"})
+
+    saved = asyncio.run(run())
+    assert sorted(bot.sent) == list(range(5, 11))
+    assert saved["state"] == "done" and saved["checkpoint"] == 10 and saved["sent"] == 6
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+from bson import ObjectId
+
+import chatlog
+from chatlog import ChatLogPipeline, _to_line
+
+def entries(n, room_id="r1"):
+    return [{"_id": ObjectId(), "room_id": room_id, "text": str(i), "timestamp": i} for i in range(n)]
+
+def write_spool(path, lines):
+    path.write_text("".join(lines), encoding="utf-8")
+
+def test_replay_skips_corrupt_lines(db, tmp_path):
+    pipeline = ChatLogPipeline(spool_path=tmp_path / "chatlog.spool", batch_size=2)
+    good = entries(3)
+    write_spool(pipeline.spool_path, [
+        _to_line(good[0]),
+        "{not json\n",
+        json.dumps({"room_id": "r1", "text": "no id"}) + "\n",
+        json.dumps({"_id": "not-an-object-id", "room_id": "r1"}) + "\n",
+        "[1, 2]\n",
+        _to_line(good[1]),
+        _to_line(good[2]),
+    ])
+    assert asyncio.run(pipeline.replay()) == 3
+    assert asyncio.run(db.chatlogs.count_documents({})) == 3
+    assert not pipeline.spool_path.exists()
+    assert not pipeline.spool_path.with_suffix(".replay").exists()
+
+def test_failed_replay_puts_the_rest_back_on_the_spool(db, tmp_path, monkeypatch):
+    pipeline = ChatLogPipeline(spool_path=tmp_path / "chatlog.spool", batch_size=2)
+    spooled = entries(5)
+    write_spool(pipeline.spool_path, [_to_line(entry) for entry in spooled])
+    written = []
+
+    async def flaky(batch):
+        if written:
+            raise ConnectionError("mongo went away")
+        written.extend(batch)
+    monkeypatch.setattr(chatlog, "insert_chat_logs", flaky)
+
+    assert asyncio.run(pipeline.replay()) == 2
+    left = [json.loads(line)["_id"] for line in pipeline.spool_path.read_text().splitlines()]
+    assert left == [str(entry["_id"]) for entry in spooled[2:]]
+    assert not pipeline.spool_path.with_suffix(".replay").exists()
+
+def test_interrupted_replay_keeps_the_file(db, tmp_path, monkeypatch):
+    pipeline = ChatLogPipeline(spool_path=tmp_path / "chatlog.spool", batch_size=2)
+    write_spool(pipeline.spool_path, [_to_line(entry) for entry in entries(4)])
+
+    async def cancelled(batch):
+        raise asyncio.CancelledError
+    monkeypatch.setattr(chatlog, "insert_chat_logs", cancelled)
+    try:
+        asyncio.run(pipeline.replay())
+    except asyncio.CancelledError:
+        pass
+    assert pipeline.spool_path.with_suffix(".replay").exists()
+
+    monkeypatch.undo()
+    assert asyncio.run(pipeline.replay()) == 4
+    assert asyncio.run(db.chatlogs.count_documents({})) == 4
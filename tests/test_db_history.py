@@ -0,0 +1,48 @@
+import asyncio
+from bson import ObjectId
+from db import (insert_chat_archive, get_chat_history, get_chat_history_page, get_recent_chat_messages,
+                iter_chat_history)
+
+ROOM = "r1"
+
+def _setup(db):
+    # 25 entries: the first 18 archived in segments of 5, the rest hot, and
+    # entry 16 left in both tiers as if an archive pass died mid-delete.
+    entries = [{"_id": ObjectId(), "room_id": ROOM, "timestamp": float(i // 2), "text": str(i)} for i in range(25)]
+    async def run():
+        await db.chatlogs.insert_many([dict(entry) for entry in entries])
+        for start in range(0, 18, 5):
+            await insert_chat_archive(ROOM, entries[start:min(start + 5, 18)])
+        await db.chatlogs.insert_one(dict(entries[16]))
+    asyncio.run(run())
+    return [entry["text"] for entry in entries]
+
+def _texts(docs):
+    return [doc["text"] for doc in docs]
+
+def test_full_history_merges_both_tiers(db):
+    expected = _setup(db)
+    async def run():
+        return [doc async for doc in iter_chat_history(ROOM, batch_size=3)], await get_chat_history(ROOM)
+    streamed, listed = asyncio.run(run())
+    assert _texts(streamed) == _texts(listed) == expected
+
+def test_pages_walk_forward_and_back(db):
+    expected = _setup(db)
+    def page(**kwargs):
+        return asyncio.run(get_chat_history_page(ROOM, limit=4, **kwargs))
+    pages, docs = [], page()
+    while docs:
+        pages.append(docs)
+        docs = page(after=(docs[-1]["timestamp"], docs[-1]["_id"]))
+    assert [text for docs in pages for text in _texts(docs)] == expected
+    back, docs = [], pages[-1]
+    while docs:
+        back.append(docs)
+        docs = page(before=(docs[0]["timestamp"], docs[0]["_id"]))
+    assert [text for docs in reversed(back) for text in _texts(docs)] == expected
+
+def test_recent_messages_reach_into_the_archive(db):
+    expected = _setup(db)
+    assert _texts(asyncio.run(get_recent_chat_messages(ROOM, 3))) == expected[-3:]
+    assert _texts(asyncio.run(get_recent_chat_messages(ROOM, 12))) == expected[-12:]
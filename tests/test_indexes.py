@@ -0,0 +1,44 @@
+import asyncio
+import os
+import pytest
+import indexes
+from indexes import INDEXES, QUERY_PLANS, check_query_plans, ensure_indexes
+from storage import MONGODB_URI
+
+# The plan check needs a real server; the local backend has no planner.
+TEST_MONGODB_URI = os.getenv("TEST_MONGODB_URI", MONGODB_URI)
+TEST_DB = "anonindochat_test_indexes"
+
+def _leading_fields(collection):
+    return {next(iter(model.document["key"])) for model in INDEXES[collection]} | {"_id"}
+
+@pytest.mark.parametrize("label,collection,query,sort", QUERY_PLANS, ids=[plan[0] for plan in QUERY_PLANS])
+def test_query_plan_has_a_candidate_index(label, collection, query, sort):
+    fields = set(query) | {field for field, _ in sort or ()}
+    assert collection in INDEXES
+    assert fields & _leading_fields(collection), f"{label}: no index leads with {sorted(fields)}"
+
+def test_query_plans_use_indexes(monkeypatch):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo.errors import PyMongoError
+
+    async def run():
+        client = AsyncIOMotorClient(TEST_MONGODB_URI, serverSelectionTimeoutMS=1000)
+        try:
+            try:
+                await client.admin.command("ping")
+            except PyMongoError:
+                return None
+            monkeypatch.setattr(indexes, "db", client[TEST_DB])
+            try:
+                await ensure_indexes()
+                return await check_query_plans()
+            finally:
+                await client.drop_database(TEST_DB)
+        finally:
+            client.close()
+
+    failures = asyncio.run(run())
+    if failures is None:
+        pytest.skip(f"no MongoDB at {TEST_MONGODB_URI}")
+    assert failures == []
@@ -0,0 +1,49 @@
+from lifecycle import TimerWheel
+
+def test_expires_at_the_deadline_tick():
+    wheel = TimerWheel(5, 30, now=0)
+    wheel.schedule("a", 12)
+    assert wheel.advance(10) == []
+    assert wheel.advance(15) == ["a"]
+    assert "a" not in wheel and len(wheel) == 0
+
+def test_touch_pushes_the_deadline_out():
+    wheel = TimerWheel(5, 30, now=0)
+    wheel.schedule("a", 30)
+    wheel.touch("a", 50)
+    # The old slot comes round first and re-slots the key.
+    assert wheel.advance(30) == []
+    assert "a" in wheel
+    assert wheel.advance(45) == []
+    assert wheel.advance(50) == ["a"]
+
+def test_touch_never_pulls_a_deadline_in_or_adds_keys():
+    wheel = TimerWheel(5, 30, now=0)
+    wheel.schedule("a", 30)
+    wheel.touch("a", 10)
+    wheel.touch("b", 10)
+    assert wheel.advance(25) == []
+    assert "b" not in wheel
+    assert wheel.advance(30) == ["a"]
+
+def test_cancel():
+    wheel = TimerWheel(5, 30, now=0)
+    wheel.schedule("a", 10)
+    wheel.schedule("b", 10)
+    wheel.cancel("a")
+    wheel.cancel("missing")
+    assert wheel.advance(10) == ["b"]
+    # A cancelled key can be scheduled again.
+    wheel.schedule("a", 20)
+    assert wheel.advance(20) == ["a"]
+
+def test_advance_after_a_stall_longer_than_a_revolution():
+    wheel = TimerWheel(5, 30, now=0)
+    for i in range(10):
+        wheel.schedule(i, 5 + i * 3)
+    wheel.schedule("late", 500)
+    assert sorted(wheel.advance(200), key=str) == list(range(10))
+    assert "late" in wheel
+    assert wheel.advance(495) == []
+    assert wheel.advance(500) == ["late"]
+    assert wheel.advance(400) == []
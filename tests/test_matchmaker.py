@@ -0,0 +1,29 @@
+from rooms import MatchPool
+from matchmaker import Matchmaker
+
+def test_empty_classes_are_dropped():
+    pool = MatchPool()
+    pool.add(1, {"gender": "male"})
+    pool.add(2, {"gender": "female"}, {"gender": "male"})
+    pool.add(1, {"gender": "male"}, {"language": "en"})
+    assert len(pool.classes) == 2
+    pool.discard(1)
+    pool.discard(2)
+    assert pool.classes == {} and len(pool) == 0
+
+def test_tick_pairs_mutually_compatible_users_oldest_first():
+    pool = MatchPool()
+    pool.add(1, {"gender": "male"}, {"gender": "female"}, since=1)
+    pool.add(2, {"gender": "male"}, since=2)
+    pool.add(3, {"gender": "female"}, {"gender": "male"}, since=3)
+    pool.add(4, {"gender": "female"}, since=4)
+    pairs = Matchmaker(pool).tick(now=10)
+    assert sorted(map(sorted, pairs)) == [[1, 3], [2, 4]]
+    assert pool.classes == {}
+
+def test_tick_leaves_incompatible_users_waiting():
+    pool = MatchPool()
+    pool.add(1, {"gender": "male"}, {"gender": "female"}, since=1)
+    pool.add(2, {"gender": "male"}, {"gender": "female"}, since=2)
+    assert Matchmaker(pool).tick(now=10) == []
+    assert list(pool) == [1, 2] and len(pool.classes) == 1
@@ -0,0 +1,39 @@
+import asyncio
+from telegram.error import Forbidden, NetworkError
+import rooms
+from handlers.message_router import on_delivery_failure, DELIVERY_FAILED_TEXT, PARTNER_GONE_TEXT
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+
+def _fail_relay(bot, room_id, error):
+    async def run():
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(on_delivery_failure(bot, room_id, 2, 1))
+        future.set_exception(error)
+        for _ in range(10):
+            await asyncio.sleep(0)
+    asyncio.run(run())
+
+def test_forbidden_closes_the_room(db):
+    bot = FakeBot()
+    asyncio.run(db.users.insert_one({"user_id": 2}))
+    room_id = asyncio.run(rooms.create_room(1, 2))
+    _fail_relay(bot, room_id, Forbidden("bot was blocked by the user"))
+    assert rooms.room_of(1) is None and rooms.room_of(2) is None
+    assert bot.sent == [(1, PARTNER_GONE_TEXT)]
+    assert asyncio.run(db.users.find_one({"user_id": 2}))["bot_blocked"]
+
+def test_other_failures_tell_the_sender(db):
+    bot = FakeBot()
+    room_id = asyncio.run(rooms.create_room(1, 2))
+    try:
+        _fail_relay(bot, room_id, NetworkError("timed out"))
+        assert rooms.room_of(1) == room_id
+        assert bot.sent == [(1, DELIVERY_FAILED_TEXT)]
+    finally:
+        asyncio.run(rooms.close_room(room_id))
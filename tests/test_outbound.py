@@ -0,0 +1,104 @@
+import asyncio
+from telegram.error import RetryAfter
+from outbound import Dispatcher, TokenBucket, RELAY, NOTICE, ADMIN, BULK
+
+def _dispatcher(**kwargs):
+    dispatcher = Dispatcher(global_rate=1000, **kwargs)
+    dispatcher.private = (1000, 1000)
+    return dispatcher
+
+class FakeSend:
+    # Records (chat_id, n) as each send completes.
+    def __init__(self):
+        self.delivered = []
+        self.calls = []
+
+    async def __call__(self, chat_id, n, delay=0.0, fail=None):
+        self.calls.append((chat_id, n))
+        await asyncio.sleep(delay)
+        if fail is not None and fail.pop(n, None):
+            raise RetryAfter(0.05)
+        self.delivered.append((chat_id, n))
+        return n
+
+def test_sends_to_one_chat_keep_their_order():
+    async def run():
+        dispatcher, send = _dispatcher(), FakeSend()
+        await dispatcher.start()
+        try:
+            futures = [dispatcher.submit((RELAY, NOTICE, BULK)[n % 3], send, chat_id=chat_id, n=n,
+                                         delay=0.01 * ((n * 7) % 3))
+                       for n in range(12) for chat_id in (1, 2)]
+            return send, await asyncio.gather(*futures)
+        finally:
+            await dispatcher.stop()
+    send, results = asyncio.run(run())
+    assert results == [n for n in range(12) for _ in (1, 2)]
+    for chat_id in (1, 2):
+        assert [n for c, n in send.delivered if c == chat_id] == list(range(12))
+
+def test_relays_go_before_admin_sends_under_contention():
+    async def run():
+        dispatcher, send = _dispatcher(concurrency=1), FakeSend()
+        gate = asyncio.Event()
+
+        async def blocker(chat_id):
+            await gate.wait()
+        await dispatcher.start()
+        try:
+            first = dispatcher.submit(ADMIN, blocker, chat_id=0)
+            while not dispatcher._sending:
+                await asyncio.sleep(0)
+            futures = [dispatcher.submit(ADMIN, send, chat_id=chat_id, n=chat_id) for chat_id in range(1, 5)]
+            futures += [dispatcher.submit(RELAY, send, chat_id=chat_id, n=chat_id) for chat_id in range(5, 9)]
+            gate.set()
+            await asyncio.gather(first, *futures)
+            return send
+        finally:
+            await dispatcher.stop()
+    send = asyncio.run(run())
+    assert [n for _, n in send.delivered] == [5, 6, 7, 8, 1, 2, 3, 4]
+
+def test_retry_after_is_retried_in_order():
+    async def run():
+        dispatcher, send = _dispatcher(), FakeSend()
+        fail = {0: True}
+        await dispatcher.start()
+        try:
+            futures = [dispatcher.submit(RELAY, send, chat_id=1, n=n, fail=fail) for n in range(3)]
+            return send, await asyncio.gather(*futures), dispatcher.stats
+        finally:
+            await dispatcher.stop()
+    send, results, stats = asyncio.run(run())
+    assert results == [0, 1, 2]
+    assert send.calls == [(1, 0), (1, 0), (1, 1), (1, 2)]
+    assert send.delivered == [(1, 0), (1, 1), (1, 2)]
+    assert stats["retry_after"] == 1 and stats["failed"] == 0
+
+def test_empty_chat_bucket_refunds_the_global_token():
+    async def run():
+        dispatcher, send = _dispatcher(concurrency=1), FakeSend()
+        dispatcher.private = (20, 1)
+        dispatcher.global_bucket = TokenBucket(0.001, 5)
+        gate = asyncio.Event()
+
+        async def blocker(chat_id):
+            await gate.wait()
+        await dispatcher.start()
+        try:
+            first = dispatcher.submit(ADMIN, blocker, chat_id=0)
+            while not dispatcher._sending:
+                await asyncio.sleep(0)
+            future = dispatcher.submit(RELAY, send, chat_id=1, n=0)
+            # Queued as ready, but its bucket runs dry before its turn.
+            dispatcher._chats[1].bucket.tokens = 0
+            gate.set()
+            await asyncio.gather(first, future)
+            return send, dispatcher.global_bucket.tokens
+        finally:
+            await dispatcher.stop()
+    send, tokens = asyncio.run(run())
+    assert send.delivered == [(1, 0)]
+    # One token each for the two deliveries; the turn the chat could not
+    # take was given back.
+    assert round(tokens) == 3
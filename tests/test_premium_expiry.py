@@ -0,0 +1,72 @@
+import asyncio
+import time
+from datetime import datetime
+import pytest
+import premium_expiry
+from premium_expiry import ExpiryScheduler, expiry_timestamp
+
+def test_schedule_is_ignored_when_not_running():
+    scheduler = ExpiryScheduler()
+    for _ in range(3):
+        scheduler.schedule(1, "2099-01-01T00:00:00")
+    assert len(scheduler) == 0 and not scheduler._heap
+
+def test_schedule_while_running(db):
+    async def run():
+        scheduler = ExpiryScheduler()
+        await scheduler.start(bot=None)
+        try:
+            scheduler.schedule(1, "2099-01-01T00:00:00")
+            scheduler.schedule(2, "2099-01-02T00:00:00")
+            scheduler.cancel(1)
+            return len(scheduler), scheduler.next_due()
+        finally:
+            await scheduler.stop()
+    count, due = asyncio.run(run())
+    assert count == 1
+    assert due == expiry_timestamp("2099-01-02T00:00:00")
+
+def _seed(db, now):
+    iso = lambda ts: datetime.utcfromtimestamp(ts).isoformat()
+    async def run():
+        await db.users.insert_many([
+            {"user_id": 1, "is_premium": True, "premium_expiry": iso(now - 60)},
+            {"user_id": 2, "is_premium": True, "premium_expiry": iso(now - 30)},
+            {"user_id": 3, "is_premium": True, "premium_expiry": iso(now + 3600)},
+            {"user_id": 4, "is_premium": False, "premium_expiry": None},
+        ])
+        scheduler = ExpiryScheduler()
+        assert await scheduler.load() == 3
+        # Renewed after the scheduler loaded; its heap entry is stale.
+        await db.users.update_one({"user_id": 2}, {"$set": {"premium_expiry": iso(now + 86400)}})
+        return scheduler
+    return run
+
+def test_fire_downgrades_only_expired_users(db):
+    now = time.time()
+    async def run():
+        scheduler = await _seed(db, now)()
+        expired = await scheduler.fire(now)
+        queued = [scheduler._notify_queue.get_nowait() for _ in range(scheduler._notify_queue.qsize())]
+        premium = {doc["user_id"]: doc["is_premium"] async for doc in db.users.find({})}
+        return scheduler, expired, queued, premium
+    scheduler, expired, queued, premium = asyncio.run(run())
+    assert expired == queued == [1]
+    assert premium == {1: False, 2: True, 3: True, 4: False}
+    # Only the not-yet-due user is left.
+    assert len(scheduler) == 1 and scheduler.next_due() > now
+
+def test_failed_downgrade_is_rescheduled(db, monkeypatch):
+    now = time.time()
+    async def fail(user_ids, now_iso):
+        raise RuntimeError("db down")
+    async def run():
+        scheduler = await _seed(db, now)()
+        monkeypatch.setattr(premium_expiry, "downgrade_premium_users", fail)
+        with pytest.raises(RuntimeError):
+            await scheduler.fire(now)
+        due = [user_id for _, user_id in scheduler.pop_due(now + 1)]
+        return scheduler, due
+    scheduler, due = asyncio.run(run())
+    assert sorted(due) == [1, 2]
+    assert scheduler._notify_queue.empty()
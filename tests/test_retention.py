@@ -0,0 +1,31 @@
+import asyncio
+from retention import ChatLogRetention
+
+def _setup(db):
+    async def run():
+        await db.rooms.insert_one({"room_id": "a", "active": True})
+        await db.rooms.insert_one({"room_id": "b", "active": False})
+        # "c" was deleted by /end; its logs remain.
+        await db.chatlogs.insert_many([{"room_id": room_id, "timestamp": ts, "text": "hi"}
+                                       for room_id in "abc" for ts in (1, 2)])
+    asyncio.run(run())
+
+def _hot_rooms(db):
+    return asyncio.run(db.chatlogs.distinct("room_id"))
+
+def test_open_rooms_do_not_block_the_walk(db):
+    _setup(db)
+    retention = ChatLogRetention(rooms_per_pass=1)
+    passes = [asyncio.run(retention.archive_closed_rooms(cutoff=100)) for _ in range(3)]
+    assert passes == [0, 1, 1]
+    assert sorted(_hot_rooms(db)) == ["a"]
+    assert sorted(asyncio.run(db.chatlog_archives.distinct("room_id"))) == ["b", "c"]
+
+def test_walk_wraps_round(db):
+    _setup(db)
+    retention = ChatLogRetention(rooms_per_pass=10)
+    assert asyncio.run(retention.archive_closed_rooms(cutoff=100)) == 2
+    assert retention._last_room is None
+    asyncio.run(db.rooms.update_one({"room_id": "a"}, {"$set": {"active": False}}))
+    assert asyncio.run(retention.archive_closed_rooms(cutoff=100)) == 1
+    assert _hot_rooms(db) == []
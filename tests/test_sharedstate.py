@@ -0,0 +1,80 @@
+import asyncio
+
+from sharedstate import MongoMatchState
+
+def state(db, shard=0, shards=1):
+    return MongoMatchState(shard, shards, publish=lambda target, event: None, collection=db.waiting)
+
+def test_waiter_prefs_apply_to_the_requester(db):
+    async def run():
+        shared = state(db)
+        assert await shared.request_match(1, {"gender": "female"}, {"gender": "male"}) is None
+        assert await shared.request_match(2, {"gender": "female"}, {}) is None
+        # 3 is male and has no prefs: 1 wants a male and is the oldest.
+        assert await shared.request_match(3, {"gender": "male"}, {}) == 1
+        # 4 is female; 2 (no prefs) is the only one left that accepts her.
+        assert await shared.request_match(4, {"gender": "female"}, {}) == 2
+    asyncio.run(run())
+
+def test_requester_filters_still_apply(db):
+    async def run():
+        shared = state(db)
+        await shared.add_waiting(1, {"language": "en"})
+        await shared.add_waiting(2, {"language": "id"})
+        assert await shared.request_match(3, {"language": "en"}, {"language": "id"}) == 2
+    asyncio.run(run())
+
+def test_waiters_without_stored_prefs_accept_anyone(db):
+    async def run():
+        await db.waiting.insert_one({"_id": 1, "gender": "male", "since": 1.0})
+        assert await state(db).request_match(2, {"gender": "female"}, {}) == 1
+    asyncio.run(run())
+
+def test_raced_requests_are_paired(db):
+    # Both claims ran before either user was in the pool.
+    async def run():
+        first, second = state(db, 0, 2), state(db, 1, 2)
+        await first.add_waiting(2, {"gender": "male"}, {})
+        await second.add_waiting(3, {"gender": "female"}, {})
+        # The second request's own re-check pairs them.
+        assert await second._rematch(await db.waiting.find_one({"_id": 3})) == 2
+        assert await db.waiting.count_documents({}) == 0
+    asyncio.run(run())
+
+def test_sweep_pairs_waiting_users(db):
+    async def run():
+        first, second = state(db, 0, 2), state(db, 1, 2)
+        await first.add_waiting(2, {"gender": "male"}, {"gender": "female"})
+        await second.add_waiting(3, {"gender": "male"}, {})
+        await second.add_waiting(5, {"gender": "female"}, {})
+        pairs = []
+
+        async def on_match(user_id, partner):
+            pairs.append((user_id, partner))
+        assert await first.sweep(on_match) == 1
+        assert pairs == [(2, 5)]
+        assert [doc["_id"] async for doc in db.waiting.find({})] == [3]
+        # Nobody left for 3; it keeps its place.
+        assert await second.sweep(on_match) == 0
+        assert await db.waiting.count_documents({"_id": 3}) == 1
+    asyncio.run(run())
+
+def test_rematch_of_a_claimed_user_does_nothing(db):
+    async def run():
+        shared = state(db)
+        await shared.add_waiting(1, {}, {})
+        await shared.add_waiting(2, {}, {})
+        doc = await db.waiting.find_one({"_id": 1})
+        assert await shared.claim(3, {}, {}) == 1
+        assert await shared._rematch(doc) is None
+        assert await db.waiting.count_documents({"_id": 2}) == 1
+    asyncio.run(run())
+
+def test_drop_waiting_reports_only_removed_users(db):
+    async def run():
+        shared = state(db)
+        await shared.add_waiting(1, {}, {})
+        await shared.add_waiting(2, {}, {})
+        assert await shared.claim(3, {}, {}) == 1
+        assert await shared.drop_waiting([1, 2]) == [2]
+    asyncio.run(run())
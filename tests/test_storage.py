@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+import storage
+from storage import JournalDatabase, LocalBackend
+
+class Crash(Exception):
+    pass
+
+def crash(*args):
+    raise Crash()
+
+def _contents(database):
+    async def read():
+        return sorted((doc["_id"], doc.get("v")) for doc in await database.items.find({}).to_list(None))
+    return asyncio.run(read())
+
+def _write(database, ops):
+    async def run():
+        for op, *args in ops:
+            await getattr(database.items, op)(*args)
+    asyncio.run(run())
+
+def test_replay_after_crash_mid_compaction(tmp_path, monkeypatch):
+    database = JournalDatabase(tmp_path)
+    _write(database, [("insert_one", {"_id": i, "v": 0}) for i in range(5)])
+    monkeypatch.setattr(storage, "_atomic_write", crash)
+    with pytest.raises(Crash):
+        asyncio.run(database.compact())
+    assert (tmp_path / "journal.jsonl.1").exists()
+    # Writes after the journal was moved aside land in the fresh journal.
+    _write(database, [("update_one", {"_id": 1}, {"$set": {"v": 1}}), ("delete_one", {"_id": 2}),
+                      ("insert_one", {"_id": 9, "v": 9})])
+    expected = _contents(database)
+    database.close()
+
+    monkeypatch.undo()
+    reopened = JournalDatabase(tmp_path)
+    assert _contents(reopened) == expected
+    asyncio.run(reopened.compact())
+    assert not (tmp_path / "journal.jsonl.1").exists()
+    reopened.close()
+    assert _contents(JournalDatabase(tmp_path)) == expected
+
+def test_replay_after_crash_before_dropping_moved_journal(tmp_path, monkeypatch):
+    database = JournalDatabase(tmp_path)
+    _write(database, [("insert_one", {"_id": i, "v": i}) for i in range(3)])
+    monkeypatch.setattr(storage.os, "remove", crash)
+    with pytest.raises(Crash):
+        asyncio.run(database.compact())
+    monkeypatch.undo()
+    _write(database, [("delete_one", {"_id": 0})])
+    expected = _contents(database)
+    database.close()
+    assert (tmp_path / "snapshot.jsonl").exists() and (tmp_path / "journal.jsonl.1").exists()
+    assert _contents(JournalDatabase(tmp_path)) == expected == [(1, 1), (2, 2)]
+
+def test_local_backend_refuses_cluster_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "CLUSTER_WORKERS", 2)
+    backend = LocalBackend(tmp_path)
+    try:
+        with pytest.raises(RuntimeError, match="CLUSTER_WORKERS=1"):
+            asyncio.run(backend.start())
+        assert backend._task is None
+    finally:
+        asyncio.run(backend.close())
+
+def test_main_refuses_cluster_mode_with_local_backend(monkeypatch):
+    import bot
+    monkeypatch.setattr(bot, "CLUSTER_WORKERS", 2)
+    monkeypatch.setattr(bot, "run_front", lambda *args: pytest.fail("cluster started"))
+    with pytest.raises(SystemExit, match="CLUSTER_WORKERS=1"):
+        bot.main()
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import pytest
+from telegram import Bot
+from webhook import WebhookServer
+
+SECRET = "s3cret"
+UPDATE = json.dumps({"update_id": 1}).encode()
+
+async def _serve(**kwargs):
+    server = WebhookServer(Bot("123456:TEST"), asyncio.Queue(), path="/hook", secret=SECRET, **kwargs)
+    await server.start(host="127.0.0.1", port=0)
+    return server, server._server.sockets[0].getsockname()[1]
+
+async def _request(port, head, body=b""):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+        return await asyncio.wait_for(reader.readline(), 5)
+    finally:
+        writer.close()
+
+def _post(headers):
+    return "".join(f"{line}\r\n" for line in ["POST /hook HTTP/1.1", "Connection: close", *headers])
+
+def test_requires_a_secret():
+    with pytest.raises(ValueError):
+        WebhookServer(Bot("123456:TEST"), asyncio.Queue(), secret="")
+
+@pytest.mark.parametrize("headers,status", [
+    ([f"Content-Length: {len(UPDATE)}"], b"403"),
+    ([f"Content-Length: {len(UPDATE)}", "X-Telegram-Bot-Api-Secret-Token: wrong"], b"403"),
+    ([f"Content-Length: {len(UPDATE)}", f"X-Telegram-Bot-Api-Secret-Token: {SECRET}"], b"200"),
+    (["Content-Length: abc", f"X-Telegram-Bot-Api-Secret-Token: {SECRET}"], b"400"),
+    (["Content-Length: -5", f"X-Telegram-Bot-Api-Secret-Token: {SECRET}"], b"400"),
+])
+def test_responses(headers, status):
+    async def run():
+        server, port = await _serve()
+        try:
+            line = await _request(port, _post(headers), UPDATE)
+            return line, server.update_queue.qsize()
+        finally:
+            await server.stop()
+    line, queued = asyncio.run(run())
+    assert line.split()[1] == status
+    assert queued == (1 if status == b"200" else 0)
+
+def test_idle_connections_are_closed():
+    async def run():
+        server, port = await _serve(read_timeout=0.1)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"POST /hook HTTP/1.1\r\n")
+            await writer.drain()
+            data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return data
+        finally:
+            await server.stop()
+    assert asyncio.run(run()) == b""
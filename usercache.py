@@ -0,0 +1,101 @@
+"""usercache.py - bounded LRU/TTL cache for user profile documents"""
+import os
+import time
+from collections import OrderedDict
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+_MISSING = object()
+
+class UserCache:
+    # Profiles are read on almost every command but written rarely, and
+    # every write goes through db.update_user, which patches the cached copy.
+    # The TTL only bounds staleness for writes made by other processes when
+    # no invalidation publisher is installed.
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (expires, doc or None)
+        self._usernames = {}  # username -> user_id
+        self._generation = 0
+        self.publisher = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def generation(self):
+        # Taken before a database read; store() discards the result if an
+        # invalidation happened while the read was in flight.
+        return self._generation
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.stats["misses"] += 1
+            return _MISSING
+        expires, doc = entry
+        if expires < time.monotonic():
+            self._drop(user_id)
+            self.stats["misses"] += 1
+            return _MISSING
+        self._entries.move_to_end(user_id)
+        self.stats["hits"] += 1
+        return doc
+
+    def user_id_for(self, username):
+        user_id = self._usernames.get(username)
+        if user_id is None:
+            self.stats["misses"] += 1
+            return _MISSING
+        return user_id
+
+    def store(self, user_id, doc, generation=None):
+        if generation is not None and generation != self._generation:
+            return
+        self._drop(user_id)
+        self._entries[user_id] = (time.monotonic() + self.ttl, doc)
+        if doc and doc.get("username"):
+            self._usernames[doc["username"]] = user_id
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.stats["evictions"] += 1
+
+    def patch(self, user_id, updates):
+        # Applies a $set to the cached copy. A cached "no such user" is
+        # dropped instead, since the upsert created a document we have not
+        # seen in full.
+        self._generation += 1
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] is None:
+            self._drop(user_id)
+        else:
+            doc = {**entry[1], **updates}
+            self.store(user_id, doc)
+        if self.publisher is not None:
+            self.publisher(user_id)
+
+    def invalidate(self, user_id, publish=True):
+        self._generation += 1
+        self._drop(user_id)
+        self.stats["invalidations"] += 1
+        if publish and self.publisher is not None:
+            self.publisher(user_id)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._usernames.clear()
+
+    def _drop(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None and entry[1] and entry[1].get("username"):
+            if self._usernames.get(entry[1]["username"]) == user_id:
+                del self._usernames[entry[1]["username"]]
+
+cache = UserCache()
+
+def is_missing(value):
+    return value is _MISSING
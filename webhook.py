@@ -0,0 +1,175 @@
+"""webhook.py - built-in webhook server as an alternative to run_polling"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+from telegram import Update
+from diagnostics import recorder
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Checked against X-Telegram-Bot-Api-Secret-Token on every POST. Left
+# empty, a random one is made per run and registered by register_webhook,
+# which needs WEBHOOK_URL; without either the server refuses to start.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or (secrets.token_urlsafe(32) if WEBHOOK_URL else "")
+WEBHOOK_MAX_QUEUE = int(os.getenv("WEBHOOK_MAX_QUEUE", "10000"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# A connection with no complete request line, header or body for this long
+# (idle keep-alive included) is closed.
+WEBHOOK_READ_TIMEOUT = float(os.getenv("WEBHOOK_READ_TIMEOUT", "30"))
+MAX_BODY = 1 << 20
+
+_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+class WebhookServer:
+    # Minimal HTTP/1.1 server (keep-alive, Content-Length bodies only) that
+    # feeds Telegram updates into the application's update queue. When the
+    # queue is full it answers 503 so Telegram redelivers later instead of
+    # us buffering without bound.
+    def __init__(self, bot, update_queue, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 max_queue=WEBHOOK_MAX_QUEUE, read_timeout=WEBHOOK_READ_TIMEOUT):
+        if not secret:
+            raise ValueError("The webhook server needs WEBHOOK_SECRET (or WEBHOOK_URL, to register a generated one).")
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self.secret = secret.encode()
+        self.max_queue = max_queue
+        self.read_timeout = read_timeout
+        self._server = None
+        self._writers = set()
+        self.stats = {"accepted": 0, "rejected_full": 0, "rejected_auth": 0, "bad_request": 0}
+
+    async def start(self, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info("Webhook server listening on %s:%d%s", host, port, self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read(self, read):
+        return await asyncio.wait_for(read, self.read_timeout)
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await self._read(reader.readline())
+                if not request_line:
+                    break
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, close=True)
+                    break
+                headers = {}
+                while True:
+                    line = await self._read(reader.readline())
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length", "0") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self.stats["bad_request"] += 1
+                    await self._respond(writer, 400, close=True)
+                    break
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await self._read(reader.readexactly(length)) if length else b""
+                status = self._accept(method, target, headers, body)
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, close=close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            # Truncated, idle too long, reset, or a line over the reader's limit.
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def _accept(self, method, target, headers, body):
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode()
+        if not hmac.compare_digest(token, self.secret):
+            self.stats["rejected_auth"] += 1
+            return 403
+        if self.update_queue.qsize() >= self.max_queue:
+            self.stats["rejected_full"] += 1
+            return 503
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except Exception:
+            self.stats["bad_request"] += 1
+            return 400
+        recorder.mark_intake(update.update_id)
+        self.update_queue.put_nowait(update)
+        self.stats["accepted"] += 1
+        return 200
+
+    @staticmethod
+    async def _respond(writer, status, close=False):
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\nContent-Length: 0\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()
+
+async def register_webhook(bot):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+async def run_webhook(app):
+    # Same lifecycle as Application.run_webhook, minus the Updater: our own
+    # server puts updates straight onto app.update_queue.
+    server = WebhookServer(app.bot, app.update_queue)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        async with app:
+            if app.post_init:
+                await app.post_init(app)
+            await app.start()
+            await server.start()
+            await register_webhook(app.bot)
+            try:
+                await stop.wait()
+            finally:
+                await server.stop()
+                await app.stop()
+    finally:
+        # After shutdown, so persistence is flushed before storage closes;
+        # run_polling uses the same order.
+        if app.post_shutdown:
+            await app.post_shutdown(app)